@@ -3,33 +3,78 @@
 """
 
 
-import ast
+import contextlib
+import logging
 import os
+import shutil
 import sys
-from datetime import date
-import subprocess
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from urllib.parse import urlencode
 import diskcache
 
-from dash import Dash, html, dcc, callback, Output, Input, dash_table, no_update
+from dash import Dash, html, dcc, callback, Output, Input, State, dash_table, no_update
 from dash.long_callback import DiskcacheLongCallbackManager
 import plotly.express as px
+from plotly.io.json import to_json_plotly
 import dash_bootstrap_components as dbc
 
+import numpy as np
 import pandas as pd
-import geopandas as gpd
+import shapely
 import dash_leaflet as dl
 import json
 from dash_extensions.javascript import arrow_function
 
-from flask import Flask, render_template, send_from_directory
+from flask import Flask, Response, abort, render_template, request
+from werkzeug.security import safe_join
+
+import catalog
+from catalog import CatalogWatcher
+import http_cache
+import instrumentation
+import job_queue
+import ml_result_cache
+import ml_result_files
+import ml_result_summaries
+import ml_result_tiles
+import ml_workers
+import object_detection
+from processes import process_alive
+import scene_tiles
+import tile_archives
+import tile_prefetch
+import tile_pyramids
+import tiled_change_detection
+from tiling import is_valid_tile
+
+import psutil
 
 CONTACT_EMAIL = os.environ["CONTACT_EMAIL"]
 DEPLOY_STATUS = os.environ["DEPLOY_STATUS"]
-print(f"Deploy status is {DEPLOY_STATUS}")
 PORT = os.environ["PORT"]
-DEBUG_STATUS = os.environ["DEBUG_STATUS"]
+# "1", "true", "yes" or "on"; any other value (including an empty one) is off
+DEBUG_STATUS = os.environ["DEBUG_STATUS"].strip().lower() in ("1", "true", "yes", "on")
+
+# logfmt lines on stderr, at DEBUG when DEBUG_STATUS is on; see instrumentation.py
+instrumentation.configure_logging(DEBUG_STATUS)
+log = logging.getLogger(__name__)
+log.info("Deploy status is %s", DEPLOY_STATUS)
 ML_MODEL_PATH = os.environ["ML_MODEL_PATH"]
 CHANGE_DETECTION_SCRIPT = os.environ["CHANGE_DETECTION_SCRIPT"]
+# ONNX object detection model, relative to the assets directory; see object_detection.py for its input and output
+DETECTION_MODEL_PATH = os.environ.get("DETECTION_MODEL_PATH", "models/detection.onnx")
+# scenes are processed in windows of this many pixels (plus overlap) to bound worker memory
+CHANGE_DETECTION_WINDOW_SIZE = int(os.environ.get("CHANGE_DETECTION_WINDOW_SIZE", str(tiled_change_detection.WINDOW_SIZE)))
+CHANGE_DETECTION_WINDOW_OVERLAP = int(os.environ.get("CHANGE_DETECTION_WINDOW_OVERLAP", str(tiled_change_detection.WINDOW_OVERLAP)))
+# pre-render tile pyramids of new and changed scenes this often, as a background ML job; 0 (the default) never does
+TILE_PYRAMID_INTERVAL_SECONDS = float(os.environ.get("TILE_PYRAMID_INTERVAL_SECONDS", "0"))
+TILE_PYRAMID_PROCESSES = int(os.environ.get("TILE_PYRAMID_PROCESSES", "1"))
+# "png" or "webp"; see tile_pyramids.py
+TILE_PYRAMID_FORMAT = os.environ.get("TILE_PYRAMID_FORMAT", "png")
+TILE_PYRAMID_QUANTIZE_BITS = int(os.environ["TILE_PYRAMID_QUANTIZE_BITS"]) if os.environ.get("TILE_PYRAMID_QUANTIZE_BITS") else None
 
 
 external_stylesheets = [dbc.themes.CERULEAN, dbc.icons.BOOTSTRAP, dbc.icons.FONT_AWESOME]
@@ -43,66 +88,450 @@ app = Dash(__name__,
             external_stylesheets=external_stylesheets,
             server=server)
 
-ASSETS_DIRECTORY = "/blob/assets"
-ML_RESULTS_DIRECTORY = "/fs/ml_results"
+# latency, response size and error metrics of every route and Dash callback, summed over all server processes
+metrics = instrumentation.Metrics(os.environ.get("METRICS_DIRECTORY", "/tmp/web-map-metrics"))
+instrumentation.instrument_flask(server, metrics)
+
+# the blob mount and the shared results volume; overridable to run against other data, e.g. by benchmarks/load_test.py
+ASSETS_DIRECTORY = os.environ.get("ASSETS_DIRECTORY", "/blob/assets")
+ML_RESULTS_DIRECTORY = os.environ.get("ML_RESULTS_DIRECTORY", "/fs/ml_results")
+# tiles rendered from scene GeoTIFFs (or copied from pre-rendered pyramids); LRU evicted past the size limit
+tile_cache = scene_tiles.TileCache(os.environ.get("TILE_CACHE_DIRECTORY", "/fs/tile_cache"),
+                                   size_limit=int(os.environ.get("TILE_CACHE_SIZE_LIMIT_BYTES", str(10 * 2**30))))
+# MBTiles archives of pre-rendered pyramids, read in place of their directories when present; see tile_archives.py
+pyramid_archives = tile_archives.TileArchives(ASSETS_DIRECTORY)
+# threads fetching the tiles of a newly selected site or date into the tile cache; 0 turns prefetching off, see tile_prefetch.py
+TILE_PREFETCH_WORKERS = int(os.environ.get("TILE_PREFETCH_WORKERS", "2"))
+tile_prefetcher = tile_prefetch.TilePrefetcher(
+    lambda scene, z, x, y: scene_tiles.get_scene_tile(scene, z, x, y, ASSETS_DIRECTORY, tile_cache, pyramid_archives),
+    max_workers=max(TILE_PREFETCH_WORKERS, 1),
+    # per selection: tiles, bytes and zoom levels (the ones users request most after opening a site)
+    max_tiles=int(os.environ.get("TILE_PREFETCH_MAX_TILES", "256")),
+    max_bytes=int(os.environ.get("TILE_PREFETCH_MAX_BYTES", str(64 * 2**20))),
+    zoom_levels=int(os.environ.get("TILE_PREFETCH_ZOOM_LEVELS", "2"))) if TILE_PREFETCH_WORKERS > 0 else None
+# vector tiles cut from ML results; safe to delete, tiles are regenerated on demand
+ML_RESULT_TILE_CACHE_DIRECTORY = os.environ.get("ML_RESULT_TILE_CACHE_DIRECTORY", "/fs/ml_result_tiles")
+
+def remove_ml_result_derivatives(filename):
+    """Remove what was derived from an evicted result file: its cached vector tiles, index and summary"""
+
+    shutil.rmtree(os.path.join(ML_RESULT_TILE_CACHE_DIRECTORY, filename.removesuffix(".geojson")), ignore_errors=True)
+    for suffix in (ml_result_files.INDEX_SUFFIX, ml_result_summaries.SUMMARY_SUFFIX):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(ML_RESULTS_DIRECTORY, filename + suffix))
+
+# ML results memoized on their inputs, model and script; least recently used results are deleted past the size limit
+result_cache = ml_result_cache.ResultCache(
+    os.environ.get("ML_RESULT_CACHE_DIRECTORY", "/fs/ml_result_cache"), ML_RESULTS_DIRECTORY,
+    size_limit=int(os.environ.get("ML_RESULT_CACHE_SIZE_LIMIT_BYTES", str(20 * 2**30))),
+    on_evict=remove_ml_result_derivatives)
+# ML runs queued by every server worker and run by the scheduler in the ML pool server; survives restarts
+ml_job_queue = job_queue.JobQueue(os.environ.get("ML_JOB_DATABASE", "/fs/ml_jobs.sqlite"))
+# memory the scheduler lets running ML jobs use; defaults to half of the host's RAM
+ML_JOB_MEMORY_BUDGET_MB = float(os.environ.get("ML_JOB_MEMORY_BUDGET_MB", str(psutil.virtual_memory().total / 2**20 / 2)))
+# how often a waiting long callback reads its job's state
+ML_JOB_POLL_SECONDS = 1
 
 # Diskcache for long callbacks
 # Mount on r+w filesystem
-cache = diskcache.Cache("/fs/cache")
+cache = diskcache.Cache(os.environ.get("LONG_CALLBACK_CACHE_DIRECTORY", "/fs/cache"))
 long_callback_manager = DiskcacheLongCallbackManager(cache)
 
-sites_metadata = "/blob/assets/sites/sites.geojson"
-print(f"Site metadata being used is {sites_metadata}")
 
-@server.route("/app/WEB/maptiles/<path:location>/<z>/<x>/<y>.png")
-def serve_tiles(location, z, x, y):
+@contextlib.contextmanager
+def session_ml_job(session_id):
+    """Claim the browser session's single ML job slot; yields False if a job is already running for it
+
+    The slot records the long callback's pid, so it is freed even when a cancel kills that process.
+    """
+
+    key = ("ml-session-job", session_id)
+    with cache.transact():
+        holder = cache.get(key)
+        claimed = holder is None or not process_alive(holder)
+        if claimed:
+            cache.set(key, os.getpid())
+
+    try:
+        yield claimed
+    finally:
+        if claimed:
+            cache.delete(key)
+
+
+sites_metadata = os.environ.get("SITES_METADATA", os.path.join(ASSETS_DIRECTORY, "sites", "sites.geojson"))
+log.info("Site metadata being used is %s", sites_metadata)
+
+# Cache-Control/compression per route; see http_cache.py for the HTTP_CACHE_CONTROL_<ROUTE> overrides
+cache_policies = http_cache.load_policies()
+
+@server.route("/app/WEB/maptiles/<path:location>/<z>/<x>/<y>.<any(png, webp):extension>")
+def serve_tiles(location, z, x, y, extension):
     """Serve tilemaps for dash_leaflet map component
     """
 
-    url = f"{location}/{z}/{x}/{y}.png"
+    url = f"{location}/{z}/{x}/{y}.{extension}"
     
-    if DEBUG_STATUS: print(f"Tilemap requested: {url}")
+    log.debug("Tilemap requested: %s", url)
+
+    # pyramids converted to an archive are read from it, the rest from their directories
+    if z.isdigit() and x.isdigit() and y.isdigit():
+        found, tile = pyramid_archives.read(location, int(z), int(x), int(y))
+        if found:
+            if tile is None:
+                abort(404)
+            return http_cache.send_bytes_cached(tile, scene_tiles.tile_mimetype(tile), cache_policies["tiles"])
+
+    return http_cache.send_file_cached(ASSETS_DIRECTORY, url, cache_policies["tiles"])
+
+@server.route("/app/WEB/scene_tiles/<uuid>/<int:z>/<int:x>/<int:y>.png")
+def serve_scene_tiles(uuid, z, x, y):
+    """Serve tilemaps for a scene, rendering them from its GeoTIFF when there is no pre-rendered pyramid
+    """
+
+    log.debug("Scene tile requested: %s/%s/%s/%s", uuid, z, x, y)
+
+    scene = catalog_watcher.current.scene(uuid)
+    if scene is None or not is_valid_tile(z, x, y):
+        abort(404)
+
+    if tile_prefetcher is not None and isinstance(scene.get("webmap_zoom"), (int, float)):
+        # teaches the prefetcher which zooms users look at after opening a site
+        tile_prefetcher.record_request(z, int(scene["webmap_zoom"]))
+
+    tile = scene_tiles.get_scene_tile(scene, z, x, y, ASSETS_DIRECTORY, tile_cache, pyramid_archives)
+    if tile is None:
+        abort(404)
 
-    return send_from_directory(ASSETS_DIRECTORY, url)
+    return http_cache.send_bytes_cached(tile, scene_tiles.tile_mimetype(tile), cache_policies["tiles"])
+
+def _stream_ml_results(filename, stream, mimetype, summarise=False):
+    """Stream the features of a result intersecting the `bbox=west,south,east,north` query parameter, if given
+
+    With `summarise` and a `zoom` below ml_result_summaries.RAW_MIN_ZOOM, a
+    view holding more than RAW_MAX_FEATURES features gets the result's grid
+    summary for that zoom instead of the features.
+    """
+
+    try:
+        bbox = tuple(float(value) for value in request.args["bbox"].split(",")) if "bbox" in request.args else None
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError(bbox)
+        zoom = int(float(request.args["zoom"])) if summarise and "zoom" in request.args else None
+    except ValueError:
+        abort(400, description="Expected bbox=west,south,east,north and a numeric zoom")
+
+    path = safe_join(ML_RESULTS_DIRECTORY, f"{filename}.geojson")
+    try:
+        stat = os.stat(path) if path else None
+    except FileNotFoundError:
+        stat = None
+    if stat is None:
+        abort(404)
+
+    policy = cache_policies["ml_results"]
+    summarised = zoom is not None and zoom < ml_result_summaries.RAW_MIN_ZOOM
+    etag = http_cache.content_etag(stat.st_mtime_ns, stat.st_size, mimetype, bbox, zoom if summarised else None)
+    response = http_cache.not_modified(etag, policy)
+    if response is not None:
+        return response
+
+    try:
+        if summarised:
+            summary = ml_result_summaries.load(path)
+            if summary.feature_count(bbox) > ml_result_summaries.RAW_MAX_FEATURES:
+                return http_cache.send_bytes_cached(summary.to_geojson(zoom, bbox), mimetype, policy, etag=etag)
+        chunks = stream(path, bbox)
+    except FileNotFoundError:
+        abort(404)
+
+    return http_cache.send_stream_cached(chunks, mimetype, policy, etag)
 
 @server.route("/app/WEB/ml_results/<path:filename>.geojson")
 def serve_ml_results(filename):
     """Serve ML results for dash_leaflet map component
+
+    With `bbox=west,south,east,north` only the features intersecting it are
+    streamed, read through the result's index (see ml_result_files.py);
+    adding `zoom` returns the grid summary of a crowded view when zoomed out
+    (see ml_result_summaries.py). Without them the whole file is served,
+    byte ranges included.
     """
 
-    url = f"{filename}"
+    url = f"{filename}.geojson"
     
-    if DEBUG_STATUS: print(f"ML geojson results requested to show on map: {url}")
+    log.debug("ML geojson results requested to show on map: %s %s", url, request.query_string.decode())
+
+    if "bbox" in request.args or "zoom" in request.args:
+        return _stream_ml_results(filename, ml_result_files.stream_geojson, "application/geo+json", summarise=True)
+
+    return http_cache.send_file_cached(ML_RESULTS_DIRECTORY, url, cache_policies["ml_results"], mimetype="application/geo+json")
+
+@server.route("/app/WEB/ml_results/<path:filename>.ndjson")
+def serve_ml_results_ndjson(filename):
+    """Stream ML results as newline-delimited GeoJSON features, optionally only those in `bbox`"""
+
+    log.debug("ML ndjson results requested: %s %s", filename, request.args.get("bbox", ""))
 
-    return send_from_directory(ML_RESULTS_DIRECTORY, url)
+    return _stream_ml_results(filename, ml_result_files.stream_ndjson, "application/x-ndjson")
+
+@server.route("/app/WEB/ml_results_tiles/<path:name>/<int:z>/<int:x>/<int:y>.pbf")
+def serve_ml_result_tiles(name, z, x, y):
+    """Serve ML results as Mapbox Vector Tiles so clients only fetch what is in view
+
+    Tiles are cut from `ML_RESULTS_DIRECTORY/<name>.geojson` and cached on disk
+    """
+
+    log.debug("ML results vector tile requested: %s/%s/%s/%s", name, z, x, y)
+
+    if not is_valid_tile(z, x, y):
+        abort(404)
+
+    try:
+        tile = ml_result_tiles.get_tile(ML_RESULTS_DIRECTORY, name, z, x, y, cache_directory=ML_RESULT_TILE_CACHE_DIRECTORY)
+    except FileNotFoundError:
+        abort(404)
+
+    return http_cache.send_bytes_cached(tile, "application/vnd.mapbox-vector-tile", cache_policies["ml_result_tiles"])
 
 @server.route("/app/WEB/assets/<path:filename>.css")
 def serve_css(filename):
     """Serve CSS files from the assets directory"""
     
-    if DEBUG_STATUS: print(f"CSS file requested: {filename}")
+    log.debug("CSS file requested: %s", filename)
     
-    return send_from_directory("assets", filename)
+    return http_cache.send_file_cached("assets", f"{filename}.css", cache_policies["css"])
+
+@server.route("/app/WEB/metrics")
+def serve_metrics():
+    """Serve request metrics in the Prometheus text format"""
 
-imagery_metadata = gpd.read_file(sites_metadata)
-# do not convert datetime into datetime objects; retain as strings. avoids hanlding timestamps
-imagery_metadata["DATETIME"] = imagery_metadata["DATETIME"].astype(str)
-imagery_metadata.columns = imagery_metadata.columns.str.lower()
-# convert "webmap_centre" from string to list
-imagery_metadata["webmap_center"] = imagery_metadata["webmap_center"].apply(ast.literal_eval)
+    return metrics.prometheus_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
-# provide data in dict format that is compatible with dash_leaflet
-geojson_bboxes = imagery_metadata.__geo_interface__
-print(f"Imagery metadata: {imagery_metadata}")
+@server.route("/app/WEB/imagery_bboxes.geojson")
+def serve_imagery_bboxes():
+    """Serve imagery bounding boxes intersecting the map view
 
-# generate df for dash_table; gdf not compatible with dash_table
-imagery_metadata_dashtable = imagery_metadata.drop(columns=["geometry", "geotiff_path", "tilemaps_path", "webmap_center", "webmap_zoom", "crs", "notes"])
-imagery_metadata_dashtable.columns = imagery_metadata_dashtable.columns.str.title()
+    Query parameters are `bbox=west,south,east,north` and `zoom`; geometries
+    are simplified for the zoom level.
+    """
+
+    try:
+        west, south, east, north = (float(value) for value in request.args["bbox"].split(","))
+        zoom = int(float(request.args.get("zoom", 0)))
+    except (KeyError, ValueError):
+        abort(400, description="Expected bbox=west,south,east,north and a numeric zoom")
+
+    log.debug("Imagery bboxes requested: %s, %s, %s, %s at zoom %s", west, south, east, north, zoom)
+
+    site_catalog = catalog_watcher.current
+    policy = cache_policies["imagery_bboxes"]
+
+    # same catalog and view => same body; answer revalidations without querying the index
+    etag = http_cache.content_etag(site_catalog.version, west, south, east, north, zoom)
+    response = http_cache.not_modified(etag, policy)
+    if response is not None:
+        return response
+
+    return http_cache.send_bytes_cached(site_catalog.bboxes_in_view(west, south, east, north, zoom), "application/json", policy, etag=etag)
+
+@server.route("/app/WEB/imagery_metadata.csv")
+def serve_imagery_metadata_csv():
+    """Stream the data page table as CSV
+
+    Takes the table's `filter_query` and `sort_by` (JSON) as query
+    parameters; rows are written in chunks so large catalogs are never
+    held in memory as one string.
+    """
+
+    try:
+        sort_by = json.loads(request.args.get("sort_by") or "[]")
+        if not isinstance(sort_by, list) or not all(isinstance(sort, dict) for sort in sort_by):
+            raise ValueError(sort_by)
+    except ValueError:
+        abort(400, description="Expected sort_by as a JSON list of {column_id, direction}")
+
+    table = catalog_watcher.current.table
+    return Response(table.iter_csv(request.args.get("filter_query"), sort_by), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=imagery_metadata.csv"})
+
+def _query_datetime(value, end=False):
+    """numpy datetime64 of an ISO date or datetime; a date-only `end` covers the whole day"""
+
+    if not value:
+        return None
+    parsed = np.datetime64(datetime.fromisoformat(value).replace(tzinfo=None), "s")
+    return parsed + np.timedelta64(1, "D") - np.timedelta64(1, "s") if end and len(value) == 10 else parsed
+
+def _query_geometry(query):
+    """Shapely geometry of a query's `bbox`, `point` or GeoJSON `geometry`, or None"""
+
+    if query.get("bbox") is not None:
+        bbox = query["bbox"]
+        west, south, east, north = (float(value) for value in (bbox.split(",") if isinstance(bbox, str) else bbox))
+        return shapely.box(west, south, east, north)
+    if query.get("point") is not None:
+        point = query["point"]
+        lng, lat = (float(value) for value in (point.split(",") if isinstance(point, str) else point))
+        return shapely.Point(lng, lat)
+    if query.get("geometry") is not None:
+        geometry = query["geometry"]
+        return shapely.from_geojson(geometry if isinstance(geometry, str) else json.dumps(geometry))
+    return None
+
+@server.route("/app/WEB/scenes.json", methods=["GET", "POST"])
+def serve_scenes():
+    """Serve the scenes matching a spatial and temporal query, a page at a time
+
+    Parameters (query string, or a JSON body when POSTed): one of
+    `bbox=west,south,east,north`, `point=lng,lat` or `geometry` (GeoJSON),
+    `start` and `end` (ISO dates or datetimes, inclusive), `algorithm`,
+    `sitename`, `offset` and `limit`. Scenes come ordered by datetime.
+    """
+
+    query = (request.get_json(silent=True) or {}) if request.method == "POST" else request.args.to_dict()
+    if not isinstance(query, dict):
+        abort(400, description="Expected the query as a JSON object")
+    try:
+        geometry = _query_geometry(query)
+        start, end = _query_datetime(query.get("start")), _query_datetime(query.get("end"), end=True)
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", catalog.QUERY_DEFAULT_LIMIT))
+        if offset < 0 or not 0 < limit <= catalog.QUERY_MAX_LIMIT:
+            raise ValueError(offset, limit)
+    except (TypeError, ValueError, shapely.errors.GEOSException):
+        abort(400, description=f"Expected bbox, point or a GeoJSON geometry, ISO start/end, offset >= 0 and 0 < limit <= {catalog.QUERY_MAX_LIMIT}")
+
+    site_catalog = catalog_watcher.current
+    policy = cache_policies["scenes"]
+
+    etag = http_cache.content_etag(site_catalog.version, geometry.wkb if geometry is not None else b"", start, end,
+                                   query.get("algorithm"), query.get("sitename"), offset, limit)
+    response = http_cache.not_modified(etag, policy)
+    if response is not None:
+        return response
+
+    scenes = site_catalog.query_scenes(geometry, start, end, query.get("algorithm"), query.get("sitename"), offset, limit)
+    return http_cache.send_bytes_cached(scenes, "application/json", policy, etag=etag)
+
+def ml_job_status(job):
+    """Public fields of an ML job; params and script output stay on the server"""
+
+    status = {name: job[name] for name in ("id", "kind", "state", "priority", "submitted_at", "started_at", "finished_at")}
+    status["progress"] = {"done": job["progress_done"], "total": job["progress_total"]}
+    if job["state"] == job_queue.QUEUED:
+        status["jobs_ahead"] = ml_job_queue.queue_position(job)
+    if job["result"]:
+        status["returncode"] = job["result"]["returncode"]
+        status["error"] = job["result"]["stderr"] if job["result"]["returncode"] > 0 else None
+    return status
+
+@server.route("/app/WEB/ml_jobs.json")
+def serve_ml_jobs():
+    """Serve the most recent ML jobs, of one browser session with `user=<session id>`"""
+
+    return {"jobs": [ml_job_status(job) for job in ml_job_queue.jobs(user=request.args.get("user"))]}
+
+@server.route("/app/WEB/ml_jobs/<job_id>.json")
+def serve_ml_job(job_id):
+    """Serve the state and progress of one ML job"""
+
+    job = ml_job_queue.get(job_id)
+    if job is None:
+        abort(404)
+
+    return ml_job_status(job)
+
+
+def start_ml_job_scheduler(pool):
+    """Run queued ML jobs on `pool` within the CPU and memory budget; called in the ML pool server"""
+
+    def run_change_detection_job(params, progress, cancelled):
+        # an identical run may have finished while this one was queued
+        if result_cache.get(params["result_key"]):
+            return {"returncode": 0, "stdout": "", "stderr": ""}
+
+        options = {"window_size": params["window_size"], "overlap": params["overlap"],
+                   "progress": lambda done, total, eta_seconds: progress(done, total),
+                   "cancelled": cancelled, "max_workers": params["workers"], "verbose": True}
+        output = os.path.join(ML_RESULTS_DIRECTORY, params["filename"])
+        scenes = params["scenes"]
+        if len(scenes) == 2:
+            run = tiled_change_detection.run(pool, params["script"], params["model"], *scenes, output, **options)
+        else:
+            # a time series: each scene is cut once per window and shared by its pairs
+            run = tiled_change_detection.run_series(pool, params["script"], params["model"], scenes, params["dates"], output, **options)
+        if run["returncode"] == 0:
+            # summarised now rather than by the first zoomed out view of the result
+            ml_result_summaries.build(output)
+            result_cache.put(params["result_key"], params["filename"])
+        return run
+
+    def run_object_detection_job(params, progress, cancelled):
+        if result_cache.get(params["result_key"]):
+            return {"returncode": 0, "stdout": "", "stderr": ""}
+
+        # one worker; its onnxruntime session batches tiles over the worker's cores
+        output = os.path.join(ML_RESULTS_DIRECTORY, params["filename"])
+        pool_job_id = pool.submit("object_detection", {"model": params["model"], "scene": params["scene"],
+                                                       "output": output, "verbose": True})
+        while (run := pool.wait(pool_job_id, ML_JOB_POLL_SECONDS)) is None:
+            if cancelled():
+                pool.cancel(pool_job_id)
+                run = pool.wait(pool_job_id)
+                break
+            if job_progress := pool.progress(pool_job_id):
+                progress(*job_progress)
+
+        if run["returncode"] == 0:
+            ml_result_summaries.build(output)
+            result_cache.put(params["result_key"], params["filename"])
+        return run
+
+    def run_tile_pyramids_job(params, progress, cancelled):
+        summary = tile_pyramids.update_pyramids(sites_metadata, ASSETS_DIRECTORY, params["processes"], params["format"],
+                                                quantize_bits=params["quantize_bits"], progress=progress, cancelled=cancelled)
+        return {"returncode": 1 if summary["failed_scenes"] else 0, "stdout": json.dumps(summary),
+                "stderr": f"failed scenes: {', '.join(summary['failed_scenes'])}" if summary["failed_scenes"] else ""}
+
+    def submit_tile_pyramids_periodically():
+        while True:
+            # keyed, so a run still queued or running is not queued twice
+            ml_job_queue.submit("tile_pyramids", {"processes": TILE_PYRAMID_PROCESSES, "format": TILE_PYRAMID_FORMAT,
+                                                  "quantize_bits": TILE_PYRAMID_QUANTIZE_BITS},
+                                key="tile_pyramids", priority=job_queue.PRIORITY_BACKGROUND,
+                                # capped at the budget, or it would never be claimed
+                                cpus=min(TILE_PYRAMID_PROCESSES, pool.size()),
+                                memory_mb=TILE_PYRAMID_PROCESSES * tile_pyramids.WORKER_MEMORY_MB)
+            time.sleep(TILE_PYRAMID_INTERVAL_SECONDS)
+
+    # a job's cpus are the pool workers (or, for tile pyramids, the processes) it keeps busy
+    job_queue.Scheduler(ml_job_queue, {"change_detection": run_change_detection_job, "object_detection": run_object_detection_job,
+                                       "tile_pyramids": run_tile_pyramids_job},
+                        cpu_budget=pool.size(), memory_budget_mb=ML_JOB_MEMORY_BUDGET_MB).start()
+    if TILE_PYRAMID_INTERVAL_SECONDS > 0:
+        threading.Thread(target=submit_tile_pyramids_periodically, name="tile-pyramids-submitter", daemon=True).start()
+
+# warm ML inference workers shared by every server process; started before any threads (it forks)
+ML_POOL_ADDRESS = os.environ.get("ML_POOL_ADDRESS", "/tmp/web-map-ml-pool.sock")
+ML_POOL_AUTHKEY = os.environ.get("ML_POOL_AUTHKEY", "web-map-ml-pool").encode()
+ML_POOL_PROCESSES, ML_POOL_THREADS = ml_workers.pool_size(int(os.environ.get("ML_WORKER_PROCESSES", "0")),
+                                                          int(os.environ.get("ML_WORKER_THREADS", "0")))
+ml_workers.ensure_pool_server(ML_POOL_ADDRESS, ML_POOL_AUTHKEY, ML_POOL_PROCESSES, ML_POOL_THREADS,
+                              initializer=start_ml_job_scheduler)
+
+# parsed sites.geojson and its indexes; reloaded in the background when the file changes
+# parsed catalogs are snapshotted to GeoParquet on /fs so restarts skip reparsing an unchanged file
+catalog_watcher = CatalogWatcher(sites_metadata,
+                                 poll_seconds=int(os.environ.get("SITES_METADATA_POLL_SECONDS", "30")),
+                                 snapshot_directory=os.environ.get("CATALOG_SNAPSHOT_DIRECTORY", "/fs/catalog_snapshots"))
+catalog_watcher.load()
+catalog_watcher.start()
 
 # ==========
 
 initial_map_center_mapload = [59.4604, -104.45483]
-available_algorithms = imagery_metadata["algorithm"].unique()
+IMAGERY_BBOX_OVERLAY_NAME = "Imagery Bounding Boxes"
 
 # == home page content ==
 home_page_content_introduction = dcc.Markdown("""
@@ -131,16 +560,19 @@ Nullam nisi sapien, gravida eu mauris sed, mollis condimentum neque. Proin turpi
 # =====
 
 # == landing page ==
-home_page = dbc.Container([
-    html.Div([
-    home_page_content_introduction,
-    html.Br(), html.Br(),
-    home_page_content_high_res_detection,
-    html.Br(), html.Br(),
-    home_page_content_coastal_scanning,
-    html.Br(), html.Br(),
-], style={'textAlign': 'left', 'padding': '50px'})
-], fluid=False)
+def home_page():
+    """Landing page layout"""
+
+    return dbc.Container([
+        html.Div([
+        home_page_content_introduction,
+        html.Br(), html.Br(),
+        home_page_content_high_res_detection,
+        html.Br(), html.Br(),
+        home_page_content_coastal_scanning,
+        html.Br(), html.Br(),
+    ], style={'textAlign': 'left', 'padding': '50px'})
+    ], fluid=False)
 
 # =====
 
@@ -149,6 +581,9 @@ ml_algorithm_initiation = html.Div(
     [   
         html.Div([html.P(id="id-start-ml-algorithm", children=["Button not clicked"])]),
         dbc.Button("Execute ML algorithm", id="id-run-selected-algorithm", n_clicks=0, disabled=False),
+        dbc.Button("Cancel", id="id-cancel-ml-algorithm", n_clicks=0, disabled=True, color="secondary", className="ms-2"),
+        dbc.Progress(id="id-ml-algorithm-progress", value=0, className="mt-2"),
+        html.Div(id="id-ml-job-status", className="mt-2"),
     ]
 )
 
@@ -221,123 +656,174 @@ help_page_content = dcc.Markdown("""
 
 """)   
 
-help_page = dbc.Container([
-    html.Div([
-    help_page_content,
-    html.Br(), html.Br(),
-], style={'textAlign': 'left', 'padding': '50px'})
-], fluid=False)
+def help_page():
+    """Help page layout"""
+
+    return dbc.Container([
+        html.Div([
+        help_page_content,
+        html.Br(), html.Br(),
+    ], style={'textAlign': 'left', 'padding': '50px'})
+    ], fluid=False)
 
 
 # == Map page ==
-map_page = dbc.Container([
-    sidebar_page,
-    dbc.Row(html.Br()),
-
-    dbc.Row([
-            dcc.Dropdown(
-                id="id-algorithm-dropdown",
-                clearable=False,
-                options=[{"label": algorithm, "value": algorithm} for algorithm in available_algorithms],
-                placeholder="Select an algorithm to begin...."
-            ),
-            dcc.Dropdown(
-                id="id-location-dropdown",
-                clearable=False,
-                placeholder="Select a site location..."),
-
- ]),
-
-    dbc.Row(
-        [dbc.Col(dcc.Dropdown(
-                id="id-change-selection-startdate",
-                clearable=True,
-                placeholder="Select start date for algorithm")),
+def map_page():
+    """Map page layout built from the current site catalog"""
+
+    site_catalog = catalog_watcher.current
+
+    return dbc.Container([
+        sidebar_page,
+        dbc.Row(html.Br()),
+
+        dbc.Row([
+                dcc.Dropdown(
+                    id="id-algorithm-dropdown",
+                    clearable=False,
+                    options=[{"label": algorithm, "value": algorithm} for algorithm in site_catalog.algorithms],
+                    placeholder="Select an algorithm to begin...."
+                ),
+                dcc.Dropdown(
+                    id="id-location-dropdown",
+                    clearable=False,
+                    placeholder="Select a site location..."),
+
+     ]),
+
+        dbc.Row(
+            [dbc.Col(dcc.Dropdown(
+                    id="id-change-selection-startdate",
+                    clearable=True,
+                    placeholder="Select start date for algorithm")),
         
-        dbc.Col(dcc.Dropdown(
-                id="id-change-selection-enddate",
-                clearable=True,
-                placeholder="Select end date for algorithm"))
+            dbc.Col(dcc.Dropdown(
+                    id="id-change-selection-enddate",
+                    clearable=True,
+                    placeholder="Select end date for algorithm"))
 
-        ], id="id-row-algorithm-dropdown-for-date-selection"),
+            ], id="id-row-algorithm-dropdown-for-date-selection"),
     
-    dbc.Row([
-        dbc.Col(ml_algorithm_initiation),
-        dbc.Col(dcc.Dropdown(id="id-datetime-for-imagery_tilemap", clearable=False, placeholder="Select date for imagery tilemap")),
-            ]),
-
-    # == web map
-    dbc.Row(dl.Map(center=initial_map_center_mapload, zoom=4, 
-                   children=[
-            # Group tilemaps and overlays into single control present on the map
-            dl.LayersControl(
-                position="topright", 
-                id="id-map-layers-control",
-                collapsed=False,
-                children=[
-                    # Default base map with OSM tiles
-                    dl.BaseLayer(
-                        dl.TileLayer(url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png", attribution="(C) OpenStreetMap contributors"),
-                        name="Open Street Map",
-                        # Visible by default
-                        checked=True
-                    ),
-                    # ESRI World Imagery tiles for user to select
-                    dl.BaseLayer(
-                        dl.TileLayer(url="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}.png", attribution="Tiles (C) Esri -- Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community"),
-                        name="ESRI World Imagery",
-                        # Visible by default
-                        checked=False
-                    ),
+        dbc.Row([
+            dbc.Col(ml_algorithm_initiation),
+            dbc.Col(dcc.Dropdown(id="id-datetime-for-imagery_tilemap", clearable=False, placeholder="Select date for imagery tilemap")),
+                ]),
+
+        # == web map
+        dbc.Row(dl.Map(center=initial_map_center_mapload, zoom=4, 
+                       children=[
+                # Group tilemaps and overlays into single control present on the map
+                dl.LayersControl(
+                    position="topright", 
+                    id="id-map-layers-control",
+                    collapsed=False,
+                    children=[
+                        # Default base map with OSM tiles
+                        dl.BaseLayer(
+                            dl.TileLayer(url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png", attribution="(C) OpenStreetMap contributors"),
+                            name="Open Street Map",
+                            # Visible by default
+                            checked=True
+                        ),
+                        # ESRI World Imagery tiles for user to select
+                        dl.BaseLayer(
+                            dl.TileLayer(url="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}.png", attribution="Tiles (C) Esri -- Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community"),
+                            name="ESRI World Imagery",
+                            # Visible by default
+                            checked=False
+                        ),
                     
-                    # Generated imagery tilemaps
-                    dl.Overlay(
-                        dl.TileLayer(id="id-satellite-tilemap-layer"),
-                        name="Show Satellite Imagery Tiles",
-                        checked=True),
+                        # Generated imagery tilemaps
+                        dl.Overlay(
+                            dl.TileLayer(id="id-satellite-tilemap-layer"),
+                            name="Show Satellite Imagery Tiles",
+                            checked=True),
                     
-                    # ML model results
-                    dl.Overlay(
-                        dl.GeoJSON(id="id-ml-model-results-polygons"),
-                        name="Show ML Model Results",
-                        checked=True),
-
-                    # Imagery bboxes
-                    dl.Overlay(
-                        dl.GeoJSON(data=geojson_bboxes, id="id-imagery-bbox-polygons",
-                            zoomToBounds=False,
-                            zoomToBoundsOnClick=True,
-                            hoverStyle=arrow_function(dict(weight=5, color="#666", dashArray=""))),
-                        name="Imagery Bounding Boxes",
-                        checked=False),
+                        # ML model results
+                        dl.Overlay(
+                            dl.GeoJSON(id="id-ml-model-results-polygons"),
+                            name="Show ML Model Results",
+                            checked=True),
+
+                        # Imagery bboxes; only those in view are fetched, see set_url_imagery_bboxes_in_view()
+                        dl.Overlay(
+                            dl.GeoJSON(id="id-imagery-bbox-polygons",
+                                zoomToBounds=False,
+                                zoomToBoundsOnClick=True,
+                                hoverStyle=arrow_function(dict(weight=5, color="#666", dashArray=""))),
+                            name=IMAGERY_BBOX_OVERLAY_NAME,
+                            checked=False),
                                                 
-                            ]
-                        )
+                                ]
+                            )
                                     
-                        ], id="id-web-map", style={"height": "75vh"})),
+                            ], id="id-web-map", style={"height": "75vh"})),
     
     
-], fluid=False)
+    ], fluid=False)
 
 # == data page ==
+# rows per page of the data page table
+DATA_TABLE_PAGE_SIZE = 50
+
 data_page_content = dcc.Markdown("""
 ## Data
                                  
 Add content and descriptions here.......
 """)
 
-data_page = dbc.Container([
-    html.Div([
-    data_page_content,
-    html.Br(), html.Br(),
-    dbc.Row([
-    dash_table.DataTable(imagery_metadata_dashtable.to_dict("records"),              
-                             id="id-imagery-metadata-table", fixed_rows={"headers": True}, #style_table={"height": "200px", "overflowY": "auto"},
-                             style_cell={"textAlign": "left"}),
-    ]),
+def data_page():
+    """Data page layout built from the current site catalog
 
-], style={'textAlign': 'left', 'padding': '50px'})
-], fluid=False)
+    Rows are paged, filtered and sorted on the server by `update_data_table`,
+    so the layout carries no data.
+    """
+
+    site_catalog = catalog_watcher.current
+
+    return dbc.Container([
+        html.Div([
+        data_page_content,
+        html.Br(), html.Br(),
+        dbc.Row([
+        dash_table.DataTable(id="id-imagery-metadata-table",
+                                 columns=site_catalog.table.datatable_columns(),
+                                 page_current=0, page_size=DATA_TABLE_PAGE_SIZE, page_action="custom",
+                                 filter_action="custom", filter_query="",
+                                 sort_action="custom", sort_mode="multi", sort_by=[],
+                                 fixed_rows={"headers": True}, #style_table={"height": "200px", "overflowY": "auto"},
+                                 style_cell={"textAlign": "left"}),
+        ]),
+        html.Br(),
+        html.A([html.I(className="bi bi-download"), " Download CSV"], id="id-imagery-metadata-csv",
+               href="/app/WEB/imagery_metadata.csv", download="imagery_metadata.csv"),
+
+    ], style={'textAlign': 'left', 'padding': '50px'})
+    ], fluid=False)
+
+@callback(
+    Output("id-imagery-metadata-table", "data"),
+    Output("id-imagery-metadata-table", "page_count"),
+    Input("id-imagery-metadata-table", "page_current"),
+    Input("id-imagery-metadata-table", "page_size"),
+    Input("id-imagery-metadata-table", "filter_query"),
+    Input("id-imagery-metadata-table", "sort_by"),
+)
+def update_data_table(page_current, page_size, filter_query, sort_by):
+    """One page of the filtered and sorted imagery metadata"""
+
+    return catalog_watcher.current.table.page(page_current or 0, page_size or DATA_TABLE_PAGE_SIZE, filter_query, sort_by)
+
+@callback(
+    Output("id-imagery-metadata-csv", "href"),
+    Input("id-imagery-metadata-table", "filter_query"),
+    Input("id-imagery-metadata-table", "sort_by"),
+    prevent_initial_call=True
+)
+def set_url_imagery_metadata_csv(filter_query, sort_by):
+    """Export the rows the table currently shows, in its order"""
+
+    return "/app/WEB/imagery_metadata.csv?" + urlencode({"filter_query": filter_query or "", "sort_by": json.dumps(sort_by or [])})
 
 
 # =====
@@ -345,24 +831,54 @@ app.layout = html.Div([
     html.Link(rel="stylesheet",
               href="/app/WEB/assets/style.css"),
     dcc.Location(id='url', refresh=False),
+    dcc.Store(id="id-session", storage_type="session"),
+    # url of the ML result shown on the map, without the view; see set_url_ml_results_in_view
+    dcc.Store(id="id-ml-results-url"),
     sidebar_page,
     html.Div(id='page-content')
 ])
 
 # == handle which page to route too
+# pathname -> layout factory; pages are only built when first visited
+pages = {
+    "/map": map_page,
+    "/home": home_page,
+    "/help": help_page,
+    "/data": data_page,
+}
+# (pathname, catalog version) -> layout serialized to plain JSON
+page_layouts = {}
+# gunicorn's gthread workers serve requests from several threads at once
+page_layouts_lock = threading.Lock()
+
+def page_layout(pathname):
+    """Serialized layout of a page, built once per catalog version
+
+    Navigation returns the cached JSON instead of rebuilding and
+    serializing the component tree. Page data (imagery bboxes, table rows)
+    is not part of any layout; it is fetched by its own callbacks once the
+    page is shown.
+    """
+
+    version = catalog_watcher.current.version
+    layout = page_layouts.get((pathname, version))
+    if layout is None:
+        layout = json.loads(to_json_plotly(pages[pathname]()))
+        with page_layouts_lock:
+            # layouts of a replaced catalog are never served again
+            for key in [key for key in page_layouts if key[1] != version]:
+                page_layouts.pop(key, None)
+            page_layouts[(pathname, version)] = layout
+
+    return layout
+
 @callback(
     Output('page-content', 'children'),
     [Input('url', 'pathname')]
 )
 def display_page(pathname):
-    if pathname == '/map':
-        return map_page
-    elif pathname == '/home':
-        return home_page
-    elif pathname == '/help':
-        return help_page
-    elif pathname == '/data':
-        return data_page
+    if pathname in pages:
+        return page_layout(pathname)
     else:
         return no_update
 
@@ -374,14 +890,13 @@ def display_page(pathname):
     prevent_initial_call=True
 )
 def get_id_of_imagery_bbox_selected(feature, n_clicks):
-    print(feature)
     if feature is not None:
         polygon_id = feature["id"]
         
-        if DEBUG_STATUS: print(f"Feature clicked: {polygon_id}")
+        log.debug("Feature clicked: %s", polygon_id)
         return polygon_id
     else:
-        if DEBUG_STATUS: print("No feature clicked")
+        log.debug("No feature clicked")
         return "Selected Polygon ID: None"
 
 # == show hover tip data when user hovers over a geojson bbox
@@ -396,6 +911,62 @@ def display_bbox_hover_data(feature):
     else:
         return []
 
+# == fetch imagery bboxes for the current map view when the overlay is shown
+@callback(
+    Output("id-imagery-bbox-polygons", "url"),
+    Input("id-web-map", "bounds"),
+    Input("id-web-map", "zoom"),
+    Input("id-map-layers-control", "overlays"),
+    prevent_initial_call=True
+)
+def set_url_imagery_bboxes_in_view(bounds, zoom, overlays):
+    """Point the bbox layer at the viewport-filtered endpoint
+
+    `bounds` is [[south, west], [north, east]] as reported by dash_leaflet on moveend
+    """
+
+    if not bounds or IMAGERY_BBOX_OVERLAY_NAME not in (overlays or []):
+        return no_update
+
+    (south, west), (north, east) = bounds
+
+    return f"/app/WEB/imagery_bboxes.geojson?bbox={west:.5f},{south:.5f},{east:.5f},{north:.5f}&zoom={round(zoom or 0)}"
+
+def ml_results_view_bbox(bounds):
+    """Map bounds widened and snapped outward to a grid a quarter of the view's size
+
+    Small pans and zooms stay inside the same bbox, so they don't change the
+    layer's url and refetch the features already shown.
+    """
+
+    (south, west), (north, east) = bounds
+    step = 2.0 ** np.ceil(np.log2(max(east - west, north - south, 1e-6))) / 4
+    return (max(np.floor(west / step) * step - step, -180.0), max(np.floor(south / step) * step - step, -90.0),
+            min(np.ceil(east / step) * step + step, 180.0), min(np.ceil(north / step) * step + step, 90.0))
+
+# == stream only the ML result features around the map view, summarised when zoomed out
+@callback(
+    Output("id-ml-model-results-polygons", "url"),
+    Input("id-ml-results-url", "data"),
+    Input("id-web-map", "bounds"),
+    Input("id-web-map", "zoom"),
+)
+def set_url_ml_results_in_view(ml_results_url, bounds, zoom):
+    """Point the results layer at the bbox-filtered stream of the result file
+
+    Below ml_result_summaries.RAW_MIN_ZOOM a crowded view is served as grid
+    cells with feature counts rather than every polygon.
+    """
+
+    if not ml_results_url:
+        return no_update
+    if not bounds:
+        return ml_results_url
+
+    bbox = ",".join(f"{value:.5f}" for value in ml_results_view_bbox(bounds))
+    # zooms from RAW_MIN_ZOOM on all get the same features; keep their url the same
+    return f"{ml_results_url}?bbox={bbox}&zoom={min(round(zoom or 0), ml_result_summaries.RAW_MIN_ZOOM)}"
+
 # == Select site location dropdown
 @callback(
     Output("id-location-dropdown", "options"),
@@ -404,12 +975,12 @@ def display_bbox_hover_data(feature):
     prevent_initial_call=True
 )
 def update_site_locations_dropdown(selected_algorithm):
+    site_catalog = catalog_watcher.current
+
     if selected_algorithm:    
-        sites = imagery_metadata[imagery_metadata["algorithm"] == selected_algorithm]["sitename"].unique()
-        
-        site_options = [{'label': site, 'value': site} for site in sites]
+        site_options = site_catalog.site_options(selected_algorithm)
 
-        if DEBUG_STATUS: print(f"Site options: {site_options}")
+        log.debug("Site options: %s", site_options)
         
         # None will forces the user to select a site location
         return site_options, None
@@ -437,164 +1008,291 @@ def set_imagery_dates_available_change_detection(selected_algorithm, selected_lo
 
     `value` is the UUID of the image
     """
+
+    site_catalog = catalog_watcher.current
     
-    if DEBUG_STATUS: print(f"INFO -- Entered set_imagery_dates_available_change_detection(): {selected_algorithm}, {selected_location}")
+    log.debug("Entered set_imagery_dates_available_change_detection(): %s, %s", selected_algorithm, selected_location)
 
     if selected_algorithm == "Change" and selected_location: 
-        site_metadata = imagery_metadata[
-            (imagery_metadata["sitename"] == selected_location) & 
-            (imagery_metadata["algorithm"] == selected_algorithm)
-        ]
-        
-        if DEBUG_STATUS: print(f"Imagery metadata found -- {type(site_metadata)}")
+        drop_drown_label_values = site_catalog.date_options(selected_algorithm, selected_location)
 
-        imagery_dates = site_metadata["datetime"].astype(str).tolist()
-        imagery_uuids = site_metadata["uuid"].tolist()
+        log.debug("Leaving set_imagery_dates_available_change_detection(): updated 'change detection' returned %s", drop_drown_label_values)
 
-        print(f"Imagery dates: {type(imagery_dates)}")
-        print(f"Imagery uuids: {type(imagery_uuids)}")
+        return drop_drown_label_values, None, True, drop_drown_label_values, None, True, drop_drown_label_values, None
 
-        results = zip(imagery_uuids, imagery_dates)
-        drop_drown_label_values = [{"label": date, "value": uuid} for uuid, date in results]
+    if selected_algorithm == "Detection" and selected_location:
+        drop_drown_label_values = site_catalog.date_options(selected_algorithm, selected_location)
 
-        if DEBUG_STATUS: print(f"INFO -- Leaving set_imagery_dates_available_change_detection(): updated 'change detection' returned {drop_drown_label_values}")
+        log.debug("Leaving set_imagery_dates_available_change_detection(): updated 'change detection' returned %s", drop_drown_label_values)
 
-        return drop_drown_label_values, None, True, drop_drown_label_values, None, True, drop_drown_label_values, None
+        return drop_drown_label_values, None, True, drop_drown_label_values, None, False, no_update, None
 
-    if selected_algorithm == "Detection" and selected_location:
-        site_metadata = imagery_metadata[
-            (imagery_metadata["sitename"] == selected_location) & 
-            (imagery_metadata["algorithm"] == selected_algorithm)
-        ]
-        
-        if DEBUG_STATUS: print(f"Imagery metadata found -- {type(site_metadata)}")
 
-        imagery_dates = site_metadata["datetime"].astype(str).tolist()
-        imagery_uuids = site_metadata["uuid"].tolist()
+    else:
+        return no_update, None, False, no_update, None, False, no_update, None
+
 
-        print(f"Imagery dates: {type(imagery_dates)}")
-        print(f"Imagery uuids: {type(imagery_uuids)}")
+# == Give each browser session an id, used to allow one ML job per session
+@callback(
+        Output("id-session", "data"),
+        Input("url", "pathname"),
+        State("id-session", "data"),
+)
+def set_session_id(pathname, session_id):
+    """Create the session id on the first page load of a browser session"""
 
-        results = zip(imagery_uuids, imagery_dates)
-        drop_drown_label_values = [{"label": date, "value": uuid} for uuid, date in results]
+    return session_id or uuid.uuid4().hex
 
-        if DEBUG_STATUS: print(f"INFO -- Leaving set_imagery_dates_available_change_detection(): updated 'change detection' returned {drop_drown_label_values}")
 
-        return drop_drown_label_values, None, True, drop_drown_label_values, None, False, no_update, None
+def ml_progress(done, total, eta_seconds):
+    """Progress bar (value, label) for an ML run"""
 
+    if total <= 0:
+        return 0, ""
 
-    else:
-        return no_update, None, False, no_update, None, False, no_update, None
+    label = f"{done}/{total} windows"
+    if eta_seconds is not None and done < total:
+        label += f", about {int(eta_seconds // 60)}m {int(eta_seconds % 60)}s left"
+    return 100 * done / total, label
+
+
+def wait_for_ml_job(job_id, set_progress):
+    """Show a queued job's position, then its progress, until it finishes; returns its result"""
+
+    while True:
+        job = ml_job_queue.get(job_id)
+        if job["state"] == job_queue.QUEUED:
+            set_progress((0, f"Queued, {ml_job_queue.queue_position(job)} jobs ahead"))
+        elif job["progress_total"]:
+            done, total = job["progress_done"], job["progress_total"]
+            elapsed = time.time() - job["started_at"]
+            set_progress(ml_progress(done, total, elapsed / done * (total - done) if done else None))
+
+        if job["state"] not in job_queue.ACTIVE_STATES:
+            # jobs cancelled before they started have no result
+            return job["result"] or ml_workers.CANCELLED_RESULT
+        time.sleep(ML_JOB_POLL_SECONDS)
 
 
 # == Run ml execution via button press
 @app.long_callback(
-    Output("id-ml-model-results-polygons", "url"),
+    Output("id-ml-results-url", "data"),
     Output("id-start-ml-algorithm", "children"),
     Input("id-run-selected-algorithm", "n_clicks"),
     Input("id-algorithm-dropdown", "value"),
     Input("id-location-dropdown", "value"),
     Input("id-change-selection-startdate", "value"),
     Input("id-change-selection-enddate", "value"),
+    State("id-session", "data"),
+    progress=[Output("id-ml-algorithm-progress", "value"), Output("id-ml-algorithm-progress", "label")],
+    running=[
+        (Output("id-run-selected-algorithm", "disabled"), True, False),
+        (Output("id-cancel-ml-algorithm", "disabled"), False, True),
+    ],
+    cancel=[Input("id-cancel-ml-algorithm", "n_clicks")],
     manager=long_callback_manager
 )
-def start_ml_algorithm(run, selected_algorithm, selected_location, start_date_uuid, end_date_uuid):
+@instrumentation.timed(metrics, "long_callback:start_ml_algorithm")
+def start_ml_algorithm(set_progress, run, selected_algorithm, selected_location, start_date_uuid, end_date_uuid, session_id):
     """Enable button to call algorithm for selected location
     
     Passed 'value' is the uuid of the image
     
     """
 
-    print(f"INFO -- Entered start_ml_algorithm(): {run}, {selected_algorithm}, {selected_location}, {start_date_uuid}, {end_date_uuid}")
+    site_catalog = catalog_watcher.current
+
+    log.debug("Entered start_ml_algorithm(): %s, %s, %s, %s, %s", run, selected_algorithm, selected_location, start_date_uuid, end_date_uuid)
 
     # Check if the callback was triggered by clicking the run button
     if not run:
-        return "Waiting for input to run the algorithm."
+        return no_update, "Waiting for input to run the algorithm."
 
-    # Default values if inputs might be missing
-    start_date_uuid = start_date_uuid if start_date_uuid is not None else "Default Start Date"
-    end_date_uuid = end_date_uuid if end_date_uuid is not None else "Default End Date"
+    # dropdowns are multi-select; nothing selected is None
+    start_date_uuid = start_date_uuid or []
+    end_date_uuid = end_date_uuid or []
 
     # Ensure other critical inputs are provided
     if selected_algorithm is None or selected_location is None:
-        return "Please select an algorithm and location."
-
-    # Simulate a long-running task
-    # Here you would typically start your machine learning algorithm
-        
-    # TODO: Show a progress bar to user when algorithm is running --> see https://dash.plotly.com/long-callbacks
+        return no_update, "Please select an algorithm and location."
 
     if selected_algorithm == "Change":
-        if selected_location and start_date_uuid and end_date_uuid:
-            
-            if DEBUG_STATUS: print(f"INFO -- Running change detection algorithm for {selected_location} from {start_date_uuid} to {end_date_uuid}")
-
-            print(f"{imagery_metadata}")
-
-            # FIXME: Only allowing single date for before and after image
-            if len(start_date_uuid) == 1:
-                start_date_uuid = start_date_uuid[0]
-                before_image_metadata = imagery_metadata[imagery_metadata["uuid"] == start_date_uuid]
-                print(f"before_image_metadata: {before_image_metadata}")
-                before_image_path = os.path.join(ASSETS_DIRECTORY, before_image_metadata["geotiff_path"].tolist()[0])
-                print(f"before_image_path: {before_image_path}")
-            
-            if len(end_date_uuid) == 1:
-                end_date_uuid = end_date_uuid[0]
-                after_image_metadata = imagery_metadata[imagery_metadata["uuid"] == end_date_uuid]
-                print(f"after_image_metadata: {after_image_metadata}")
-                after_image_path = os.path.join(ASSETS_DIRECTORY, after_image_metadata["geotiff_path"].tolist()[0])
-                print(f"after_image_path: {after_image_path}")
-            
-            ml_model_path = os.path.join(ASSETS_DIRECTORY, ML_MODEL_PATH)
-            print(f"ml_model_path: {ml_model_path}")
-            
-            # FIXME: Prepend date ran to filename. Should a uuid be added? 
-            # QUESTION: Should metadata be injected into geojson file etc. dated used, location, algotithm etc.
-            ml_results_filename = f"{selected_algorithm}_{selected_location}_{start_date_uuid}_{end_date_uuid}"
-            
-            ml_results_path = os.path.join(ML_RESULTS_DIRECTORY, ml_results_filename + ".geojson")
-            print(f"ml_output_path: {ml_results_path}.geojson")
-
-            change_detection_script_path = os.path.join(ASSETS_DIRECTORY, CHANGE_DETECTION_SCRIPT)
-            print(f"change_detection_path script: {change_detection_script_path}")
-
-            run = subprocess.run(["python", change_detection_script_path, before_image_path, after_image_path, ml_model_path, ml_results_path, "--verbose"], capture_output=True,
-                                 text=True)
-
-            if run.returncode == 0:
-                # TODO: Show as banner on UI
-                print("ML algorithm completed successfully")
-                
-                # Return the path to the generated ML results
-                display_ml_results_url = f"/app/WEB/ml_results/{ml_results_filename}.geojson"
-
-                return display_ml_results_url, f"ML algorithm completed for {selected_algorithm} for location {selected_location}," f"from {start_date_uuid} to {end_date_uuid}. Loading output file {display_ml_results_url}"
-            
-            elif run.returncode >= 1:
-                # TODO: Show as banner on UI
-                print("ML algorithm failed")
-                print(f"Error: {run.stderr}")
-                return no_update, f"ML algorithm failed to run for location {selected_location}," f"from {start_date_uuid} to {end_date_uuid}. Error: {run.stderr}"
-    
+        # every date selected in either dropdown, compared with the next one in date order
+        scene_uuids = set(start_date_uuid) | set(end_date_uuid)
+        # a scene may have been removed by a catalog reload since the browser listed it
+        if any(site_catalog.scene(uuid) is None for uuid in scene_uuids):
+            return no_update, "A selected scene is no longer available. Please select the dates again."
+        scene_uuids = sorted(scene_uuids, key=lambda uuid: str(site_catalog.scene(uuid)["datetime"]))
+        if len(scene_uuids) < 2:
+            return no_update, "Please select at least two dates for change detection."
+
+        scene_dates = [str(site_catalog.scene(uuid)["datetime"]) for uuid in scene_uuids]
+        scene_paths = [os.path.join(ASSETS_DIRECTORY, site_catalog.scene(uuid)["geotiff_path"]) for uuid in scene_uuids]
+        log.debug("change detection scenes: %s", scene_paths)
+
+        log.debug("Running change detection algorithm for %s over %s", selected_location, scene_dates)
+
+        ml_model_path = os.path.join(ASSETS_DIRECTORY, ML_MODEL_PATH)
+        log.debug("ml_model_path: %s", ml_model_path)
+
+        change_detection_script_path = os.path.join(ASSETS_DIRECTORY, CHANGE_DETECTION_SCRIPT)
+        log.debug("change_detection_path script: %s", change_detection_script_path)
+
+        # identical runs (same scenes, model and script) are memoized; the key in the filename
+        # keeps results of different model or script versions from overwriting each other
+        result_key = result_cache.key(selected_algorithm, selected_location, scene_uuids,
+                                      ml_model_path, change_detection_script_path)
+
+        # QUESTION: Should metadata be injected into geojson file etc. dated used, location, algotithm etc.
+        if len(scene_uuids) == 2:
+            ml_results_filename = f"{selected_algorithm}_{selected_location}_{scene_uuids[0]}_{scene_uuids[1]}_{result_key[:12]}"
+        else:
+            ml_results_filename = f"{selected_algorithm}_{selected_location}_{scene_uuids[0]}_{scene_uuids[-1]}_{len(scene_uuids)}dates_{result_key[:12]}"
+        display_ml_results_url = f"/app/WEB/ml_results/{ml_results_filename}.geojson"
+        description = f"for location {selected_location}, from {scene_dates[0]} to {scene_dates[-1]} ({len(scene_uuids)} dates)"
+
+        # one job at a time per browser session, so repeated clicks don't queue more heavy jobs
+        with session_ml_job(session_id) as claimed:
+            if not claimed:
+                return no_update, "An ML algorithm is already running in this session. Wait for it to finish or cancel it."
+
+            if result_cache.get(result_key):
+                log.info("ML results reused from cache: %s", ml_results_filename)
+                return display_ml_results_url, f"ML results for {selected_algorithm} {description} already exist. Loading output file {display_ml_results_url}"
+
+            # queued for the scheduler, which runs it on warm pool workers in overlapping windows once it
+            # fits in the budget; identical requests queued under the same key share one job
+            workers, memory_mb = tiled_change_detection.estimate_cost(scene_paths[0], ML_POOL_PROCESSES,
+                                                                      CHANGE_DETECTION_WINDOW_SIZE, CHANGE_DETECTION_WINDOW_OVERLAP)
+            job_id = ml_job_queue.submit("change_detection", {
+                "script": change_detection_script_path, "model": ml_model_path,
+                "scenes": scene_paths, "dates": scene_dates,
+                "filename": ml_results_filename + ".geojson", "result_key": result_key, "workers": workers,
+                "window_size": CHANGE_DETECTION_WINDOW_SIZE, "overlap": CHANGE_DETECTION_WINDOW_OVERLAP,
+            }, user=session_id, key=result_key, cpus=workers, memory_mb=memory_mb * len(scene_uuids) / 2)
+            log.info("ML job queued: %s", job_id)
+            run = wait_for_ml_job(job_id, set_progress)
+
+        if run["returncode"] == 0:
+            # TODO: Show as banner on UI
+            log.info("ML algorithm completed successfully")
+
+            return display_ml_results_url, f"ML algorithm completed for {selected_algorithm} {description}. Loading output file {display_ml_results_url}"
+
+        elif run["returncode"] >= 1:
+            # TODO: Show as banner on UI
+            log.warning("ML algorithm failed: %s", run["stderr"])
+            return no_update, f"ML algorithm failed to run {description}. Error: {run['stderr']}"
+
+        else:
+            log.info("ML algorithm cancelled")
+            return no_update, f"ML algorithm cancelled {description}."
+
+    elif selected_algorithm == "Detection":
+        # object detection runs on the single date selected as the start date
+        if len(start_date_uuid) != 1:
+            return no_update, "Please select one date for object detection."
+
+        scene_uuid = start_date_uuid[0]
+        if site_catalog.scene(scene_uuid) is None:
+            return no_update, "The selected scene is no longer available. Please select the date again."
+        scene_path = os.path.join(ASSETS_DIRECTORY, site_catalog.scene(scene_uuid)["geotiff_path"])
+        detection_model_path = os.path.join(ASSETS_DIRECTORY, DETECTION_MODEL_PATH)
+
+        log.debug("Running object detection for %s on %s: %s", selected_location, scene_uuid, scene_path)
+
+        # object_detection.py is the "script" of a detection run, so a change to it invalidates memoized results
+        result_key = result_cache.key(selected_algorithm, selected_location, [scene_uuid],
+                                      detection_model_path, object_detection.__file__)
+        ml_results_filename = f"{selected_algorithm}_{selected_location}_{scene_uuid}_{result_key[:12]}"
+        display_ml_results_url = f"/app/WEB/ml_results/{ml_results_filename}.geojson"
+
+        with session_ml_job(session_id) as claimed:
+            if not claimed:
+                return no_update, "An ML algorithm is already running in this session. Wait for it to finish or cancel it."
+
+            if result_cache.get(result_key):
+                log.info("ML results reused from cache: %s", ml_results_filename)
+                return display_ml_results_url, f"Object detection results for location {selected_location} on {scene_uuid} already exist. Loading output file {display_ml_results_url}"
+
+            job_id = ml_job_queue.submit("object_detection", {
+                "model": detection_model_path, "scene": scene_path,
+                "filename": ml_results_filename + ".geojson", "result_key": result_key,
+            }, user=session_id, key=result_key)
+            log.info("ML job queued: %s", job_id)
+            run = wait_for_ml_job(job_id, set_progress)
+
+        if run["returncode"] == 0:
+            log.info("Object detection completed successfully")
+            return display_ml_results_url, f"Object detection completed for location {selected_location} on {scene_uuid}. Loading output file {display_ml_results_url}"
+
+        elif run["returncode"] >= 1:
+            log.warning("Object detection failed: %s", run["stderr"])
+            return no_update, f"Object detection failed to run for location {selected_location} on {scene_uuid}. Error: {run['stderr']}"
+
+        else:
+            log.info("Object detection cancelled")
+            return no_update, f"Object detection cancelled for location {selected_location} on {scene_uuid}."
+
     else:
-        # TODO: Implement detection
+        return no_update, f"Unknown algorithm {selected_algorithm}."
+
+
+# == Cancel the session's queued and running ML jobs; the long callback itself is cancelled by Dash
+@callback(
+        Output("id-ml-job-status", "children"),
+        Input("id-cancel-ml-algorithm", "n_clicks"),
+        State("id-session", "data"),
+        prevent_initial_call=True
+)
+def cancel_ml_jobs(n_clicks, session_id):
+    """Cancel the ML jobs of this browser session"""
+
+    cancelled = ml_job_queue.cancel(user=session_id)
+    log.debug("Cancelled %s ML jobs of session %s", cancelled, session_id)
+
+    return f"Cancelled {cancelled} ML jobs." if cancelled else ""
+
 
+def prefetch_scene_tiles(session_id, scene):
+    """Warm the tile cache with a scene's tiles around its site's view, in the background"""
 
-        # For demonstration, we'll just return a message
-        return (
-            f"Running {selected_algorithm} for location {selected_location},"
-            f"from {start_date_uuid} to {end_date_uuid}."
-        )
+    if tile_prefetcher is None or scene is None:
+        return
+    bounds = catalog_watcher.current.scene_bounds(scene["uuid"])
+    if bounds is None:
+        return
 
+    try:
+        (lat, lng), zoom = scene["webmap_center"], int(scene["webmap_zoom"])
+    except (TypeError, ValueError):
+        log.debug("Scene %s has no usable web map view; tiles not prefetched", scene["uuid"])
+        return
+
+    tile_prefetcher.prefetch(session_id, scene, bounds, (float(lng), float(lat)), zoom)
+
+def warm_site_ml_results(algorithms, location):
+    """Load the indexes and zoom summaries of a site's existing ML results, most recent first"""
+
+    prefixes = tuple(f"{algorithm}_{location}_" for algorithm in algorithms)
+    try:
+        entries = [entry for entry in os.scandir(ML_RESULTS_DIRECTORY) if entry.name.endswith(".geojson") and entry.name.startswith(prefixes)]
+    except FileNotFoundError:
+        # nothing has been run yet on a fresh deployment
+        return
+    # as many as stay loaded alongside the results already in use
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime, reverse=True)[:ml_result_files.MAX_LOADED_INDEXES // 2]:
+        ml_result_files.warm_index(entry.path)
+        ml_result_summaries.load(entry.path)
 
 # == Show single date maptiles for imagery
 @callback(
         Output("id-satellite-tilemap-layer", "url"),
         Input("id-datetime-for-imagery_tilemap", "value"),
+        State("id-session", "data"),
         prevent_initial_call=True
 )
-def set_url_tilemap_for_single_selected_datetime(selected_tile_uuid):
+def set_url_tilemap_for_single_selected_datetime(selected_tile_uuid, session_id):
     """Set tilemap url based on user selected datetime
     
     Single input datetime and single url output
@@ -602,10 +1300,18 @@ def set_url_tilemap_for_single_selected_datetime(selected_tile_uuid):
     Input is the tilemaps path
     """
 
-    if selected_tile_uuid:
-        image_metadata = imagery_metadata[imagery_metadata["uuid"] == selected_tile_uuid]
-        path = image_metadata["tilemaps_path"].tolist()[0]
-        if DEBUG_STATUS: print(f"set_url_tilemap_for_user_selected_datetime - selected tilemap url: {path}")
+    site_catalog = catalog_watcher.current
+
+    if selected_tile_uuid and site_catalog.scene(selected_tile_uuid):
+        # rendered from the scene's GeoTIFF, or its pre-rendered tilemaps_path pyramid when present
+        path = f"/app/WEB/scene_tiles/{selected_tile_uuid}/{{z}}/{{x}}/{{y}}.png"
+        tilemaps_path = site_catalog.scene(selected_tile_uuid).get("tilemaps_path")
+        if tilemaps_path:
+            # tiles are cached as immutable; a regenerated pyramid gets a new url
+            path += "?v=" + http_cache.content_etag(tilemaps_path)[:12]
+        log.debug("set_url_tilemap_for_user_selected_datetime - selected tilemap url: %s", path)
+
+        prefetch_scene_tiles(session_id, site_catalog.scene(selected_tile_uuid))
     
         return path
     else:
@@ -616,19 +1322,26 @@ def set_url_tilemap_for_single_selected_datetime(selected_tile_uuid):
         Output("id-web-map", "center"),
         Output("id-web-map", "zoom"),
         Input("id-location-dropdown", "value"),
+        State("id-session", "data"),
         prevent_initial_call=True
 )
-def zoom_map_to_site_location(selected_location):
+def zoom_map_to_site_location(selected_location, session_id):
+    site_catalog = catalog_watcher.current
         
-    if selected_location:
-        selected_location = imagery_metadata[imagery_metadata["sitename"] == selected_location]
-    
-        if DEBUG_STATUS: print(f"Selected location: {selected_location}")
+    # the site may have been removed by a catalog reload since the browser listed it
+    site_view = site_catalog.site_view(selected_location) if selected_location else None
 
-        coordinates = selected_location["webmap_center"].tolist()[0]
-        zoom_level = selected_location["webmap_zoom"].tolist()[0]
+    if site_view:
+        coordinates, zoom_level = site_view
+
+        # the imagery most likely to be opened next, and the site's results, warmed while the user picks a date
+        if tile_prefetcher is not None:
+            prefetch_scene_tiles(session_id, site_catalog.latest_scene(selected_location))
+            tile_prefetcher.submit(warm_site_ml_results, site_catalog.algorithms, selected_location)
+    
+        log.debug("Selected location: %s", selected_location)
 
-        if DEBUG_STATUS: print(f"returned: coordinates: {coordinates}, Zoom level: {zoom_level}")
+        log.debug("returned: coordinates: %s, Zoom level: %s", coordinates, zoom_level)
 
         return coordinates, zoom_level
     else:
@@ -636,6 +1349,7 @@ def zoom_map_to_site_location(selected_location):
 
 
 
+# Flask development server; production serves `server` with gunicorn, see wsgi.py
 if __name__ == "__main__":
     app.run_server(debug=DEBUG_STATUS, host='0.0.0.0', port=PORT)
 
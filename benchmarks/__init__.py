@@ -0,0 +1,4 @@
+"""Micro-benchmarks for the web map
+
+Run from the repository root, e.g. `python -m benchmarks.catalog_lookup`.
+"""
@@ -0,0 +1,61 @@
+"""Callback lookups: boolean-mask scans of imagery_metadata vs SiteCatalog
+
+    python -m benchmarks.catalog_lookup [--rows 1000 10000 100000]
+
+"""
+
+import argparse
+import timeit
+
+from catalog import SiteCatalog
+from benchmarks.synthetic import make_imagery_metadata
+
+
+def mask_lookups(imagery_metadata, algorithm, sitename, uuid):
+    """What the callbacks did before SiteCatalog"""
+
+    imagery_metadata[imagery_metadata["algorithm"] == algorithm]["sitename"].unique()
+
+    site_metadata = imagery_metadata[
+        (imagery_metadata["sitename"] == sitename) &
+        (imagery_metadata["algorithm"] == algorithm)
+    ]
+    [{"label": d, "value": u} for u, d in zip(site_metadata["uuid"].tolist(), site_metadata["datetime"].astype(str).tolist())]
+
+    imagery_metadata[imagery_metadata["uuid"] == uuid]["tilemaps_path"].tolist()[0]
+
+    site = imagery_metadata[imagery_metadata["sitename"] == sitename]
+    site["webmap_center"].tolist()[0], site["webmap_zoom"].tolist()[0]
+
+
+def catalog_lookups(site_catalog, algorithm, sitename, uuid):
+    site_catalog.site_options(algorithm)
+    site_catalog.date_options(algorithm, sitename)
+    site_catalog.scene(uuid)["tilemaps_path"]
+    site_catalog.site_view(sitename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'build (ms)':>11} {'mask (ms)':>10} {'catalog (us)':>13} {'speedup':>9}")
+
+    for n_rows in args.rows:
+        imagery_metadata = make_imagery_metadata(n_rows)
+
+        build_s = timeit.timeit(lambda: SiteCatalog(imagery_metadata), number=1)
+        site_catalog = SiteCatalog(imagery_metadata)
+
+        samples = imagery_metadata.sample(args.repeat, replace=True, random_state=1)[["algorithm", "sitename", "uuid"]].values.tolist()
+
+        mask_s = timeit.timeit(lambda: [mask_lookups(imagery_metadata, *sample) for sample in samples], number=1) / len(samples)
+        catalog_s = timeit.timeit(lambda: [catalog_lookups(site_catalog, *sample) for sample in samples], number=1) / len(samples)
+
+        print(f"{n_rows:>8} {build_s * 1e3:>11.1f} {mask_s * 1e3:>10.3f} {catalog_s * 1e6:>13.2f} {mask_s / catalog_s:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
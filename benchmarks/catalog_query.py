@@ -0,0 +1,85 @@
+"""Scene query latency (SiteCatalog.query_scenes) for typical query shapes
+
+    python -m benchmarks.catalog_query [--rows 10000 100000] [--repeat 200]
+
+Queries a synthetic catalog the way the /app/WEB/scenes.json endpoint does,
+each at random places and dates, and reports p50/p99 latency per shape,
+including building the page of GeoJSON.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+import shapely
+
+from catalog import SiteCatalog
+from benchmarks.synthetic import make_imagery_metadata
+
+
+def query_shapes(site_catalog, rng):
+    """name -> function making the keyword arguments of a random query of that shape"""
+
+    bounds = site_catalog.metadata.total_bounds
+    algorithms = site_catalog.algorithms
+    sites = site_catalog.metadata["sitename"].unique().tolist()
+
+    centroids = shapely.centroid(site_catalog.metadata.geometry.to_numpy())
+
+    def point():
+        # inside a footprint, as a click on the map would be
+        return centroids[rng.randrange(len(centroids))]
+
+    def bbox(size):
+        west, south = rng.uniform(bounds[0], bounds[2] - size), rng.uniform(bounds[1], bounds[3] - size)
+        return shapely.box(west, south, west + size, south + size)
+
+    def dates(days):
+        start = np.datetime64("2015-01-01") + np.timedelta64(rng.randrange(3650 - days), "D")
+        return {"start": start.astype("datetime64[s]"), "end": (start + np.timedelta64(days, "D")).astype("datetime64[s]")}
+
+    return {
+        "point": lambda: {"geometry": point()},
+        "bbox 1 deg": lambda: {"geometry": bbox(1)},
+        "bbox 10 deg": lambda: {"geometry": bbox(10)},
+        "polygon": lambda: {"geometry": point().buffer(2, 4)},
+        "dates 30 days": lambda: dates(30),
+        "dates 1 year": lambda: dates(365),
+        "bbox + dates": lambda: {"geometry": bbox(10), **dates(365)},
+        "bbox + dates + algo": lambda: {"geometry": bbox(10), **dates(365), "algorithm": rng.choice(algorithms)},
+        "site": lambda: {"sitename": rng.choice(sites)},
+        "all, page 50": lambda: {"offset": 50 * 100},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        site_catalog = SiteCatalog(make_imagery_metadata(n_rows))
+        start = time.perf_counter()
+        site_catalog._scene_index, site_catalog.metadata.sindex, site_catalog._properties_json
+        print(f"{n_rows} rows, indexes built in {(time.perf_counter() - start) * 1e3:.0f} ms")
+        print(f"{'query':>20} {'p50 ms':>8} {'p99 ms':>8} {'matched':>8}")
+
+        rng = random.Random(0)
+        for name, make_query in query_shapes(site_catalog, rng).items():
+            latencies, matched = [], []
+            for _ in range(args.repeat):
+                query = make_query()
+                begin = time.perf_counter()
+                result = site_catalog.query_scenes(**query)
+                latencies.append(time.perf_counter() - begin)
+                matched.append(int(result[result.index('"numberMatched":') + 16:result.index(',"numberReturned"')]))
+            latencies.sort()
+            print(f"{name:>20} {statistics.median(latencies) * 1e3:>8.3f} {latencies[int(len(latencies) * 0.99)] * 1e3:>8.3f} "
+                  f"{statistics.median(matched):>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Startup cost of loading sites.geojson: original import-time parse vs CatalogWatcher
+
+    python -m benchmarks.catalog_startup [--rows 1000 10000 100000]
+
+"legacy" is the parse app.py used to run at import (including the bbox
+GeoJSON it embedded in the map page), "cold" is a CatalogWatcher with no
+snapshot yet (parse + write snapshot) and "snapshot" is a restart against
+the unchanged file.
+"""
+
+import argparse
+import ast
+import os
+import tempfile
+import time
+
+import geopandas as gpd
+
+from catalog import CatalogWatcher
+from benchmarks.synthetic import write_sites_geojson
+
+
+def legacy_load(sites_metadata):
+    imagery_metadata = gpd.read_file(sites_metadata)
+    imagery_metadata["DATETIME"] = imagery_metadata["DATETIME"].astype(str)
+    imagery_metadata.columns = imagery_metadata.columns.str.lower()
+    imagery_metadata["webmap_center"] = imagery_metadata["webmap_center"].apply(ast.literal_eval)
+    return imagery_metadata.__geo_interface__
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'file (MB)':>10} {'legacy (s)':>11} {'cold (s)':>9} {'snapshot (s)':>13} {'speedup':>8}")
+
+    for n_rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            sites_metadata = write_sites_geojson(os.path.join(directory, "sites.geojson"), n_rows)
+            snapshot_directory = os.path.join(directory, "snapshots")
+
+            legacy_s = timed(lambda: legacy_load(sites_metadata))
+            cold_s = timed(lambda: CatalogWatcher(sites_metadata, snapshot_directory=snapshot_directory).load())
+
+            snapshot_s = timed(lambda: CatalogWatcher(sites_metadata, snapshot_directory=snapshot_directory).load())
+
+            size_mb = os.path.getsize(sites_metadata) / 1e6
+            print(f"{n_rows:>8} {size_mb:>10.1f} {legacy_s:>11.2f} {cold_s:>9.2f} {snapshot_s:>13.2f} {legacy_s / snapshot_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
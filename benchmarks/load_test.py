@@ -0,0 +1,332 @@
+"""Latency percentiles and throughput of the web map's hot endpoints under concurrent clients
+
+    python -m benchmarks.load_test [--target client|dev|gunicorn] [--clients 1 8 32] [--seconds 10]
+                                   [--rows 10000] [--result-features 200000] [--output run.json] [--baseline run.json]
+
+Builds a synthetic deployment in a temporary directory: a sites.geojson of
+`--rows` scenes, a GeoTIFF behind one of them, a pre-rendered pyramid as a
+directory and as an MBTiles archive, and an ML result of
+`--result-features` detections with its index and zoom summary. The app is
+pointed at it through ASSETS_DIRECTORY, SITES_METADATA, ML_RESULTS_DIRECTORY
+and the cache directory variables, so nothing is written outside the
+temporary directory, and is driven either
+
+- in this process through the Flask test client (`--target client`, app
+  code only), or
+- as a local server on `--port` (`--target dev` runs `python app.py`,
+  `--target gunicorn` the production configuration).
+
+Each endpoint is hit by 1, 8, ... clients sending requests back to back for
+`--seconds`, cycling through randomised requests of its kind (tiles over
+the pyramid, views of the result, dropdown selections). p50/p95/p99
+latency, requests/sec and errors are reported per endpoint and client count.
+Caches warm as a run goes on, as they would in production.
+
+`--output` saves the results as JSON; `--baseline` compares the run with a
+saved one and exits with status 1 if any endpoint's p95 is more than
+`--tolerance` slower, so a regression fails the build before deploy.
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+
+import ml_result_files
+import ml_result_summaries
+import tile_archives
+from benchmarks.page_payload import callback_request
+from benchmarks.serving_throughput import wait_until_up
+from benchmarks.synthetic import make_detections, make_site_features, write_geotiff, write_pyramid
+from tiling import tiles_for_bounds
+
+RESULT_NAME = "load_test_result"
+SESSION_ID = "load-test"
+
+
+def build_deployment(directory, args):
+    """Write the synthetic data under `directory`; returns (environment, catalog features, scene, scene bounds, result bounds)"""
+
+    assets_directory = os.path.join(directory, "assets")
+    results_directory = os.path.join(directory, "ml_results")
+    os.makedirs(os.path.join(assets_directory, "sites"))
+    os.makedirs(results_directory)
+
+    # the first scene is rendered from a real GeoTIFF; the others only populate the catalog and dropdowns
+    os.makedirs(os.path.join(assets_directory, "imagery"))
+    with rasterio.open(write_geotiff(os.path.join(assets_directory, "imagery", "scene.tif"), size=args.geotiff_size)) as dataset:
+        scene_bounds = transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds)
+    west, south, east, north = scene_bounds
+    features = make_site_features(args.rows)
+    features[0]["geometry"] = box(*scene_bounds).__geo_interface__
+    scene = features[0]["properties"]
+    scene.update(geotiff_path="imagery/scene.tif", tilemaps_path="",
+                 webmap_center=f"[{(south + north) / 2:.5f}, {(west + east) / 2:.5f}]", webmap_zoom=14)
+    with open(os.path.join(assets_directory, "sites", "sites.geojson"), "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    write_pyramid(os.path.join(assets_directory, "bench", "pyramid"), args.pyramid_zooms, args.tile_bytes)
+    tile_archives.convert(os.path.join(assets_directory, "bench", "pyramid"), os.path.join(assets_directory, "bench", "archive.mbtiles"))
+
+    result_path = os.path.join(results_directory, f"{RESULT_NAME}.geojson")
+    # a result over the region around the scene, as change detection over a series covers
+    lng, lat = (west + east) / 2, (south + north) / 2
+    result_bounds = (lng - 0.5, lat - 0.5, lng + 0.5, lat + 0.5)
+    ml_result_files.write_result(make_detections(args.result_features, result_bounds), result_path)
+    ml_result_summaries.build(result_path)
+
+    environment = {
+        # required by app.py but unused by the endpoints under test
+        "CONTACT_EMAIL": "load-test@example.com",
+        "DEPLOY_STATUS": "load-test",
+        "ML_MODEL_PATH": "models/change_detection.pt",
+        "CHANGE_DETECTION_SCRIPT": "scripts/change_detection.py",
+        "ASSETS_DIRECTORY": assets_directory,
+        "SITES_METADATA": os.path.join(assets_directory, "sites", "sites.geojson"),
+        "ML_RESULTS_DIRECTORY": results_directory,
+        "TILE_CACHE_DIRECTORY": os.path.join(directory, "tile_cache"),
+        "ML_RESULT_TILE_CACHE_DIRECTORY": os.path.join(directory, "ml_result_tiles"),
+        "ML_RESULT_CACHE_DIRECTORY": os.path.join(directory, "ml_result_cache"),
+        "CATALOG_SNAPSHOT_DIRECTORY": os.path.join(directory, "catalog_snapshots"),
+        "LONG_CALLBACK_CACHE_DIRECTORY": os.path.join(directory, "long_callback_cache"),
+        "ML_JOB_DATABASE": os.path.join(directory, "ml_jobs.sqlite"),
+        "ML_POOL_ADDRESS": os.path.join(directory, "ml-pool.sock"),
+        "METRICS_DIRECTORY": os.path.join(directory, "metrics"),
+        # only one scene has a GeoTIFF; prefetching the site views' other scenes would only log failed reads
+        "TILE_PREFETCH_WORKERS": "0",
+        "PORT": str(args.port),
+        "DEBUG_STATUS": "",
+    }
+    return environment, features, scene, scene_bounds, result_bounds
+
+
+def endpoints(features, scene, scene_bounds, result_bounds, pyramid_zooms, rng):
+    """name -> list of (path, JSON body or None) to cycle through"""
+
+    west, south, east, north = scene_bounds
+    pyramid_tiles = [(z, x, y) for z in pyramid_zooms for x in range(2 ** (z - pyramid_zooms[0])) for y in range(2 ** (z - pyramid_zooms[0]))]
+    scene_tiles = [tile for z in (13, 14, 15, 16) for tile in tiles_for_bounds(west, south, east, north, z)]
+
+    def view(zoom):
+        # a map view of about 1024 pixels at `zoom` centred somewhere over the result
+        size = 4 * 360 / 2 ** zoom
+        lng = rng.uniform(result_bounds[0], result_bounds[2]) - size / 2
+        lat = rng.uniform(result_bounds[1], result_bounds[3]) - size / 2
+        return f"{lng:.5f},{lat:.5f},{lng + size:.5f},{lat + size:.5f}"
+
+    sites = {}
+    for feature in features:
+        properties = feature["properties"]
+        sites.setdefault((properties["algorithm"], properties["sitename"]), []).append(properties["uuid"])
+    selections = rng.sample(sorted(sites), min(200, len(sites)))
+    site_outputs = [("id-location-dropdown", "options"), ("id-location-dropdown", "value")]
+    date_outputs = [("id-datetime-for-imagery_tilemap", "options"), ("id-datetime-for-imagery_tilemap", "value")] + [
+        (id, prop) for id in ("id-change-selection-startdate", "id-change-selection-enddate") for prop in ("multi", "options", "value")]
+    session = [("id-session", "data", SESSION_ID)]
+
+    requests = {
+        "pyramid tile": [(f"/app/WEB/maptiles/bench/pyramid/{z}/{x}/{y}.png", None) for z, x, y in pyramid_tiles],
+        "archive tile": [(f"/app/WEB/maptiles/bench/archive/{z}/{x}/{y}.png", None) for z, x, y in pyramid_tiles],
+        "scene tile": [(f"/app/WEB/scene_tiles/{scene['uuid']}/{z}/{x}/{y}.png", None) for z, x, y in scene_tiles],
+        "result view z15": [(f"/app/WEB/ml_results/{RESULT_NAME}.geojson?bbox={view(15)}&zoom=15", None) for _ in range(500)],
+        "result view z9": [(f"/app/WEB/ml_results/{RESULT_NAME}.geojson?bbox={view(9)}&zoom=9", None) for _ in range(500)],
+        "result file": [(f"/app/WEB/ml_results/{RESULT_NAME}.geojson", None)],
+        "callback sites": [("/app/WEB/_dash-update-component", callback_request(site_outputs, [("id-algorithm-dropdown", "value", algorithm)]))
+                           for algorithm in sorted({algorithm for algorithm, _ in sites})],
+        "callback dates": [("/app/WEB/_dash-update-component", callback_request(
+            date_outputs, [("id-algorithm-dropdown", "value", algorithm), ("id-location-dropdown", "value", sitename)]))
+            for algorithm, sitename in selections],
+        "callback site view": [("/app/WEB/_dash-update-component", callback_request(
+            [("id-web-map", "center"), ("id-web-map", "zoom")], [("id-location-dropdown", "value", sitename)], session))
+            for _, sitename in selections],
+        "callback tile url": [("/app/WEB/_dash-update-component", callback_request(
+            [("id-satellite-tilemap-layer", "url")], [("id-datetime-for-imagery_tilemap", "value", rng.choice(sites[selection]))], session))
+            for selection in selections],
+    }
+    for endpoint_requests in requests.values():
+        rng.shuffle(endpoint_requests)
+    return requests
+
+
+def client_sender(app):
+    """send(path, body) -> status through a Flask test client of this thread"""
+
+    local = threading.local()
+
+    def send(path, body):
+        if not hasattr(local, "client"):
+            local.client = app.server.test_client()
+        response = local.client.open(path, method="POST" if body else "GET", json=body, headers={"Accept-Encoding": "gzip"})
+        # streamed bodies are generated as they are read
+        response.get_data()
+        return response.status_code
+
+    return send
+
+
+def http_sender(base_url):
+    """send(path, body) -> status over HTTP"""
+
+    def send(path, body):
+        http_request = urllib.request.Request(base_url + path, data=json.dumps(body).encode() if body else None,
+                                              headers={"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+        try:
+            with urllib.request.urlopen(http_request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    return send
+
+
+def measure(send, requests, clients, seconds):
+    """(latencies in seconds, errors, elapsed seconds) of `clients` sending `requests` round robin for `seconds`"""
+
+    deadline = time.perf_counter() + seconds
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client(offset):
+        client_latencies, client_errors = [], 0
+        position = offset
+        while time.perf_counter() < deadline:
+            path, body = requests[position % len(requests)]
+            position += 1
+            start = time.perf_counter()
+            try:
+                status = send(path, body)
+            except OSError:
+                status = None
+            client_latencies.append(time.perf_counter() - start)
+            client_errors += status is None or status >= 400
+        with lock:
+            latencies.extend(client_latencies)
+            errors.append(client_errors)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        # clients start at different places so they don't all ask for the same item at once
+        for index in range(clients):
+            executor.submit(client, index * len(requests) // clients)
+    return latencies, sum(errors), time.perf_counter() - start
+
+
+def percentiles(latencies):
+    """(p50, p95, p99) in milliseconds"""
+
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else float("nan")
+        return value, value, value
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+def compare(results, baseline, tolerance, min_regression_ms):
+    """Lines describing the endpoints whose p95 regressed against `baseline`"""
+
+    previous = {(result["endpoint"], result["clients"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["endpoint"], result["clients"]))
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance) and result["p95_ms"] - before["p95_ms"] > min_regression_ms:
+            regressions.append(f"{result['endpoint']} with {result['clients']} clients: p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms")
+    return regressions
+
+
+def run(send, requests, args):
+    results = []
+    print(f"{'endpoint':>20} {'clients':>8} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for clients in args.clients:
+        for endpoint, endpoint_requests in requests.items():
+            if args.endpoints and endpoint not in args.endpoints:
+                continue
+            latencies, errors, elapsed = measure(send, endpoint_requests, clients, args.seconds)
+            p50, p95, p99 = percentiles(latencies)
+            results.append({"endpoint": endpoint, "clients": clients, "requests": len(latencies), "errors": errors,
+                            "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "requests_per_second": len(latencies) / elapsed})
+            print(f"{endpoint:>20} {clients:>8} {len(latencies):>9} {errors:>7} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} "
+                  f"{len(latencies) / elapsed:>8.0f}", flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["client", "dev", "gunicorn"], default="client")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seconds", type=float, default=10, help="per endpoint and client count")
+    parser.add_argument("--endpoints", nargs="+", help="only these endpoints (names as printed)")
+    parser.add_argument("--rows", type=int, default=10_000, help="scenes in the synthetic catalog")
+    parser.add_argument("--geotiff-size", type=int, default=4096, help="synthetic GeoTIFF width and height in pixels")
+    parser.add_argument("--pyramid-zooms", type=int, nargs="+", default=[12, 13, 14, 15, 16])
+    parser.add_argument("--tile-bytes", type=int, default=20_000, help="synthetic pyramid tile size")
+    parser.add_argument("--result-features", type=int, default=200_000, help="detections in the synthetic ML result")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95 slowdown against the baseline")
+    parser.add_argument("--min-regression-ms", type=float, default=1.0, help="p95 slowdowns smaller than this are noise")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        environment, features, scene, scene_bounds, result_bounds = build_deployment(directory, args)
+        requests = endpoints(features, scene, scene_bounds, result_bounds, args.pyramid_zooms, random.Random(args.seed))
+        print(f"synthetic deployment: {args.rows} scenes, {args.result_features} detections, "
+              f"built in {time.perf_counter() - start:.1f}s; target {args.target}")
+
+        process = None
+        try:
+            if args.target == "client":
+                # the app reads its configuration on import
+                os.environ.update(environment)
+                import app
+                send = client_sender(app)
+            else:
+                command = [sys.executable, "app.py"] if args.target == "dev" else \
+                    [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "wsgi:application"]
+                # own process group, so the ML pool server it forks is stopped with it
+                process = subprocess.Popen(command, env={**os.environ, **environment}, stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL, start_new_session=True)
+                base_url = f"http://127.0.0.1:{args.port}"
+                wait_until_up(f"{base_url}/app/WEB/", process)
+                send = http_sender(base_url)
+
+            results = run(send, requests, args)
+        finally:
+            if process is not None:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(30)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_regression_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Change detection latency: a cold `python script.py` subprocess per run vs the warm worker pool
+
+    python -m benchmarks.ml_pool_latency [--runs 5] [--model-load-seconds 2]
+
+Uses a stand-in change detection script that imports the geospatial stack
+(in place of torch/onnxruntime), sleeps to emulate the model load and
+writes an empty result, so the numbers isolate per-run overhead.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+import ml_workers
+
+STAND_IN_SCRIPT = textwrap.dedent('''
+    import argparse
+    import json
+    import os
+    import time
+
+    import geopandas
+    import rasterio
+
+    def load_model(model_path):
+        time.sleep(float(os.environ.get("BENCHMARK_MODEL_LOAD_SECONDS", "2")))
+        return model_path
+
+    def run_change_detection(model, before, after, output, verbose=False):
+        with open(output, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": []}, f)
+
+    if __name__ == "__main__":
+        parser = argparse.ArgumentParser()
+        for argument in ("before", "after", "model", "output"):
+            parser.add_argument(argument)
+        parser.add_argument("--verbose", action="store_true")
+        args = parser.parse_args()
+        run_change_detection(load_model(args.model), args.before, args.after, args.output, args.verbose)
+''')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--model-load-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    os.environ["BENCHMARK_MODEL_LOAD_SECONDS"] = str(args.model_load_seconds)
+
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "change_detection.py")
+        with open(script, "w") as f:
+            f.write(STAND_IN_SCRIPT)
+        output = os.path.join(directory, "result.geojson")
+        params = {"script": script, "model": "model.onnx", "before": "before.tif", "after": "after.tif", "output": output}
+
+        cold = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, "before.tif", "after.tif", "model.onnx", output, "--verbose"], check=True, capture_output=True)
+            cold.append(time.perf_counter() - start)
+
+        pool = ml_workers.ensure_pool_server(os.path.join(directory, "pool.sock"), b"benchmark", processes=1, threads_per_process=1)
+
+        warm = []
+        for _ in range(args.runs + 1):
+            start = time.perf_counter()
+            result = pool.run("change_detection", params)
+            warm.append(time.perf_counter() - start)
+            assert result["returncode"] == 0, result["stderr"]
+
+    print(f"{'':>22} {'median (s)':>11} {'min (s)':>8}")
+    print(f"{'cold subprocess':>22} {statistics.median(cold):>11.3f} {min(cold):>8.3f}")
+    print(f"{'pool, first run':>22} {warm[0]:>11.3f} {warm[0]:>8.3f}")
+    print(f"{'pool, warm':>22} {statistics.median(warm[1:]):>11.3f} {min(warm[1:]):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
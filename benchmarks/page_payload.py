@@ -0,0 +1,92 @@
+"""Initial response bytes and time-to-interactive of each page
+
+    python -m benchmarks.page_payload [--base-url http://127.0.0.1:8050] [--repeat 20]
+
+Replays, against a running server, the requests a browser makes to show a
+page, in order:
+
+- shell: the index HTML, `_dash-layout` and `_dash-dependencies`
+- page: the `display_page` callback for the route
+- data: the callbacks the page fires once shown (the data table's first page)
+
+and reports the bytes of each step and the median time of the whole chain.
+Dash's JavaScript bundles are left out: they are static and cached by the
+browser after the first visit. Run it before and after a change to compare.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+
+ROUTES = ("/home", "/map", "/data", "/help")
+
+
+def callback_request(outputs, inputs, state=()):
+    """_dash-update-component body; `outputs` are (id, property), `inputs` and `state` (id, property, value)"""
+
+    output_specs = [{"id": id, "property": prop} for id, prop in outputs]
+    # Dash sends a single output unwrapped
+    if len(outputs) == 1:
+        output, output_specs = ".".join(outputs[0]), output_specs[0]
+    else:
+        output = "..{}..".format("...".join(f"{id}.{prop}" for id, prop in outputs))
+    return {
+        "output": output,
+        "outputs": output_specs,
+        "inputs": [{"id": id, "property": prop, "value": value} for id, prop, value in inputs],
+        "changedPropIds": [f"{id}.{prop}" for id, prop, _ in inputs],
+        "state": [{"id": id, "property": prop, "value": value} for id, prop, value in state],
+    }
+
+
+def steps(route):
+    """[(step, path, POST body or None)] a browser requests to show `route`"""
+
+    shell = [("shell", "/app/WEB/", None), ("shell", "/app/WEB/_dash-layout", None), ("shell", "/app/WEB/_dash-dependencies", None)]
+    page = [("page", "/app/WEB/_dash-update-component", callback_request([("page-content", "children")], [("url", "pathname", route)]))]
+    data = []
+    if route == "/data":
+        data.append(("data", "/app/WEB/_dash-update-component", callback_request(
+            [("id-imagery-metadata-table", "data"), ("id-imagery-metadata-table", "page_count")],
+            [("id-imagery-metadata-table", "page_current", 0), ("id-imagery-metadata-table", "page_size", 50),
+             ("id-imagery-metadata-table", "filter_query", ""), ("id-imagery-metadata-table", "sort_by", [])])))
+    return shell + page + data
+
+
+def fetch(url, body):
+    """Response size in bytes"""
+
+    http_request = urllib.request.Request(url, data=json.dumps(body).encode() if body else None,
+                                          headers={"Content-Type": "application/json"} if body else {})
+    with urllib.request.urlopen(http_request, timeout=60) as response:
+        return len(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8050")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'route':>8} {'shell bytes':>12} {'page bytes':>12} {'data bytes':>12} {'interactive ms':>15}")
+    for route in ROUTES:
+        route_steps = steps(route)
+        sizes = {}
+        durations = []
+        # the first chain warms the server's caches, as any earlier visitor would have
+        for repeat in range(args.repeat + 1):
+            start = time.perf_counter()
+            chain_sizes = {}
+            for step, path, body in route_steps:
+                chain_sizes[step] = chain_sizes.get(step, 0) + fetch(args.base_url + path, body)
+            if repeat:
+                durations.append(time.perf_counter() - start)
+            sizes = chain_sizes
+        print(f"{route:>8} {sizes['shell']:>12} {sizes['page']:>12} {sizes.get('data', 0):>12} "
+              f"{statistics.median(durations) * 1000:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
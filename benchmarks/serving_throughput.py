@@ -0,0 +1,136 @@
+"""Requests/sec of the Flask development server vs gunicorn
+
+    python -m benchmarks.serving_throughput [--concurrency 1 8 32] [--seconds 10]
+
+Starts the app with `python app.py` and with `gunicorn --config
+gunicorn.conf.py wsgi:application` in turn, using the environment this is
+run with (CONTACT_EMAIL, DEPLOY_STATUS, ML_MODEL_PATH, ... and the /blob
+and /fs mounts), and measures requests/sec at each concurrency for:
+
+- a scene tile (rendered once, then served from the tile cache)
+- the imagery bboxes endpoint
+- a Dash callback (the site dropdown for an algorithm)
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+from rasterio.warp import transform_bounds
+
+from catalog import load_site_metadata
+from tiling import tiles_for_bounds
+
+ASSETS_DIRECTORY = "/blob/assets"
+SITES_METADATA = "/blob/assets/sites/sites.geojson"
+
+
+def endpoints(base_url):
+    """name -> (url, POST body or None)"""
+
+    with open(SITES_METADATA, "rb") as f:
+        imagery_metadata, _ = load_site_metadata(f.read(), {})
+    # the first scene whose GeoTIFF is on disk
+    scene = next(row for _, row in imagery_metadata.iterrows() if os.path.exists(os.path.join(ASSETS_DIRECTORY, row["geotiff_path"])))
+    with rasterio.open(os.path.join(ASSETS_DIRECTORY, scene["geotiff_path"])) as dataset:
+        z, x, y = tiles_for_bounds(*transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds), 14)[0]
+    west, south, east, north = scene.geometry.bounds
+
+    callback = {
+        "output": "..id-location-dropdown.options...id-location-dropdown.value..",
+        "outputs": [{"id": "id-location-dropdown", "property": "options"}, {"id": "id-location-dropdown", "property": "value"}],
+        "inputs": [{"id": "id-algorithm-dropdown", "property": "value", "value": scene["algorithm"]}],
+        "changedPropIds": ["id-algorithm-dropdown.value"],
+        "state": [],
+    }
+
+    return {
+        "scene tile": (f"{base_url}/app/WEB/scene_tiles/{scene['uuid']}/{z}/{x}/{y}.png", None),
+        "imagery bboxes": (f"{base_url}/app/WEB/imagery_bboxes.geojson?bbox={west},{south},{east},{north}&zoom=10", None),
+        "dash callback": (f"{base_url}/app/WEB/_dash-update-component", json.dumps(callback).encode()),
+    }
+
+
+def request(url, body):
+    http_request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"} if body else {})
+    with urllib.request.urlopen(http_request, timeout=60) as response:
+        response.read()
+
+
+def measure(url, body, concurrency, seconds):
+    """Requests/sec with `concurrency` clients each sending requests back to back"""
+
+    deadline = time.perf_counter() + seconds
+    counts = []
+    lock = threading.Lock()
+
+    def client():
+        count = 0
+        while time.perf_counter() < deadline:
+            request(url, body)
+            count += 1
+        with lock:
+            counts.append(count)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def wait_until_up(url, process, timeout=180):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            request(url, None)
+            return
+        except OSError:
+            time.sleep(1)
+    raise RuntimeError(f"server not up after {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    servers = {
+        "dev server": [sys.executable, "app.py"],
+        "gunicorn": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "wsgi:application"],
+    }
+    base_url = f"http://127.0.0.1:{args.port}"
+    urls = endpoints(base_url)
+
+    print(f"{'server':>12} {'endpoint':>16} " + " ".join(f"{f'{concurrency} clients':>12}" for concurrency in args.concurrency))
+    for name, command in servers.items():
+        environment = {**os.environ, "PORT": str(args.port), "DEBUG_STATUS": ""}
+        # own process group, so the ML pool server it forks is stopped with it
+        process = subprocess.Popen(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   start_new_session=True)
+        try:
+            wait_until_up(f"{base_url}/app/WEB/", process)
+            for endpoint, (url, body) in urls.items():
+                # warm caches so both servers are measured serving, not rendering
+                request(url, body)
+                rates = [measure(url, body, concurrency, args.seconds) for concurrency in args.concurrency]
+                print(f"{name:>12} {endpoint:>16} " + " ".join(f"{rate:>10.0f}/s" for rate in rates))
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(30)
+
+
+if __name__ == "__main__":
+    main()
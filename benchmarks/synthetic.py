@@ -0,0 +1,124 @@
+"""Synthetic site catalogs shaped like /blob/assets/sites/sites.geojson"""
+
+import json
+import os
+import random
+import uuid
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+
+def make_site_features(n_rows, n_sites=None, seed=0):
+    """Raw GeoJSON features with the properties written by the imagery pipeline"""
+
+    rng = random.Random(seed)
+    n_sites = n_sites or max(1, n_rows // 50)
+
+    features = []
+    for i in range(n_rows):
+        site_index = i % n_sites
+        sitename = f"site_{site_index:05d}"
+        algorithm = "Change" if site_index % 3 else "Detection"
+
+        west = -140 + (site_index * 0.37) % 80 + rng.random() * 0.2
+        south = 42 + (site_index * 0.23) % 25 + rng.random() * 0.2
+        east, north = west + 0.1, south + 0.1
+
+        features.append({
+            "type": "Feature",
+            "properties": {
+                "DATETIME": f"{2015 + rng.randrange(10)}-{1 + rng.randrange(12):02d}-{1 + rng.randrange(28):02d}T{rng.randrange(24):02d}:00:00",
+                "algorithm": algorithm,
+                "sitename": sitename,
+                "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+                "geotiff_path": f"imagery/{sitename}/{i}.tif",
+                "tilemaps_path": f"/app/WEB/maptiles/tilemaps/{sitename}/{i}/{{z}}/{{x}}/{{y}}.png",
+                "webmap_center": f"[{(south + north) / 2:.5f}, {(west + east) / 2:.5f}]",
+                "webmap_zoom": 13,
+                "crs": "EPSG:4326",
+                "notes": "",
+            },
+            "geometry": box(west, south, east, north).__geo_interface__,
+        })
+
+    return features
+
+
+def write_sites_geojson(path, n_rows, n_sites=None, seed=0):
+    """Write a synthetic sites.geojson and return its path"""
+
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": make_site_features(n_rows, n_sites, seed)}, f)
+
+    return path
+
+
+def make_imagery_metadata(n_rows, n_sites=None, seed=0):
+    """GeoDataFrame in the shape app.py produces after parsing sites.geojson"""
+
+    imagery_metadata = gpd.GeoDataFrame.from_features(make_site_features(n_rows, n_sites, seed), crs="EPSG:4326")
+    imagery_metadata.columns = imagery_metadata.columns.str.lower()
+    imagery_metadata["datetime"] = imagery_metadata["datetime"].str.replace("T", " ")
+    imagery_metadata["webmap_center"] = imagery_metadata["webmap_center"].apply(json.loads)
+
+    return imagery_metadata
+
+
+def write_geotiff(path, size=4096, count=3, dtype="uint16", crs="EPSG:32611", origin=(500000, 5700000), resolution=1.0, seed=0):
+    """Write a tiled GeoTIFF with internal overviews (COG-like) of smooth noise and return its path"""
+
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    # low frequency pattern upsampled so tiles compress like imagery rather than white noise
+    coarse = rng.random((count, size // 64 + 1, size // 64 + 1))
+    data = np.kron(coarse, np.ones((64, 64)))[:, :size, :size]
+    data = (data * (255 if dtype == "uint8" else 4000)).astype(dtype)
+
+    profile = dict(driver="GTiff", width=size, height=size, count=count, dtype=dtype, crs=crs,
+                   transform=from_origin(*origin, resolution, resolution), nodata=0,
+                   tiled=True, blockxsize=512, blockysize=512, compress="deflate")
+
+    with rasterio.open(path, "w", **profile) as dataset:
+        dataset.write(data)
+        factors = [2 ** level for level in range(1, 8) if size // 2 ** level >= 256]
+        dataset.build_overviews(factors, Resampling.average)
+
+    return path
+
+
+def write_pyramid(directory, zooms, tile_bytes, seed=0):
+    """Synthetic pyramid of incompressible tiles over a square of tiles at each zoom"""
+
+    rng = random.Random(seed)
+    for z in zooms:
+        side = 2 ** (z - zooms[0])
+        for x in range(side):
+            os.makedirs(os.path.join(directory, str(z), str(x)), exist_ok=True)
+            for y in range(side):
+                with open(os.path.join(directory, str(z), str(x), f"{y}.png"), "wb") as f:
+                    f.write(rng.randbytes(tile_bytes))
+
+
+def make_detections(n_features, bounds, seed=0):
+    """GeoDataFrame of `n_features` small boxes with score/class/label, clustered inside lng/lat `bounds`"""
+
+    rng = np.random.default_rng(seed)
+    west, south, east, north = bounds
+    # detections bunch up (buildings, ships in port) rather than spreading evenly
+    centres = rng.uniform((west, south), (east, north), (max(1, n_features // 500), 2))
+    points = centres[rng.integers(len(centres), size=n_features)] + rng.normal(0, (east - west) / 50, (n_features, 2))
+    points = np.clip(points, (west, south), (east, north))
+    size = (east - west) / 5000
+    classes = rng.integers(0, 3, n_features)
+
+    return gpd.GeoDataFrame({
+        "score": rng.uniform(0.25, 1, n_features),
+        "class": classes,
+        "label": np.array(["car", "ship", "building"])[classes],
+    }, geometry=shapely.box(points[:, 0], points[:, 1], points[:, 0] + size, points[:, 1] + size), crs="EPSG:4326")
@@ -0,0 +1,87 @@
+"""Pre-rendered tile latency: one file per tile vs an MBTiles archive
+
+    python -m benchmarks.tile_archive_latency [--directory /blob/assets/tiles/site1/1] [--concurrency 1 8]
+
+Reads random tiles of a pyramid from its `<z>/<x>/<y>.<ext>` files (open and
+read, as serve_tiles does) and from the same pyramid converted with
+tile_archives.convert(), and reports p50/p99 latency and tiles/sec at each
+concurrency. Without `--directory` a synthetic pyramid is written to a
+temporary directory; point it at a pyramid on the blob mount to include the
+network filesystem's per-file cost.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tile_archives
+from benchmarks.synthetic import write_pyramid
+
+
+def list_tiles(directory):
+    return [(int(z), int(x), int(filename.partition(".")[0]), os.path.join(directory, z, x, filename))
+            for z in os.listdir(directory) if z.isdigit()
+            for x in os.listdir(os.path.join(directory, z)) if x.isdigit()
+            for filename in os.listdir(os.path.join(directory, z, x))]
+
+
+def read_file(tile):
+    with open(tile[3], "rb") as f:
+        return f.read()
+
+
+def measure(read, tiles, concurrency):
+    """(p50 ms, p99 ms, tiles/sec) reading `tiles` from `concurrency` threads"""
+
+    def timed_read(tile):
+        start = time.perf_counter()
+        read(tile)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(timed_read, tiles))
+    elapsed = time.perf_counter() - start
+    return statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99)] * 1000, len(tiles) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", help="existing pyramid directory; synthetic if omitted")
+    parser.add_argument("--zooms", type=int, nargs="+", default=[12, 13, 14, 15, 16], help="synthetic pyramid zooms")
+    parser.add_argument("--tile-bytes", type=int, default=30_000, help="synthetic tile size")
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = args.directory
+        if directory is None:
+            directory = os.path.join(temporary_directory, "pyramid")
+            write_pyramid(directory, args.zooms, args.tile_bytes)
+        archive_path = os.path.join(temporary_directory, "pyramid" + tile_archives.ARCHIVE_SUFFIX)
+        _, count = tile_archives.convert(directory, archive_path)
+        print(f"{count} tiles, archive {os.path.getsize(archive_path) / 2**20:.1f} MiB")
+
+        tiles = list_tiles(directory)
+        rng = random.Random(0)
+        requests = [rng.choice(tiles) for _ in range(args.requests)]
+        archives = tile_archives.TileArchives(temporary_directory)
+        backends = {
+            "files": read_file,
+            "mbtiles": lambda tile: archives.read("pyramid", *tile[:3])[1],
+        }
+
+        print(f"{'backend':>8} {'clients':>8} {'p50 ms':>8} {'p99 ms':>8} {'tiles/s':>9}")
+        for name, read in backends.items():
+            for concurrency in args.concurrency:
+                p50, p99, rate = measure(read, requests, concurrency)
+                print(f"{name:>8} {concurrency:>8} {p50:>8.3f} {p99:>8.3f} {rate:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
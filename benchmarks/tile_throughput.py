@@ -0,0 +1,59 @@
+"""Scene tile throughput: on-demand GeoTIFF rendering vs the LRU tile cache
+
+    python -m benchmarks.tile_throughput [--concurrency 1 4 8] [--size 8192]
+
+Renders every tile covering a synthetic GeoTIFF at zooms 12-16 from a
+thread pool, first cold (rendered from the GeoTIFF) and then warm (served
+from TileCache), and reports tiles/sec at each concurrency.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rasterio.warp import transform_bounds
+
+import scene_tiles
+from benchmarks.synthetic import write_geotiff
+from tiling import tiles_for_bounds
+
+
+def run(tiles, scene, assets_directory, tile_cache, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        served = sum(tile is not None for tile in executor.map(
+            lambda tile: scene_tiles.get_scene_tile(scene, *tile, assets_directory, tile_cache), tiles))
+    return served, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--size", type=int, default=8192, help="GeoTIFF width and height in pixels")
+    parser.add_argument("--zooms", type=int, nargs="+", default=[12, 13, 14, 15, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as assets_directory:
+        geotiff_path = write_geotiff(os.path.join(assets_directory, "scene.tif"), size=args.size)
+        scene = {"uuid": "benchmark", "geotiff_path": "scene.tif", "tilemaps_path": None}
+
+        with scene_tiles.rasterio.open(geotiff_path) as dataset:
+            bounds = transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds)
+        tiles = [tile for zoom in args.zooms for tile in tiles_for_bounds(*bounds, zoom)]
+
+        print(f"{len(tiles)} tiles over zooms {args.zooms} of a {args.size}x{args.size} GeoTIFF")
+        print(f"{'threads':>8} {'rendered (tiles/s)':>19} {'cached (tiles/s)':>17}")
+
+        for concurrency in args.concurrency:
+            tile_cache = scene_tiles.TileCache(os.path.join(assets_directory, f"cache-{concurrency}"), size_limit=2**30)
+
+            served, cold_s = run(tiles, scene, assets_directory, tile_cache, concurrency)
+            _, warm_s = run(tiles, scene, assets_directory, tile_cache, concurrency)
+
+            print(f"{concurrency:>8} {served / cold_s:>19.0f} {served / warm_s:>17.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,518 @@
+"""Indexed view of the imagery site metadata
+
+The dropdown and map callbacks only ever ask a handful of questions of
+`imagery_metadata`: which sites exist for an algorithm, which scenes (dates)
+exist for a site, and what is stored against a scene uuid. `SiteCatalog`
+answers those from dictionaries built once at load time instead of
+filtering the GeoDataFrame with boolean masks on every request.
+
+`CatalogWatcher` owns the current `SiteCatalog` and rebuilds it in a
+background thread when sites.geojson changes on disk. Callers read
+`watcher.current` once per request; a reload replaces the whole object so a
+request never sees a half-built catalog.
+
+Parsing sites.geojson is the slow part of startup, so every parsed catalog
+is also written to a GeoParquet snapshot named after the source file's
+sha256. Workers starting against an unchanged file memory map the snapshot
+instead of parsing the GeoJSON again.
+
+"""
+
+import ast
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from functools import cached_property
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box, shape
+
+from table_index import TableIndex
+
+log = logging.getLogger(__name__)
+
+# zoom levels above this draw footprints unsimplified
+MAX_SIMPLIFIED_ZOOM = 18
+
+# scenes per page of query_scenes(), and the most one page may hold
+QUERY_DEFAULT_LIMIT = 100
+QUERY_MAX_LIMIT = 1000
+
+# columns not shown on the data page table
+DASHTABLE_DROPPED_COLUMNS = ["geometry", "geotiff_path", "tilemaps_path", "webmap_center", "webmap_zoom", "crs", "notes"]
+
+
+class SiteCatalog:
+    """Hash indexes over the parsed sites.geojson GeoDataFrame
+
+    Lookups return the same list/dict objects on every call; callers must
+    treat them as read-only.
+    """
+
+    def __init__(self, imagery_metadata, version=None):
+        self.metadata = imagery_metadata
+        # digest of the source file; changes whenever the catalog is rebuilt from new data
+        self.version = version
+
+        # generate df for dash_table; gdf not compatible with dash_table
+        self.dashtable = imagery_metadata.drop(columns=DASHTABLE_DROPPED_COLUMNS, errors="ignore")
+        self.dashtable.columns = self.dashtable.columns.str.title()
+
+        # column-wise tolist() + zip is several times faster than DataFrame.to_dict("records")
+        columns = [column for column in imagery_metadata.columns if column != "geometry"]
+        records = [dict(zip(columns, values))
+                   for values in zip(*(imagery_metadata[column].tolist() for column in columns))]
+
+        self._records = records
+        self._simplified_geometries = {}
+
+        # uuid -> row of metadata (without geometry)
+        self.by_uuid = {record["uuid"]: record for record in records}
+        # uuid -> row position in metadata
+        self._positions = {record["uuid"]: position for position, record in enumerate(records)}
+
+        # (algorithm, sitename) -> rows, kept in file order until sorted below
+        scenes_by_site = {}
+        # algorithm -> sitenames in order of first appearance (matches Series.unique())
+        sites_by_algorithm = {}
+        # sitename -> (webmap_center, webmap_zoom) of the first row for the site
+        self._site_view = {}
+        # sitename -> row of the site's most recent scene
+        self._latest_scene = {}
+
+        for record in records:
+            algorithm = record["algorithm"]
+            sitename = record["sitename"]
+
+            scenes_by_site.setdefault((algorithm, sitename), []).append(record)
+            sites_by_algorithm.setdefault(algorithm, {}).setdefault(sitename, None)
+            self._site_view.setdefault(sitename, (record["webmap_center"], record["webmap_zoom"]))
+            if str(record["datetime"]) >= str(self._latest_scene.get(sitename, record)["datetime"]):
+                self._latest_scene[sitename] = record
+
+        self.algorithms = list(sites_by_algorithm)
+
+        self._site_options = {
+            algorithm: [{"label": site, "value": site} for site in sites]
+            for algorithm, sites in sites_by_algorithm.items()
+        }
+
+        # datetimes are kept as ISO formatted strings so a string sort is a date sort
+        self._date_options = {
+            key: [{"label": str(record["datetime"]), "value": record["uuid"]}
+                  for record in sorted(rows, key=lambda row: str(row["datetime"]))]
+            for key, rows in scenes_by_site.items()
+        }
+
+    def __len__(self):
+        return len(self.by_uuid)
+
+    @cached_property
+    def table(self):
+        """Columnar index of `dashtable` serving the data page's paging, filtering and sorting"""
+
+        return TableIndex(self.dashtable)
+
+    @cached_property
+    def _scene_index(self):
+        """Arrays answering query_scenes()
+
+        `order` lists row positions by datetime (unparsable datetimes last),
+        `rank` is each row's place in it and `sorted_datetimes` the datetimes
+        in that order, so a date range is two binary searches. Algorithm and
+        site are integer codes so filtering candidates is one comparison.
+        Footprint bounds let box queries skip exact intersection tests.
+        """
+
+        datetimes = pd.to_datetime(self.metadata["datetime"], errors="coerce", format="mixed").to_numpy(dtype="datetime64[s]")
+        order = np.argsort(datetimes, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        footprints = self.metadata.geometry.to_numpy()
+        footprint_bounds = shapely.bounds(footprints)
+        algorithm_codes, algorithms = pd.factorize(self.metadata["algorithm"])
+        site_codes, sites = pd.factorize(self.metadata["sitename"])
+
+        return {
+            "datetimes": datetimes,
+            "order": order,
+            "rank": rank,
+            "sorted_datetimes": datetimes[order],
+            "footprint_bounds": footprint_bounds,
+            # footprints filling their bounding box (most are bboxes): a box query needs no exact test for them
+            "is_box": np.isclose(shapely.area(footprints), (footprint_bounds[:, 2] - footprint_bounds[:, 0]) * (footprint_bounds[:, 3] - footprint_bounds[:, 1])),
+            "algorithm_codes": algorithm_codes,
+            "algorithms": {algorithm: code for code, algorithm in enumerate(algorithms)},
+            "site_codes": site_codes,
+            "sites": {site: code for code, site in enumerate(sites)},
+        }
+
+    def _intersecting(self, geometry):
+        """Row positions of the footprints intersecting a geometry, in no particular order"""
+
+        index = self._scene_index
+        if not shapely.equals(geometry, shapely.box(*geometry.bounds)):
+            return self.metadata.sindex.query(geometry, predicate="intersects")
+
+        # a box query: footprints whose bounds overlap it intersect it if they are boxes themselves,
+        # or if they lie inside it; only the other footprints on its edges need an exact test
+        west, south, east, north = geometry.bounds
+        candidates = self.metadata.sindex.query(geometry)
+        bounds = index["footprint_bounds"][candidates]
+        certain = index["is_box"][candidates] | ((bounds[:, 0] >= west) & (bounds[:, 1] >= south) & (bounds[:, 2] <= east) & (bounds[:, 3] <= north))
+        edge = candidates[~certain]
+        edge = edge[shapely.intersects(geometry, self.metadata.geometry.to_numpy()[edge])]
+        return np.concatenate([candidates[certain], edge])
+
+    def query_scenes(self, geometry=None, start=None, end=None, algorithm=None, sitename=None, offset=0, limit=QUERY_DEFAULT_LIMIT):
+        """FeatureCollection (as a JSON string) of one page of the scenes matching a query, by datetime
+
+        `geometry` is a shapely geometry the footprints must intersect
+        (answered by the STRtree), `start` and `end` inclusive
+        numpy.datetime64 bounds. The collection carries `numberMatched` and
+        `numberReturned`, and `next` (the offset of the next page) when
+        there are more.
+        """
+
+        index = self._scene_index
+
+        if geometry is not None:
+            positions = self._intersecting(geometry)
+            if start is not None or end is not None:
+                datetimes = index["datetimes"][positions]
+                keep = ~np.isnat(datetimes)
+                if start is not None:
+                    keep &= datetimes >= start
+                if end is not None:
+                    keep &= datetimes <= end
+                positions = positions[keep]
+            # back into datetime order; a mask over all rows is cheaper than sorting large results
+            in_order = np.zeros(len(index["order"]), dtype=bool)
+            in_order[index["rank"][positions]] = True
+            positions = index["order"][in_order]
+        elif start is not None or end is not None:
+            sorted_datetimes = index["sorted_datetimes"]
+            low = np.searchsorted(sorted_datetimes, start, "left") if start is not None else 0
+            # NaT sorts last and never matches
+            high = np.searchsorted(sorted_datetimes, end, "right") if end is not None else len(sorted_datetimes) - np.isnat(sorted_datetimes).sum()
+            positions = index["order"][low:high]
+        else:
+            positions = index["order"]
+
+        for value, codes, lookup in ((algorithm, "algorithm_codes", "algorithms"), (sitename, "site_codes", "sites")):
+            if value is not None:
+                positions = positions[index[codes][positions] == index[lookup].get(value, -1)]
+
+        page = positions[offset:offset + limit]
+        geometries_json = shapely.to_geojson(self.metadata.geometry.to_numpy()[page])
+        properties_json = self._properties_json
+
+        features = ",".join(
+            f'{{"type":"Feature","id":"{position}","properties":{properties_json[position]},"geometry":{geometry_json}}}'
+            for position, geometry_json in zip(page.tolist(), geometries_json.tolist()))
+        next_page = f',"next":{offset + limit}' if offset + limit < len(positions) else ""
+
+        return (f'{{"type":"FeatureCollection","numberMatched":{len(positions)},"numberReturned":{len(page)}{next_page},'
+                f'"features":[{features}]}}')
+
+    @cached_property
+    def _properties_json(self):
+        """Per row GeoJSON `properties`, serialized once"""
+
+        return [json.dumps(record, default=str) for record in self._records]
+
+    def _geometries_for_zoom(self, zoom):
+        """Footprints simplified to about half a screen pixel at `zoom`, cached per level"""
+
+        zoom = max(0, int(zoom))
+        if zoom > MAX_SIMPLIFIED_ZOOM:
+            zoom = MAX_SIMPLIFIED_ZOOM + 1
+
+        geometries = self._simplified_geometries.get(zoom)
+        if geometries is None:
+            geometries = self.metadata.geometry.to_numpy()
+            if zoom <= MAX_SIMPLIFIED_ZOOM:
+                # web mercator tiles are 256px wide and span 360 degrees at zoom 0
+                tolerance = 360 / (256 * 2 ** zoom) / 2
+                geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+            self._simplified_geometries[zoom] = geometries
+
+        return geometries
+
+    def bboxes_in_view(self, west, south, east, north, zoom):
+        """FeatureCollection (as a JSON string) of footprints intersecting the view
+
+        Uses the GeoDataFrame's STRtree (`sindex`), so cost scales with the
+        number of footprints in view rather than the catalog size. Feature ids
+        are row positions, as with `GeoDataFrame.__geo_interface__`.
+        """
+
+        positions = self.metadata.sindex.query(box(west, south, east, north), predicate="intersects")
+        positions.sort()
+
+        geometries_json = shapely.to_geojson(self._geometries_for_zoom(zoom)[positions])
+        properties_json = self._properties_json
+
+        features = ",".join(
+            f'{{"type":"Feature","id":"{position}","properties":{properties_json[position]},"geometry":{geometry_json}}}'
+            for position, geometry_json in zip(positions.tolist(), geometries_json.tolist()))
+
+        return f'{{"type":"FeatureCollection","features":[{features}]}}'
+
+    def site_options(self, algorithm):
+        """Dropdown options for the sites imaged for `algorithm`"""
+
+        return self._site_options.get(algorithm, [])
+
+    def date_options(self, algorithm, sitename):
+        """Date sorted dropdown options for a site; `value` is the scene uuid"""
+
+        return self._date_options.get((algorithm, sitename), [])
+
+    def scene(self, uuid):
+        """Metadata row for a scene uuid, or None if the uuid is unknown"""
+
+        return self.by_uuid.get(uuid)
+
+    def site_view(self, sitename):
+        """(webmap_center, webmap_zoom) for a site, or None if the site is unknown"""
+
+        return self._site_view.get(sitename)
+
+    def latest_scene(self, sitename):
+        """Metadata row of a site's most recent scene, or None if the site is unknown"""
+
+        return self._latest_scene.get(sitename)
+
+    def scene_bounds(self, uuid):
+        """(west, south, east, north) of a scene's footprint, or None if the uuid is unknown"""
+
+        position = self._positions.get(uuid)
+        if position is None:
+            return None
+        return tuple(self._scene_index["footprint_bounds"][position].tolist())
+
+
+def _normalise_datetime(value):
+    """Format DATETIME the way `gpd.read_file(...).astype(str)` does
+
+    Datetimes are kept as strings (avoids handling timestamps) but in the
+    same "YYYY-MM-DD HH:MM:SS" form the dropdown labels have always used.
+    """
+
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+    return str(parsed.date()) if len(value) == 10 else str(parsed)
+
+
+def parse_site_feature(feature):
+    """Flatten one sites.geojson feature into a metadata row"""
+
+    row = {key.lower(): value for key, value in feature["properties"].items()}
+
+    row["datetime"] = _normalise_datetime(row.get("datetime"))
+
+    # convert "webmap_centre" from string to list; "[lat, lon]" is valid JSON and json is much faster
+    if isinstance(row.get("webmap_center"), str):
+        try:
+            row["webmap_center"] = json.loads(row["webmap_center"])
+        except ValueError:
+            row["webmap_center"] = ast.literal_eval(row["webmap_center"])
+
+    row["geometry"] = shape(feature["geometry"]) if feature.get("geometry") else None
+
+    return row
+
+
+def load_site_metadata(raw, parsed_features=None):
+    """Parse sites.geojson bytes into the imagery_metadata GeoDataFrame
+
+    `parsed_features` maps a digest of each feature's repr to its parsed row
+    from a previous load. Unchanged features are reused instead of being
+    parsed again. Returns the GeoDataFrame and the mapping for the next
+    incremental load.
+    """
+
+    parsed_features = parsed_features or {}
+    feature_collection = json.loads(raw)
+
+    rows = []
+    next_parsed_features = {}
+    for feature in feature_collection["features"]:
+        # repr follows the file's key order; a reordered feature is just parsed again
+        digest = hashlib.blake2b(repr(feature).encode(), digest_size=16).digest()
+
+        row = parsed_features.get(digest)
+        if row is None:
+            row = parse_site_feature(feature)
+
+        next_parsed_features[digest] = row
+        rows.append(row)
+
+    crs = feature_collection.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+    imagery_metadata = gpd.GeoDataFrame(rows, geometry="geometry", crs=crs)
+
+    return imagery_metadata, next_parsed_features
+
+
+def _snapshot_path(snapshot_directory, digest):
+    return os.path.join(snapshot_directory, digest + ".parquet")
+
+
+def read_catalog_snapshot(snapshot_directory, digest):
+    """SiteCatalog from the snapshot of a source file digest, or None if there is none"""
+
+    parquet_path = _snapshot_path(snapshot_directory, digest)
+    if not os.path.exists(parquet_path):
+        return None
+
+    imagery_metadata = gpd.read_parquet(parquet_path, memory_map=True)
+    # list columns come back as numpy arrays
+    imagery_metadata["webmap_center"] = imagery_metadata["webmap_center"].map(lambda center: center.tolist())
+
+    return SiteCatalog(imagery_metadata, version=digest)
+
+
+def write_catalog_snapshot(snapshot_directory, site_catalog, keep=2):
+    """Persist a catalog keyed on its source digest, keeping the newest `keep` snapshots"""
+
+    os.makedirs(snapshot_directory, exist_ok=True)
+    parquet_path = _snapshot_path(snapshot_directory, site_catalog.version)
+
+    # write then rename so a concurrently starting worker never maps a partial file;
+    # temporary names are per process as several workers may snapshot the same new file at once
+    temporary_path = f"{parquet_path}.{os.getpid()}.tmp"
+    site_catalog.metadata.to_parquet(temporary_path)
+    os.replace(temporary_path, parquet_path)
+
+    snapshots = sorted(
+        (entry for entry in os.scandir(snapshot_directory) if entry.name.endswith(".parquet")),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in snapshots[keep:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class CatalogWatcher:
+    """Keeps `current` in sync with a sites.geojson file
+
+    `check()` compares mtime and size first and only hashes the file when
+    they moved, so polling is a single `os.stat` while nothing changes. A
+    changed hash rebuilds the catalog, reusing rows of unchanged features.
+
+    With a `snapshot_directory`, catalogs are loaded from and saved to
+    snapshots keyed on the file's sha256.
+    """
+
+    def __init__(self, path, poll_seconds=30, snapshot_directory=None):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.snapshot_directory = snapshot_directory
+        self.current = None
+
+        self._stat = None
+        self._parsed_features = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Build the catalog synchronously; used at startup before serving"""
+
+        with self._lock:
+            stat = os.stat(self.path)
+            with open(self.path, "rb") as f:
+                raw = f.read()
+
+            self._swap(raw, hashlib.sha256(raw).hexdigest(), stat)
+
+        return self.current
+
+    def check(self):
+        """Reload if sites.geojson changed; returns True when a new catalog was swapped in"""
+
+        with self._lock:
+            stat = os.stat(self.path)
+            if self._stat and (stat.st_mtime_ns, stat.st_size) == (self._stat.st_mtime_ns, self._stat.st_size):
+                return False
+
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            digest = hashlib.sha256(raw).hexdigest()
+
+            if self.current is not None and digest == self.current.version:
+                # touched but not modified
+                self._stat = stat
+                return False
+
+            self._swap(raw, digest, stat)
+            return True
+
+    def _swap(self, raw, digest, stat):
+        site_catalog = None
+        source = "snapshot"
+
+        # a snapshot has no per-feature digests, so only use it when there is nothing to diff against
+        if self.snapshot_directory and not self._parsed_features:
+            try:
+                site_catalog = read_catalog_snapshot(self.snapshot_directory, digest)
+            except Exception as error:
+                log.error("Reading catalog snapshot %s failed, parsing %s: %r", digest[:12], self.path, error)
+
+        if site_catalog is None:
+            source = self.path
+            imagery_metadata, self._parsed_features = load_site_metadata(raw, self._parsed_features)
+            site_catalog = SiteCatalog(imagery_metadata, version=digest)
+
+            if self.snapshot_directory:
+                try:
+                    write_catalog_snapshot(self.snapshot_directory, site_catalog)
+                except Exception as error:
+                    log.error("Writing catalog snapshot %s failed: %r", digest[:12], error)
+
+        # build the data page table and scene query indexes before the catalog is served, not on the first request
+        site_catalog.table
+        site_catalog._scene_index
+        site_catalog.metadata.sindex
+
+        # single reference assignment; readers holding the old catalog keep a consistent view
+        self.current = site_catalog
+        self._stat = stat
+
+        log.info("Site metadata loaded from %s: %d scenes, version %s", source, len(site_catalog), digest[:12])
+
+    def start(self):
+        """Poll for changes in a daemon thread"""
+
+        if self.poll_seconds <= 0 or (self._thread and self._thread.is_alive()):
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="catalog-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling; returns once an in-progress reload has finished"""
+
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.check()
+            except Exception as error:
+                # keep serving the last good catalog; a partially written file is retried next poll
+                log.error("Reloading site metadata from %s failed: %r", self.path, error)
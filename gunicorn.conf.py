@@ -0,0 +1,39 @@
+"""gunicorn settings for serving the web map; see wsgi.py
+
+Worker and thread counts can be overridden with WEB_WORKERS and WEB_THREADS.
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ['PORT']}"
+
+# import the app once in the master; workers are forked from it and share the catalog copy-on-write
+preload_app = True
+
+# one process per core for tile rendering and geopandas work; GDAL reads release the GIL, and
+# threads keep Dash long-callback polls and static files from queueing behind a slow tile
+workers = int(os.environ.get("WEB_WORKERS", "0")) or max(2, os.cpu_count() or 1)
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "4"))
+
+timeout = 120
+graceful_timeout = 30
+# recycle workers now and then to bound memory growth in GDAL and geopandas
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def when_ready(server):
+    import app
+
+    # the master only supervises; each worker polls sites.geojson itself
+    app.catalog_watcher.stop()
+    # keep the garbage collector from touching (and so copying) the preloaded objects in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+
+    app.catalog_watcher.start()
@@ -0,0 +1,183 @@
+"""HTTP caching for the file and tile routes
+
+Every cached route has a `CachePolicy`: the Cache-Control header to send
+and whether the body may be compressed. Responses carry strong ETags and
+Last-Modified so browsers and the reverse proxy revalidate with a 304
+instead of downloading the body again.
+
+Compressed bodies come from precompressed sidecar files (`<file>.br`,
+`<file>.gz`) when they exist and are at least as new as the file, and are
+otherwise gzipped on the fly.
+
+Policies can be overridden per route with `HTTP_CACHE_CONTROL_<ROUTE>`,
+e.g. `HTTP_CACHE_CONTROL_ML_RESULTS="private, max-age=60"`.
+
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import zlib
+from collections import namedtuple
+
+from flask import Response, abort, request, send_file
+from werkzeug.security import safe_join
+
+CachePolicy = namedtuple("CachePolicy", ["cache_control", "compress"])
+
+# tile pyramids never change under a given url
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+DEFAULT_POLICIES = {
+    # pre-rendered and rendered imagery tiles; PNG is already compressed
+    "tiles": CachePolicy(IMMUTABLE, compress=False),
+    # result files can be rewritten in place by a re-run, so always revalidate
+    "ml_results": CachePolicy("no-cache", compress=True),
+    "ml_result_tiles": CachePolicy("public, max-age=3600", compress=True),
+    # depends on the catalog version, which changes on reload
+    "imagery_bboxes": CachePolicy("no-cache", compress=True),
+    "scenes": CachePolicy("no-cache", compress=True),
+    "css": CachePolicy("public, max-age=3600", compress=True),
+}
+
+# bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+# (Content-Encoding, sidecar suffix) in order of preference
+SIDECAR_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def load_policies(environ=os.environ):
+    """DEFAULT_POLICIES with Cache-Control overrides from the environment applied"""
+
+    return {
+        name: policy._replace(cache_control=environ.get(f"HTTP_CACHE_CONTROL_{name.upper()}", policy.cache_control))
+        for name, policy in DEFAULT_POLICIES.items()
+    }
+
+
+def _accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def _finish(response, policy):
+    response.headers["Cache-Control"] = policy.cache_control
+    if policy.compress:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def _gzip_chunks(chunks):
+    """gzip compress a stream of chunks as they come"""
+
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _file_chunks(path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def _gzip_file_chunks(path):
+    """Stream a file gzip compressed without holding it in memory"""
+
+    return _gzip_chunks(_file_chunks(path))
+
+
+def content_etag(*parts):
+    """Strong ETag value derived from bytes/str parts"""
+
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+    return digest.hexdigest()
+
+
+def not_modified(etag, policy):
+    """A 304 response if the request already holds `etag`, else None
+
+    Lets computed routes skip building a body the client has.
+    """
+
+    for candidate in (etag, f"{etag}-gzip"):
+        if request.if_none_match.contains(candidate):
+            response = Response(status=304)
+            response.set_etag(candidate)
+            return _finish(response, policy)
+
+    return None
+
+
+def send_file_cached(directory, filename, policy, mimetype=None):
+    """send_from_directory() with the route's caching policy applied"""
+
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    stat = os.stat(path)
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    # byte ranges are of the file itself, so range requests are answered uncompressed
+    if policy.compress and not request.range:
+        for encoding, suffix in SIDECAR_ENCODINGS:
+            sidecar_path = path + suffix
+            if _accepts(encoding) and os.path.isfile(sidecar_path) and os.path.getmtime(sidecar_path) >= stat.st_mtime:
+                response = send_file(sidecar_path, mimetype=mimetype, etag=f"{etag}-{encoding}",
+                                     last_modified=stat.st_mtime, conditional=True)
+                response.headers["Content-Encoding"] = encoding
+                return _finish(response, policy)
+
+        if _accepts("gzip") and stat.st_size >= MIN_COMPRESS_BYTES:
+            response = Response(_gzip_file_chunks(path), mimetype=mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(f"{etag}-gzip")
+            response.last_modified = stat.st_mtime
+            return _finish(response.make_conditional(request), policy)
+
+    response = send_file(path, mimetype=mimetype, etag=etag, last_modified=stat.st_mtime, conditional=True)
+    return _finish(response, policy)
+
+
+def send_bytes_cached(data, mimetype, policy, etag=None):
+    """Response for an in-memory body (rendered tiles, query results) with the route's caching policy"""
+
+    etag = etag or content_etag(data)
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    response = Response(mimetype=mimetype)
+    if policy.compress and len(data) >= MIN_COMPRESS_BYTES and _accepts("gzip"):
+        data = gzip.compress(data, compresslevel=5)
+        response.headers["Content-Encoding"] = "gzip"
+        etag = f"{etag}-gzip"
+
+    response.set_data(data)
+    response.set_etag(etag)
+    return _finish(response.make_conditional(request), policy)
+
+
+def send_stream_cached(chunks, mimetype, policy, etag):
+    """Streamed response for a body generated in chunks (filtered result files) with the route's caching policy
+
+    The body is never held in memory, so the caller computes `etag` from what
+    the body is derived from and answers revalidations with not_modified().
+    """
+
+    compress = policy.compress and _accepts("gzip")
+    response = Response(_gzip_chunks(chunks) if compress else chunks, mimetype=mimetype)
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+        etag = f"{etag}-gzip"
+
+    response.set_etag(etag)
+    return _finish(response, policy)
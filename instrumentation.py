@@ -0,0 +1,254 @@
+"""Logging and request metrics
+
+`configure_logging()` sets up the standard `logging` module with one line
+per record in logfmt (`time=... level=... logger=... msg="..."`), plus any
+`extra=` fields of the record, so logs stay greppable and machine readable.
+Modules log through `logging.getLogger(__name__)` with %-style arguments,
+which are only formatted when the record is emitted.
+
+`instrument_flask(server)` times every Flask request, including every Dash
+callback (labelled by the callback's outputs, since all callbacks share the
+`_dash-update-component` route), and records:
+
+- web_request_duration_seconds: latency histogram per endpoint
+- web_response_bytes: response size histogram per endpoint
+- web_request_errors_total: requests that raised or answered 5xx, per endpoint
+
+`timed(metrics, name)` records the same latency and error metrics for any
+function.
+
+Each process keeps its own metrics and snapshots them to a file in
+`directory` every few seconds; `prometheus_text()` sums the snapshots of
+every process (gunicorn workers, long-callback processes), so a scrape of
+any worker at /app/WEB/metrics sees the whole server.
+
+"""
+
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, request
+
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS_BYTES = (1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20, 100 << 20)
+SNAPSHOT_SECONDS = 5
+
+METRICS = {
+    "web_request_duration_seconds": ("histogram", "Request latency", LATENCY_BUCKETS_SECONDS),
+    "web_response_bytes": ("histogram", "Response size", SIZE_BUCKETS_BYTES),
+    "web_request_errors_total": ("counter", "Requests that raised or answered with a 5xx status", None),
+}
+
+# standard LogRecord attributes; anything else on a record came from `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class LogfmtFormatter(logging.Formatter):
+    """key=value lines: time, level, logger, msg, then the record's extra fields"""
+
+    def format(self, record):
+        fields = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+
+        return " ".join(f"{key}={_logfmt_value(value)}" for key, value in fields.items())
+
+
+def _logfmt_value(value):
+    value = str(value)
+    if not value or any(character in value for character in ' ="\n'):
+        return json.dumps(value)
+    return value
+
+
+def configure_logging(debug=False):
+    """Log to stderr at DEBUG with `debug`, else at LOG_LEVEL (default INFO)"""
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(LogfmtFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.DEBUG if debug else os.environ.get("LOG_LEVEL", "INFO").upper())
+    # werkzeug logs every request of the development server at INFO
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+
+class Metrics:
+    """Histograms and counters of one process, snapshotted to `directory` for the other processes"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # (metric name, label value) -> [bucket counts..., sum, count] for histograms, [count] for counters
+        self._values = {}
+        self._lock = threading.Lock()
+        self._changed = False
+        self._pid = None
+        self._path = None
+
+    def observe(self, name, endpoint, value):
+        kind, _, buckets = METRICS[name]
+        with self._lock:
+            values = self._values.get((name, endpoint))
+            if values is None:
+                values = self._values[(name, endpoint)] = [0] * (len(buckets) + 2 if kind == "histogram" else 1)
+            if kind == "histogram":
+                # the count of the smallest bucket holding the value; cumulated on export
+                index = bisect.bisect_left(buckets, value)
+                if index < len(buckets):
+                    values[index] += 1
+                values[-2] += value
+                values[-1] += 1
+            else:
+                values[0] += value
+            self._changed = True
+
+        self._ensure_snapshots()
+
+    def _ensure_snapshots(self):
+        # started lazily, so each forked process (gunicorn worker) snapshots under its own pid
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    # the start time keeps a later process reusing the pid from overwriting this one's counts
+                    self._path = os.path.join(self.directory, f"{self._pid}-{time.time_ns()}.json")
+                    threading.Thread(target=self._snapshot_periodically, name="metrics-snapshot", daemon=True).start()
+
+    def _snapshot_periodically(self):
+        while True:
+            time.sleep(SNAPSHOT_SECONDS)
+            try:
+                self.snapshot()
+            except OSError as error:
+                logging.getLogger(__name__).warning("Writing metrics snapshot failed: %r", error)
+
+    def snapshot(self):
+        """Write this process's metrics to its file, if they changed"""
+
+        with self._lock:
+            if not self._changed or self._pid != os.getpid():
+                return
+            values = [[name, endpoint, list(counts)] for (name, endpoint), counts in self._values.items()]
+            path = self._path
+            self._changed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(values, f)
+        os.replace(f"{path}.tmp", path)
+
+    def totals(self):
+        """{(metric name, endpoint): summed values} over the snapshots of every process"""
+
+        self.snapshot()
+        totals = {}
+        for entry in os.scandir(self.directory) if os.path.isdir(self.directory) else ():
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    values = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, endpoint, counts in values:
+                total = totals.setdefault((name, endpoint), [0] * len(counts))
+                for index, count in enumerate(counts):
+                    total[index] += count
+        return totals
+
+    def prometheus_text(self):
+        """All metrics in the Prometheus text exposition format"""
+
+        totals = self.totals()
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for (metric, endpoint), values in sorted(totals.items()):
+                if metric != name:
+                    continue
+                label = f'endpoint="{_escape_label(endpoint)}"'
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(buckets, values):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {values[-1]}')
+                    lines.append(f"{name}_sum{{{label}}} {values[-2]}")
+                    lines.append(f"{name}_count{{{label}}} {values[-1]}")
+                else:
+                    lines.append(f"{name}{{{label}}} {values[0]}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _endpoint_label():
+    """Route rule of the current request; Dash callbacks by their outputs"""
+
+    if request.path.endswith("/_dash-update-component"):
+        body = request.get_json(silent=True) or {}
+        return f"callback:{body.get('output', '?')}"
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def instrument_flask(server, metrics):
+    """Record latency, response size and errors of every request to `server`"""
+
+    @server.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @server.after_request
+    def record_response(response):
+        g.request_recorded = True
+        endpoint = _endpoint_label()
+        metrics.observe("web_request_duration_seconds", endpoint, time.perf_counter() - g.request_started)
+        metrics.observe("web_response_bytes", endpoint, response.content_length or 0)
+        if response.status_code >= 500:
+            metrics.observe("web_request_errors_total", endpoint, 1)
+        return response
+
+    @server.teardown_request
+    def record_exception(error):
+        # exceptions propagated in debug mode skip after_request
+        if error is not None and "request_started" in g and "request_recorded" not in g:
+            endpoint = _endpoint_label()
+            metrics.observe("web_request_duration_seconds", endpoint, time.perf_counter() - g.request_started)
+            metrics.observe("web_request_errors_total", endpoint, 1)
+
+
+def timed(metrics, name):
+    """Decorator recording a function's latency and exceptions under endpoint `name`
+
+    The snapshot is written after every call, so calls in short-lived
+    processes (Dash long callbacks) are counted too.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                metrics.observe("web_request_errors_total", name, 1)
+                raise
+            finally:
+                metrics.observe("web_request_duration_seconds", name, time.perf_counter() - started)
+                metrics.snapshot()
+        return wrapper
+
+    return decorator
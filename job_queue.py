@@ -0,0 +1,343 @@
+"""Persistent queue and scheduler for ML jobs
+
+Clicking "Execute ML algorithm" submits a job to a SQLite backed queue
+instead of starting work straight away. A `Scheduler` (one per host, it runs
+in the ML pool server) claims queued jobs while they fit in a CPU and memory
+budget, so however many users click at once the machine runs a bounded
+amount of ML work and the web server keeps its share of the CPU.
+
+Claim order is fair share first: the user (browser session) with the fewest
+running jobs goes next, then higher `priority`, then the oldest job. The
+queue is a file on /fs, so queued jobs survive a restart; jobs that were
+running when the scheduler stopped are queued again when it starts.
+
+Submitting a job with the `key` of a queued or running job returns that
+job instead of adding a duplicate, and subscribes the submitting user to
+it. A user's cancel unsubscribes them; the job itself is cancelled once no
+subscriber is left.
+
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+# cancel requested while running; the scheduler stops the job
+CANCELLING = "cancelling"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATES = (QUEUED, RUNNING, CANCELLING)
+
+# larger numbers are claimed first
+PRIORITY_BACKGROUND = -10
+PRIORITY_NORMAL = 0
+
+# finished jobs are kept this long for the status endpoint
+FINISHED_JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    user TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    cpus REAL NOT NULL DEFAULT 1,
+    memory_mb REAL NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    progress_done INTEGER,
+    progress_total INTEGER,
+    result TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user);
+-- users waiting for a job: its submitter and whoever submitted the same key while it was active
+CREATE TABLE IF NOT EXISTS job_subscribers (
+    job_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    PRIMARY KEY (job_id, user)
+);
+CREATE INDEX IF NOT EXISTS job_subscribers_user ON job_subscribers (user);
+"""
+
+# columns returned by get()/jobs(); params and result are decoded from JSON
+JOB_COLUMNS = ("id", "key", "kind", "params", "user", "priority", "cpus", "memory_mb", "state",
+               "progress_done", "progress_total", "result", "submitted_at", "started_at", "finished_at")
+
+
+def _row_to_job(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+class JobQueue:
+    """Jobs table in a SQLite file shared by every process on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        connection = self._connection()
+        # readers (status polls) don't block the writer and vice versa
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connection(self):
+        """Connection for this thread; sqlite connections must not cross threads or forks"""
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            # autocommit; write transactions are opened explicitly with BEGIN IMMEDIATE
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction; takes the database write lock up front so check-then-update is atomic"""
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _select(self, where, parameters=(), suffix=""):
+        columns = ", ".join(JOB_COLUMNS)
+        rows = self._connection().execute(f"SELECT {columns} FROM jobs WHERE {where} {suffix}", parameters).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def submit(self, kind, params, user=None, key=None, priority=PRIORITY_NORMAL, cpus=1, memory_mb=0):
+        """Queue a job and return its id, or the id of the active job already queued under `key`
+
+        `user` is subscribed to the job either way.
+        """
+
+        with self._transaction() as connection:
+            existing = None
+            if key is not None:
+                existing = connection.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND state IN (?, ?, ?)", (key, *ACTIVE_STATES)).fetchone()
+
+            if existing:
+                job_id = existing[0]
+            else:
+                job_id = uuid.uuid4().hex
+                connection.execute(
+                    "INSERT INTO jobs (id, key, kind, params, user, priority, cpus, memory_mb, state, submitted_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, key, kind, json.dumps(params), user, priority, cpus, memory_mb, QUEUED, time.time()))
+
+            if user is not None:
+                connection.execute("INSERT OR IGNORE INTO job_subscribers (job_id, user) VALUES (?, ?)", (job_id, user))
+
+        return job_id
+
+    def get(self, job_id):
+        """Job as a dict, or None if there is no such job"""
+
+        jobs = self._select("id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def jobs(self, user=None, limit=100):
+        """Most recently submitted jobs, optionally those a user submitted or subscribed to"""
+
+        if user is None:
+            return self._select("1", suffix=f"ORDER BY submitted_at DESC LIMIT {int(limit)}")
+        return self._select("user = ? OR id IN (SELECT job_id FROM job_subscribers WHERE user = ?)", (user, user),
+                            suffix=f"ORDER BY submitted_at DESC LIMIT {int(limit)}")
+
+    def queue_position(self, job):
+        """Number of queued jobs that would be claimed before a queued `job` (ignoring fair share)"""
+
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ? AND (priority > ? OR (priority = ? AND submitted_at < ?))",
+            (QUEUED, job["priority"], job["priority"], job["submitted_at"])).fetchone()[0]
+
+    def cancel(self, job_id=None, user=None):
+        """Cancel a job, or unsubscribe a user from their active jobs; returns how many jobs were cancelled
+
+        A user's jobs are cancelled only once no other user is subscribed to
+        them. Queued jobs are cancelled at once; running jobs are marked and
+        stopped by the scheduler.
+        """
+
+        with self._transaction() as connection:
+            if job_id is not None:
+                where, parameters = "id = ?", (job_id,)
+            else:
+                subscribed = [row[0] for row in connection.execute(
+                    "SELECT job_id FROM job_subscribers WHERE user = ? AND job_id IN (SELECT id FROM jobs WHERE state IN (?, ?, ?))",
+                    (user, *ACTIVE_STATES))]
+                connection.executemany("DELETE FROM job_subscribers WHERE job_id = ? AND user = ?", [(id, user) for id in subscribed])
+                # jobs the user submitted or was subscribed to that nobody is waiting for any more
+                placeholders = ",".join("?" * len(subscribed))
+                where = f"(user = ? OR id IN ({placeholders})) AND id NOT IN (SELECT job_id FROM job_subscribers)"
+                parameters = (user, *subscribed)
+            queued = connection.execute(
+                f"UPDATE jobs SET state = ?, finished_at = ? WHERE {where} AND state = ?",
+                (CANCELLED, time.time(), *parameters, QUEUED)).rowcount
+            running = connection.execute(
+                f"UPDATE jobs SET state = ? WHERE {where} AND state = ?", (CANCELLING, *parameters, RUNNING)).rowcount
+
+        return queued + running
+
+    def claim(self, cpu_budget, memory_budget_mb):
+        """Mark the next job running and return it, or None if nothing is queued or it doesn't fit the budget
+
+        A job larger than the whole budget still runs, alone.
+        """
+
+        with self._transaction() as connection:
+            running_cpus, running_memory_mb, running_count = connection.execute(
+                "SELECT COALESCE(SUM(cpus), 0), COALESCE(SUM(memory_mb), 0), COUNT(*) FROM jobs WHERE state IN (?, ?)",
+                (RUNNING, CANCELLING)).fetchone()
+
+            columns = ", ".join(JOB_COLUMNS)
+            row = connection.execute(
+                f"SELECT {columns} FROM jobs AS queued WHERE state = ? ORDER BY"
+                # fair share: users with fewer running jobs first
+                " (SELECT COUNT(*) FROM jobs AS running WHERE running.user IS queued.user AND running.state IN (?, ?)),"
+                " priority DESC, submitted_at LIMIT 1",
+                (QUEUED, RUNNING, CANCELLING)).fetchone()
+
+            job = _row_to_job(row) if row else None
+            fits = job is not None and (running_count == 0 or (
+                running_cpus + job["cpus"] <= cpu_budget and running_memory_mb + job["memory_mb"] <= memory_budget_mb))
+
+            if fits:
+                job["state"], job["started_at"] = RUNNING, time.time()
+                connection.execute("UPDATE jobs SET state = ?, started_at = ? WHERE id = ?", (RUNNING, job["started_at"], job["id"]))
+
+        return job if fits else None
+
+    def update_progress(self, job_id, done, total):
+        self._connection().execute("UPDATE jobs SET progress_done = ?, progress_total = ? WHERE id = ?", (done, total, job_id))
+
+    def finish(self, job_id, result):
+        """Record a job's subprocess.run-like result; a job whose cancel was requested ends cancelled"""
+
+        with self._transaction() as connection:
+            state = connection.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            if state == CANCELLING:
+                state = CANCELLED
+            else:
+                state = SUCCEEDED if result["returncode"] == 0 else FAILED
+            connection.execute("UPDATE jobs SET state = ?, result = ?, finished_at = ? WHERE id = ?",
+                               (state, json.dumps(result), time.time(), job_id))
+
+    def cancelling(self):
+        """Ids of running jobs whose cancel has been requested"""
+
+        return [row[0] for row in self._connection().execute("SELECT id FROM jobs WHERE state = ?", (CANCELLING,))]
+
+    def requeue_interrupted(self):
+        """Queue again the jobs left running by a scheduler that stopped; returns how many"""
+
+        with self._transaction() as connection:
+            cancelled = connection.execute("UPDATE jobs SET state = ?, finished_at = ? WHERE state = ?",
+                                           (CANCELLED, time.time(), CANCELLING)).rowcount
+            requeued = connection.execute(
+                "UPDATE jobs SET state = ?, started_at = NULL, progress_done = NULL, progress_total = NULL WHERE state = ?",
+                (QUEUED, RUNNING)).rowcount
+
+        if requeued or cancelled:
+            log.info("ML job queue: %d interrupted jobs queued again, %d cancelled", requeued, cancelled)
+        return requeued
+
+    def prune(self, older_than_seconds=FINISHED_JOB_RETENTION_SECONDS):
+        placeholders = ",".join("?" * len(ACTIVE_STATES))
+        connection = self._connection()
+        connection.execute(f"DELETE FROM jobs WHERE state NOT IN ({placeholders}) AND finished_at < ?",
+                           (*ACTIVE_STATES, time.time() - older_than_seconds))
+        connection.execute("DELETE FROM job_subscribers WHERE job_id NOT IN (SELECT id FROM jobs)")
+
+
+class Scheduler:
+    """Claims jobs from a JobQueue within a budget and runs each on its own thread
+
+    `runners` maps a job kind to `runner(params, progress, cancelled)`, which
+    returns a subprocess.run-like result dict; `progress(done, total)`
+    reports progress and `cancelled()` turns True once a cancel is requested.
+    """
+
+    def __init__(self, job_queue, runners, cpu_budget, memory_budget_mb, poll_seconds=1):
+        self.job_queue = job_queue
+        self.runners = runners
+        self.cpu_budget = cpu_budget
+        self.memory_budget_mb = memory_budget_mb
+        self.poll_seconds = poll_seconds
+
+        # job id -> event set when the job's cancel is requested
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Requeue interrupted jobs and start scheduling in a daemon thread"""
+
+        if self._thread and self._thread.is_alive():
+            return
+
+        self.job_queue.requeue_interrupted()
+        self.job_queue.prune()
+        self._thread = threading.Thread(target=self._run, name="ml-job-scheduler", daemon=True)
+        self._thread.start()
+        log.info("ML job scheduler started: budget %s CPUs, %.0f MB", self.cpu_budget, self.memory_budget_mb)
+
+    def _run(self):
+        while True:
+            try:
+                for job_id in self.job_queue.cancelling():
+                    with self._lock:
+                        event = self._cancel_events.get(job_id)
+                    if event:
+                        event.set()
+
+                while (job := self.job_queue.claim(self.cpu_budget, self.memory_budget_mb)) is not None:
+                    with self._lock:
+                        self._cancel_events[job["id"]] = threading.Event()
+                    threading.Thread(target=self._run_job, args=(job,), name=f"ml-job-{job['id'][:8]}", daemon=True).start()
+            except Exception:
+                log.exception("ML job scheduler failed")
+
+            time.sleep(self.poll_seconds)
+
+    def _run_job(self, job):
+        with self._lock:
+            cancel_event = self._cancel_events[job["id"]]
+
+        try:
+            runner = self.runners[job["kind"]]
+            result = runner(job["params"],
+                            progress=lambda done, total: self.job_queue.update_progress(job["id"], done, total),
+                            cancelled=cancel_event.is_set)
+        except Exception:
+            result = {"returncode": 1, "stdout": "", "stderr": traceback.format_exc()}
+        finally:
+            with self._lock:
+                self._cancel_events.pop(job["id"], None)
+
+        self.job_queue.finish(job["id"], result)
@@ -0,0 +1,122 @@
+"""Memoized ML results
+
+A run is identified by what it was computed from: the algorithm, the
+location, the input scene uuids and the content hashes of the model file
+and the script. `ResultCache` maps that key to the result file in the ML
+results directory, so asking for the same run again returns the existing
+result instead of recomputing it:
+
+    key = result_cache.key("Change", location, [before_uuid, after_uuid], model_path, script_path)
+    filename = result_cache.get(key)
+    if filename is None:
+        ...  # run the algorithm, writing <results directory>/<filename>
+        result_cache.put(key, filename)
+
+The index lives in a diskcache, so all server workers, long-callback
+processes and the ML job scheduler share it. Identical concurrent requests
+are folded into one run by the job queue, which queues jobs under this key.
+When the result files outgrow `size_limit` the least recently used ones are
+deleted.
+
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import time
+
+import diskcache
+
+log = logging.getLogger(__name__)
+
+# files are hashed in chunks so large models are never read into memory at once
+HASH_CHUNK_BYTES = 1 << 20
+
+
+class ResultCache:
+    """Index of result files keyed on the inputs and versions they were computed from"""
+
+    def __init__(self, directory, results_directory, size_limit, on_evict=None):
+        # the index is tiny; results_directory holds the data and is bounded by size_limit
+        self._cache = diskcache.Cache(directory)
+        self._results_directory = results_directory
+        self._size_limit = size_limit
+        self._on_evict = on_evict
+
+    def file_digest(self, path):
+        """sha256 of a file, remembered for as long as its mtime and size are unchanged"""
+
+        stat = os.stat(path)
+        digest_key = ("file_digest", os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        digest = self._cache.get(digest_key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(HASH_CHUNK_BYTES):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            # drop the entry once the file has changed and been rehashed under a new key
+            self._cache.set(digest_key, digest, expire=30 * 24 * 60 * 60)
+        return digest
+
+    def key(self, algorithm, location, scene_uuids, model_path, script_path):
+        """Content-addressed key of a run"""
+
+        digest = hashlib.sha256()
+        for part in (algorithm, location, *scene_uuids, self.file_digest(model_path), self.file_digest(script_path)):
+            digest.update(str(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Filename of the memoized result for `key`, or None
+
+        Entries whose file has been removed from the results directory are dropped.
+        """
+
+        entry = self._cache.get(("result", key))
+        if entry is None:
+            return None
+
+        if not os.path.isfile(os.path.join(self._results_directory, entry["filename"])):
+            self._cache.delete(("result", key))
+            return None
+
+        self._cache.set(("result", key), {**entry, "last_used": time.time()})
+        return entry["filename"]
+
+    def put(self, key, filename):
+        """Record the result file of a finished run and evict past the size limit"""
+
+        size = os.path.getsize(os.path.join(self._results_directory, filename))
+        self._cache.set(("result", key), {"filename": filename, "size": size, "last_used": time.time()})
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Delete least recently used results until they fit in the size limit, except the result of `keep`"""
+
+        with diskcache.Lock(self._cache, "evict", expire=60):
+            entries = []
+            for cache_key in self._cache.iterkeys():
+                if cache_key[0] == "result":
+                    entry = self._cache.get(cache_key)
+                    if entry is not None:
+                        entries.append((entry["last_used"], cache_key, entry))
+
+            total_size = sum(entry["size"] for _, _, entry in entries)
+            for _, cache_key, entry in sorted(entries, key=lambda item: item[0]):
+                if total_size <= self._size_limit:
+                    break
+                # the result just recorded is about to be served
+                if cache_key[1] == keep:
+                    continue
+
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self._results_directory, entry["filename"]))
+                self._cache.delete(cache_key)
+                total_size -= entry["size"]
+                if self._on_evict:
+                    self._on_evict(entry["filename"])
+
+                log.info("ML result evicted from cache: %s", entry["filename"])
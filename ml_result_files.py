@@ -0,0 +1,312 @@
+"""ML result GeoJSON written incrementally and read back by bounding box
+
+A result is still one `<name>.geojson` FeatureCollection, so existing
+consumers (the map, geopandas, downloads) keep working, but it is laid out
+with one feature per line:
+
+    {"type":"FeatureCollection","features":[
+    {"type":"Feature",...},
+    {"type":"Feature",...}
+    ]}
+
+`ResultWriter` appends features as they are produced, a chunk at a time,
+and records the byte offset, length and bounds of each one in a sidecar
+`<name>.geojson.idx`. Neither side needs the whole collection in memory:
+`iter_features()` scans the index for a bounding box and reads only the
+byte ranges of the features in it, merging nearby ones into one read, and
+`stream_geojson()` / `stream_ndjson()` wrap them as a FeatureCollection or
+as newline-delimited GeoJSON for a streamed response.
+
+The index header holds the size and mtime of the result file it was written
+with; a result rewritten by anything else (or written before this layout)
+has no valid index and is read whole instead.
+
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"GJSONIDX"
+# magic, result file size, result file mtime_ns
+INDEX_HEADER = np.dtype([("magic", "S8"), ("size", "<u8"), ("mtime_ns", "<i8")])
+INDEX_RECORD = np.dtype([("offset", "<u8"), ("length", "<u4"),
+                         ("minx", "<f8"), ("miny", "<f8"), ("maxx", "<f8"), ("maxy", "<f8")])
+
+COLLECTION_START = b'{"type":"FeatureCollection","features":[\n'
+COLLECTION_END = b'\n]}\n'
+FEATURE_SEPARATOR = b',\n'
+
+# features converted to JSON at a time while writing
+WRITE_CHUNK_FEATURES = 10_000
+# features closer than this in the file are fetched with one read
+READ_GAP_BYTES = 64 * 1024
+# and at most this many bytes are read at once
+READ_SPAN_BYTES = 1 << 20
+# streamed responses are written in chunks of about this size
+STREAM_CHUNK_BYTES = 64 * 1024
+# indexes kept loaded per process
+MAX_LOADED_INDEXES = 8
+
+# (path, size, mtime_ns) -> index columns, least recently used first
+_loaded_indexes = OrderedDict()
+_loaded_indexes_lock = threading.Lock()
+
+
+class ResultWriter:
+    """Writes GeoDataFrames to `output` one chunk at a time
+
+    Use as a context manager; the result and its index replace any previous
+    version when the block exits without an exception, so the result url
+    never serves a partial file.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.count = 0
+        self._temporary_output = f"{output}.{os.getpid()}.tmp"
+        self._temporary_index = f"{output}{INDEX_SUFFIX}.{os.getpid()}.tmp"
+        self._file = None
+        self._index_file = None
+
+    def __enter__(self):
+        self._file = open(self._temporary_output, "wb")
+        self._index_file = open(self._temporary_index, "wb")
+        self._file.write(COLLECTION_START)
+        self._offset = len(COLLECTION_START)
+        # rewritten with the final size and mtime on close
+        self._index_file.write(np.zeros(1, INDEX_HEADER).tobytes())
+        return self
+
+    def write(self, frame):
+        """Append the features of `frame`, reprojected to EPSG:4326 as RFC 7946 GeoJSON is"""
+
+        if frame.crs is not None and not frame.crs.equals("EPSG:4326"):
+            frame = frame.to_crs("EPSG:4326")
+        for start in range(0, len(frame), WRITE_CHUNK_FEATURES):
+            self._write_chunk(frame.iloc[start:start + WRITE_CHUNK_FEATURES])
+
+    def _write_chunk(self, chunk):
+        geometries = chunk.geometry.to_numpy()
+        properties = chunk.drop(columns=chunk.geometry.name)
+        if len(properties.columns):
+            properties = properties.to_json(orient="records", lines=True, date_format="iso", double_precision=15).splitlines()
+        else:
+            properties = ["{}"] * len(chunk)
+
+        records = np.zeros(len(chunk), INDEX_RECORD)
+        bounds = shapely.bounds(geometries)
+        for name, column in zip(("minx", "miny", "maxx", "maxy"), bounds.T):
+            records[name] = column
+
+        features = [f'{{"type":"Feature","properties":{feature_properties},"geometry":{geometry or "null"}}}'.encode()
+                    for geometry, feature_properties in zip(shapely.to_geojson(geometries), properties)]
+
+        # every feature follows a separator except the first of the file
+        leading = FEATURE_SEPARATOR if self.count else b""
+        lengths = np.fromiter(map(len, features), np.uint64, len(features))
+        records["length"] = lengths
+        records["offset"] = self._offset + len(leading) + np.cumsum(lengths + len(FEATURE_SEPARATOR)) - lengths - len(FEATURE_SEPARATOR)
+
+        data = leading + FEATURE_SEPARATOR.join(features)
+        self._file.write(data)
+        self._offset += len(data)
+        self.count += len(features)
+        self._index_file.write(records.tobytes())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._file.close()
+            self._index_file.close()
+            for path in (self._temporary_output, self._temporary_index):
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+
+        self._file.write(COLLECTION_END)
+        self._file.close()
+
+        stat = os.stat(self._temporary_output)
+        header = np.array([(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns)], INDEX_HEADER)
+        self._index_file.seek(0)
+        self._index_file.write(header.tobytes())
+        self._index_file.close()
+
+        # the index first: a reader between the two renames sees a header that doesn't match and reads the file whole
+        os.replace(self._temporary_index, self.output + INDEX_SUFFIX)
+        os.replace(self._temporary_output, self.output)
+        return False
+
+
+def write_result(frame, output):
+    """Write a GeoDataFrame as a line-per-feature result with its index; returns the feature count"""
+
+    with ResultWriter(output) as writer:
+        writer.write(frame)
+    return writer.count
+
+
+def _load_index(path, stat):
+    """Index columns of the result at `path` as of `stat`, or None if it has no index for that version"""
+
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _loaded_indexes_lock:
+        index = _loaded_indexes.get(key)
+        if index is not None:
+            _loaded_indexes.move_to_end(key)
+            return index
+
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            header = np.frombuffer(f.read(INDEX_HEADER.itemsize), INDEX_HEADER)
+            if len(header) != 1 or header[0]["magic"] != INDEX_MAGIC \
+                    or header[0]["size"] != stat.st_size or header[0]["mtime_ns"] != stat.st_mtime_ns:
+                return None
+            records = np.fromfile(f, INDEX_RECORD)
+    except FileNotFoundError:
+        return None
+
+    # contiguous columns scan much faster than fields of the packed records
+    index = {name: np.ascontiguousarray(records[name]) for name in INDEX_RECORD.names}
+    with _loaded_indexes_lock:
+        _loaded_indexes[key] = index
+        while len(_loaded_indexes) > MAX_LOADED_INDEXES:
+            _loaded_indexes.popitem(last=False)
+
+    return index
+
+
+def warm_index(path):
+    """Load the index of the result at `path` ahead of its first read; False if it has none"""
+
+    return _load_index(path, os.stat(path)) is not None
+
+
+def _read_spans(f, offsets, lengths):
+    """Feature bytes at (offsets, lengths), sorted by offset, reading runs of nearby features at once"""
+
+    def read_span(span):
+        f.seek(span[0][0])
+        data = f.read(span[-1][1] - span[0][0])
+        return [data[start - span[0][0]:end - span[0][0]] for start, end in span]
+
+    span = []
+    for start, end in zip(offsets.tolist(), (offsets + lengths).tolist()):
+        # read through small gaps, but never hold much more than READ_SPAN_BYTES at once
+        if span and (start - span[-1][1] > READ_GAP_BYTES or end - span[0][0] > READ_SPAN_BYTES):
+            yield from read_span(span)
+            span = []
+        span.append((start, end))
+    if span:
+        yield from read_span(span)
+
+
+def _geometries(features):
+    return shapely.from_geojson([json.dumps(feature["geometry"]) if feature.get("geometry") else None for feature in features])
+
+
+def _iter_unindexed(f, bbox):
+    """Features of a result without a valid index; the whole file is parsed"""
+
+    features = json.load(f).get("features") or []
+    if bbox is not None:
+        features = [feature for feature, hit in zip(features, shapely.intersects(_geometries(features), shapely.box(*bbox))) if hit]
+    for feature in features:
+        yield json.dumps(feature, separators=(",", ":")).encode()
+
+
+def iter_features(path, bbox=None):
+    """Encoded features of a result, all of them or those whose bounds intersect `bbox` (west, south, east, north)
+
+    Raises FileNotFoundError if the result does not exist.
+    """
+
+    f = open(path, "rb")
+    try:
+        # the open file is the version read, even if the result is replaced meanwhile
+        index = _load_index(path, os.fstat(f.fileno()))
+        if index is None:
+            yield from _iter_unindexed(f, bbox)
+            return
+
+        offsets, lengths = index["offset"], index["length"]
+        if bbox is not None:
+            west, south, east, north = bbox
+            # NaN bounds (empty geometries) never match
+            hits = np.flatnonzero((index["minx"] <= east) & (index["maxx"] >= west)
+                                  & (index["miny"] <= north) & (index["maxy"] >= south))
+            offsets, lengths = offsets[hits], lengths[hits]
+
+        yield from _read_spans(f, offsets, lengths)
+    finally:
+        f.close()
+
+
+def feature_bounds(path):
+    """(stat, bounds): the os.stat_result of the result version read and the (features, 4) bounds of its features
+
+    Bounds come from the index when the result has one; features without a
+    geometry have NaN bounds. Raises FileNotFoundError if the result does not exist.
+    """
+
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        index = _load_index(path, stat)
+        if index is not None:
+            return stat, np.column_stack([index["minx"], index["miny"], index["maxx"], index["maxy"]])
+        return stat, shapely.bounds(_geometries(json.load(f).get("features") or []))
+
+
+def _batched(chunks):
+    """Join small chunks so a streamed response isn't written a feature at a time"""
+
+    batch, size = [], 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_BYTES:
+            yield b"".join(batch)
+            batch, size = [], 0
+    if batch:
+        yield b"".join(batch)
+
+
+def stream_geojson(path, bbox=None):
+    """FeatureCollection chunks of the features `iter_features()` returns"""
+
+    features = iter_features(path, bbox)
+    # pull the first feature now so a missing file raises before the response starts
+    first = next(features, None)
+
+    def chunks():
+        yield COLLECTION_START
+        if first is not None:
+            yield first
+            for feature in features:
+                yield FEATURE_SEPARATOR
+                yield feature
+        yield COLLECTION_END
+
+    return _batched(chunks())
+
+
+def stream_ndjson(path, bbox=None):
+    """Newline-delimited GeoJSON chunks of the features `iter_features()` returns"""
+
+    features = iter_features(path, bbox)
+    first = next(features, None)
+
+    def chunks():
+        if first is not None:
+            yield first
+            yield b"\n"
+            for feature in features:
+                yield feature
+                yield b"\n"
+
+    return _batched(chunks())
@@ -0,0 +1,199 @@
+"""Multi-resolution summaries of ML results for showing them zoomed out
+
+A result with hundreds of thousands of detections can't be drawn polygon by
+polygon at zoom 4. Its summary bins the features' centres into a grid per
+zoom level: at zoom `z` the cells are the XYZ tiles of zoom
+`z + CELL_ZOOM_OFFSET`, i.e. 4x4 cells per map tile, each with the number of
+features in it and their mean centre. Coarser levels are summed from finer
+ones, so building a summary is one pass over the feature bounds, which come
+from the result's index (see ml_result_files.py) without reading the
+features themselves.
+
+Summaries are stored next to the result as `<name>.geojson.summary.npz`,
+tagged with the size and mtime of the result they were built from, and are
+rebuilt when the result (or RAW_MIN_ZOOM) changes.
+
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import ml_result_files
+from tiling import MAX_LATITUDE, tile_bounds_lnglat
+
+SUMMARY_SUFFIX = ".summary.npz"
+# from this zoom on, results are shown as their features rather than summarised
+RAW_MIN_ZOOM = int(os.environ.get("ML_RESULTS_RAW_MIN_ZOOM", "13"))
+# views holding at most this many features show them at any zoom
+RAW_MAX_FEATURES = int(os.environ.get("ML_RESULTS_RAW_MAX_FEATURES", "2000"))
+# cells at zoom z are the tiles of zoom z + CELL_ZOOM_OFFSET
+CELL_ZOOM_OFFSET = 2
+# summaries kept loaded per process
+MAX_LOADED_SUMMARIES = 8
+
+# (path, size, mtime_ns) -> ResultSummary, least recently used first
+_loaded_summaries = OrderedDict()
+_loaded_summaries_lock = threading.Lock()
+_build_locks = {}
+
+
+class ResultSummary:
+    """Grid cells of one result version at zooms 0 .. RAW_MIN_ZOOM - 1
+
+    `zoom`, `x`, `y`, `count`, `lng` and `lat` are arrays over all cells,
+    sorted by zoom then x; `x` and `y` are tile coordinates at
+    `zoom + CELL_ZOOM_OFFSET`.
+    """
+
+    def __init__(self, zoom, x, y, count, lng, lat):
+        self.zoom, self.x, self.y, self.count, self.lng, self.lat = zoom, x, y, count, lng, lat
+        # cells of zoom z are [starts[z], starts[z + 1])
+        self._starts = np.searchsorted(zoom, np.arange(RAW_MIN_ZOOM + 1))
+
+    def _cells(self, zoom, bbox):
+        """Positions of the cells of `zoom` overlapping `bbox` (west, south, east, north)"""
+
+        start, end = self._starts[zoom], self._starts[zoom + 1]
+        if bbox is None:
+            return np.arange(start, end)
+
+        west, south, east, north = bbox
+        min_x, min_y = _cell(west, north, zoom + CELL_ZOOM_OFFSET)
+        max_x, max_y = _cell(east, south, zoom + CELL_ZOOM_OFFSET)
+        x, y = self.x[start:end], self.y[start:end]
+        return start + np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+
+    def feature_count(self, bbox=None):
+        """Features in the cells overlapping `bbox` at the finest level, a close upper bound of those in it"""
+
+        return int(self.count[self._cells(RAW_MIN_ZOOM - 1, bbox)].sum())
+
+    def to_geojson(self, zoom, bbox=None):
+        """FeatureCollection of the cells of `zoom` overlapping `bbox` as polygons with their `count`"""
+
+        zoom = min(max(int(zoom), 0), RAW_MIN_ZOOM - 1)
+        features = []
+        for position in self._cells(zoom, bbox).tolist():
+            west, south, east, north = tile_bounds_lnglat(zoom + CELL_ZOOM_OFFSET, int(self.x[position]), int(self.y[position]))
+            features.append({
+                "type": "Feature",
+                "properties": {"count": int(self.count[position]),
+                               "lng": round(float(self.lng[position]), 6), "lat": round(float(self.lat[position]), 6)},
+                "geometry": {"type": "Polygon", "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]},
+            })
+
+        return json.dumps({"type": "FeatureCollection", "features": features, "summary_zoom": zoom}, separators=(",", ":"))
+
+
+def _cell(lng, lat, z):
+    """Tile (x, y) at zoom `z` of scalar or array lng/lat, clamped to the map"""
+
+    n = 2 ** z
+    lat = np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    x = np.floor((np.asarray(lng, dtype=float) + 180) / 360 * n)
+    y = np.floor((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def summarise(bounds):
+    """ResultSummary of features with (features, 4) lng/lat `bounds`"""
+
+    bounds = bounds[~np.isnan(bounds).any(axis=1)] if len(bounds) else np.zeros((0, 4))
+    lng = (bounds[:, 0] + bounds[:, 2]) / 2
+    lat = (bounds[:, 1] + bounds[:, 3]) / 2
+    x, y = _cell(lng, lat, RAW_MIN_ZOOM - 1 + CELL_ZOOM_OFFSET)
+    count = np.ones(len(x), dtype=np.int64)
+
+    levels = []
+    for zoom in range(RAW_MIN_ZOOM - 1, -1, -1):
+        # the features, or the finer level's cells weighted by their counts, summed into this level's cells
+        keys, inverse = np.unique((x << 32) | y, return_inverse=True)
+        cell_count = np.bincount(inverse, count, len(keys))
+        lng = np.bincount(inverse, lng * count, len(keys)) / cell_count
+        lat = np.bincount(inverse, lat * count, len(keys)) / cell_count
+        x, y, count = keys >> 32, keys & 0xFFFFFFFF, cell_count.astype(np.int64)
+        levels.append((np.full(len(keys), zoom, dtype=np.int8), x, y, count, lng, lat))
+        x, y = x >> 1, y >> 1
+
+    return ResultSummary(*(np.concatenate(column) for column in zip(*reversed(levels))))
+
+
+def _source(stat):
+    """What a stored summary was built from: the result version and the levels it holds"""
+
+    return np.array([stat.st_size, stat.st_mtime_ns, RAW_MIN_ZOOM, CELL_ZOOM_OFFSET], dtype=np.int64)
+
+
+def build(path):
+    """Summarise the result at `path` and store the summary next to it; returns the ResultSummary"""
+
+    stat, bounds = ml_result_files.feature_bounds(path)
+    summary = summarise(bounds)
+
+    output = path + SUMMARY_SUFFIX
+    # write then rename so readers never load a partial summary
+    temporary_output = f"{output}.{os.getpid()}.tmp"
+    with open(temporary_output, "wb") as f:
+        np.savez(f, source=_source(stat), zoom=summary.zoom, x=summary.x,
+                 y=summary.y, count=summary.count, lng=summary.lng, lat=summary.lat)
+    os.replace(temporary_output, output)
+
+    _remember((path, stat.st_size, stat.st_mtime_ns), summary)
+    return summary
+
+
+def _remember(key, summary):
+    with _loaded_summaries_lock:
+        _loaded_summaries[key] = summary
+        while len(_loaded_summaries) > MAX_LOADED_SUMMARIES:
+            _loaded_summaries.popitem(last=False)
+
+
+def _read(path, stat):
+    """Stored summary of the result version `stat`, or None if there is none for it"""
+
+    try:
+        with np.load(path + SUMMARY_SUFFIX) as stored:
+            if stored["source"].tolist() != _source(stat).tolist():
+                return None
+            return ResultSummary(stored["zoom"], stored["x"], stored["y"], stored["count"], stored["lng"], stored["lat"])
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def load(path):
+    """ResultSummary of the result at `path`, built now if it has none for its current version
+
+    Raises FileNotFoundError if the result does not exist.
+    """
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _loaded_summaries_lock:
+        summary = _loaded_summaries.get(key)
+        if summary is not None:
+            _loaded_summaries.move_to_end(key)
+            return summary
+        # a zoomed out view asks for the summary once per pan; one thread builds, the rest wait
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    with build_lock:
+        try:
+            with _loaded_summaries_lock:
+                summary = _loaded_summaries.get(key)
+            if summary is None:
+                summary = _read(path, stat)
+                if summary is not None:
+                    _remember(key, summary)
+                else:
+                    summary = build(path)
+        finally:
+            # also when reading or building failed, so the lock of a bad file is not kept forever
+            with _loaded_summaries_lock:
+                _build_locks.pop(key, None)
+
+    return summary
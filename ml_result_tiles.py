@@ -0,0 +1,176 @@
+"""Mapbox Vector Tiles cut on demand from ML result GeoJSON files
+
+Change detection results can hold hundreds of thousands of polygons, too
+many to ship to the browser as one GeoJSON document. A result file is read
+once into web mercator with an STRtree (`sindex`) and each requested tile is
+clipped, simplified and encoded from the features it intersects. Encoded
+tiles are cached on disk under the result file's mtime, so a rewritten
+result never serves stale tiles.
+
+"""
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import geopandas as gpd
+import mapbox_vector_tile
+import shapely
+from werkzeug.security import safe_join
+
+from tiling import tile_bounds_mercator
+
+# MVT layer holding the result features
+LAYER_NAME = "ml_results"
+TILE_EXTENT = 4096
+# features are clipped to the tile plus this fraction of it on each side so strokes don't show seams
+TILE_BUFFER = 1 / 16
+# results kept loaded per process; each can hold hundreds of thousands of polygons
+MAX_LOADED_RESULTS = int(os.environ.get("ML_RESULT_TILES_MAX_LOADED_RESULTS", "2"))
+
+# (path, mtime_ns) -> results, least recently used first
+_loaded_results = OrderedDict()
+_loaded_results_lock = threading.Lock()
+_load_locks = {}
+
+
+def _read_result(path):
+    """Result features in EPSG:3857 with their spatial index built"""
+
+    results = gpd.read_file(path)
+    if results.crs is None:
+        # RFC 7946 GeoJSON is WGS84
+        results = results.set_crs("EPSG:4326")
+    results = results.to_crs("EPSG:3857")
+    results = results[~results.geometry.is_empty & results.geometry.notna()].reset_index(drop=True)
+
+    # build now rather than on the first tile request
+    results.sindex
+
+    return results
+
+
+def _load_result(path, mtime_ns):
+    """Loaded result for a file version, read once however many tile requests ask for it at the same time
+
+    `mtime_ns` is part of the cache key so a rewritten file is reloaded.
+    """
+
+    key = (path, mtime_ns)
+    with _loaded_results_lock:
+        results = _loaded_results.get(key)
+        if results is not None:
+            _loaded_results.move_to_end(key)
+            return results
+        # a browser opening a result asks for a screenful of tiles at once; one thread loads, the rest wait
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        try:
+            with _loaded_results_lock:
+                results = _loaded_results.get(key)
+            if results is None:
+                results = _read_result(path)
+                with _loaded_results_lock:
+                    _loaded_results[key] = results
+                    while len(_loaded_results) > MAX_LOADED_RESULTS:
+                        _loaded_results.popitem(last=False)
+        finally:
+            # also when reading failed, so the lock of a bad file is not kept forever
+            with _loaded_results_lock:
+                _load_locks.pop(key, None)
+
+    return results
+
+
+def _feature_properties(row):
+    """MVT only encodes str, int, float and bool values"""
+
+    properties = {}
+    for key, value in row.items():
+        if value is None or value != value:
+            continue
+        if not isinstance(value, (str, int, float, bool)):
+            value = value.item() if hasattr(value, "item") else str(value)
+        properties[key] = value
+
+    return properties
+
+
+def encode_tile(results, z, x, y):
+    """Encode the features of `results` (EPSG:3857) intersecting tile z/x/y"""
+
+    minx, miny, maxx, maxy = tile_bounds_mercator(z, x, y)
+    buffer = (maxx - minx) * TILE_BUFFER
+    clip_bounds = (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+    positions = results.sindex.query(shapely.box(*clip_bounds), predicate="intersects")
+    if len(positions) == 0:
+        return b""
+
+    positions.sort()
+    selected = results.iloc[positions]
+
+    # detail finer than one tile pixel is invisible; 4096 extent units over a 256px tile
+    geometries = shapely.clip_by_rect(selected.geometry.to_numpy(), *clip_bounds)
+    geometries = shapely.simplify(geometries, (maxx - minx) / 512, preserve_topology=True)
+
+    properties = selected.drop(columns=selected.geometry.name).to_dict("records")
+
+    features = [
+        {"geometry": geometry, "properties": _feature_properties(row)}
+        for geometry, row in zip(geometries, properties)
+        if not geometry.is_empty
+    ]
+
+    return mapbox_vector_tile.encode(
+        [{"name": LAYER_NAME, "features": features}],
+        default_options={"quantize_bounds": (minx, miny, maxx, maxy), "extents": TILE_EXTENT})
+
+
+def _prune_stale_versions(name_directory, current_version):
+    """Remove tiles cached for earlier versions of a result file"""
+
+    for entry in os.scandir(name_directory):
+        if entry.is_dir() and entry.name != current_version:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def get_tile(results_directory, name, z, x, y, cache_directory=None):
+    """Encoded tile for `<results_directory>/<name>.geojson`, read through the on-disk cache
+
+    Raises FileNotFoundError if the result file does not exist.
+    """
+
+    result_path = safe_join(results_directory, f"{name}.geojson")
+    if result_path is None:
+        raise FileNotFoundError(name)
+
+    stat = os.stat(result_path)
+    version = str(stat.st_mtime_ns)
+
+    cached_tile_path = None
+    if cache_directory:
+        name_directory = safe_join(cache_directory, name)
+        cached_tile_path = os.path.join(name_directory, version, str(z), str(x), f"{y}.pbf")
+        try:
+            with open(cached_tile_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    tile = encode_tile(_load_result(result_path, stat.st_mtime_ns), z, x, y)
+
+    if cached_tile_path:
+        if not os.path.isdir(os.path.join(name_directory, version)) and os.path.isdir(name_directory):
+            _prune_stale_versions(name_directory, version)
+
+        os.makedirs(os.path.dirname(cached_tile_path), exist_ok=True)
+        # write then rename so concurrent readers never see a partial tile
+        temporary_path = f"{cached_tile_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(tile)
+        os.replace(temporary_path, cached_tile_path)
+
+    return tile
@@ -0,0 +1,555 @@
+"""Long-lived pool of ML inference workers
+
+Running the change detection script with `subprocess.run(["python", ...])`
+pays for interpreter start, the torch/onnxruntime imports and the model
+load on every click. Instead, a small pool server owns worker processes
+that import the script once and keep loaded models in memory between jobs.
+
+The pool lives in its own process (a `multiprocessing` manager listening
+on a local unix socket), so the web workers and the long-callback processes
+of every server worker share the same pool:
+
+    pool = ml_workers.connect(address, authkey)
+    result = pool.run("change_detection", {"script": ..., "model": ..., "before": ..., "after": ..., "output": ...})
+
+Jobs return `{"returncode", "stdout", "stderr"}` like `subprocess.run`.
+
+Scripts are run the way the command line would run them (as `__main__`
+with `sys.argv` set) unless they expose these optional hooks, in which
+case the model is loaded once per worker and reused:
+
+    load_model(model_path) -> model
+    run_change_detection(model, before_image_path, after_image_path, output_path, verbose=False[, progress])
+
+"object_detection" jobs run an ONNX detection model on a scene (see
+object_detection.py); the session is kept per worker like script models.
+
+A `run_change_detection` hook taking a `progress` argument is passed
+`report_progress(done, total)`; callers read it with `pool.progress(job_id)`.
+
+"""
+
+import collections
+import contextlib
+import importlib.util
+import inspect
+import io
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.reduction
+import multiprocessing.util
+import os
+import runpy
+import sys
+import threading
+import traceback
+import uuid
+from multiprocessing.managers import BaseManager
+
+from rasterio.windows import Window
+
+import object_detection
+import tiled_change_detection
+
+log = logging.getLogger(__name__)
+
+# the result thread waits at most this long before picking up the pipes of replaced workers
+CONNECTION_POLL_SECONDS = 1
+# result of a cancelled job; negative like the returncode of a process killed by a signal
+CANCELLED_RESULT = {"returncode": -9, "stdout": "", "stderr": "Cancelled"}
+
+# --- worker process side ---
+
+# (script path, mtime) -> module
+_scripts = {}
+# (script path, model path) -> loaded model; ONNX detection sessions under (None, model path)
+_models = {}
+# cores of this worker, set when it starts
+_threads = None
+
+
+def _load_script(script_path):
+    """Import a script as a module once per worker; reloaded if the file changes"""
+
+    key = (script_path, os.path.getmtime(script_path))
+    module = _scripts.get(key)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(f"ml_script_{len(_scripts)}", script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[key] = module
+    return module
+
+
+def _run_script_as_main(script_path, argv):
+    """runpy the script with sys.argv set; heavy imports stay cached in sys.modules across jobs"""
+
+    saved_argv = sys.argv
+    sys.argv = [script_path, *argv]
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except SystemExit as exit:
+        if exit.code not in (None, 0):
+            return exit.code if isinstance(exit.code, int) else 1
+    finally:
+        sys.argv = saved_argv
+    return 0
+
+
+def run_change_detection(script, model, before, after, output, verbose=True):
+    """Run the change detection script on a before/after GeoTIFF pair"""
+
+    module = _load_script(script)
+
+    if hasattr(module, "load_model") and hasattr(module, "run_change_detection"):
+        loaded_model = _models.get((script, model))
+        if loaded_model is None:
+            loaded_model = _models[(script, model)] = module.load_model(model)
+        options = {"verbose": verbose}
+        if "progress" in inspect.signature(module.run_change_detection).parameters:
+            options["progress"] = report_progress
+        module.run_change_detection(loaded_model, before, after, output, **options)
+        return 0
+
+    return _run_script_as_main(script, [before, after, model, output] + (["--verbose"] if verbose else []))
+
+
+def run_change_detection_window(script, model, before, after, window, output, verbose=False):
+    """Run the change detection script on one window of a before/after pair
+
+    `window` is [col_off, row_off, width, height] on the before image's grid.
+    No output is written for a window without data on either date.
+    """
+
+    paths = tiled_change_detection.write_window_pair(before, after, Window(*window), os.path.dirname(output))
+    if paths is None:
+        return 0
+
+    try:
+        return run_change_detection(script, model, *paths, output, verbose=verbose)
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def run_change_detection_series_window(script, model, scenes, window, outputs, verbose=False):
+    """Run the change detection script on each consecutive pair of a window of a time series
+
+    Every scene's window is cut once and shared by the (up to) two pairs it
+    is in; `outputs` has one path per pair. No output is written for a pair
+    without data on either date.
+    """
+
+    paths = tiled_change_detection.write_window_series(scenes, Window(*window), os.path.dirname(outputs[0]))
+    try:
+        for before, after, output in zip(paths, paths[1:], outputs):
+            if before and after:
+                returncode = run_change_detection(script, model, before, after, output, verbose=verbose)
+                if returncode != 0:
+                    return returncode
+        return 0
+    finally:
+        for path in filter(None, paths):
+            os.remove(path)
+
+
+def run_object_detection(model, scene, output, verbose=False):
+    """Detect objects in a scene with an ONNX model, batching tiles through one session"""
+
+    session = _models.get((None, model))
+    if session is None:
+        session = _models[(None, model)] = object_detection.load_session(model, _threads)
+
+    count = object_detection.run(session, scene, output, progress=report_progress)
+    if verbose:
+        print(f"{count} objects detected in {scene}")
+    return 0
+
+
+JOB_HANDLERS = {
+    "change_detection": run_change_detection,
+    "change_detection_window": run_change_detection_window,
+    "change_detection_series_window": run_change_detection_series_window,
+    "object_detection": run_object_detection,
+}
+
+
+def _run_job(kind, params):
+    """Run a job with output captured; returns a subprocess.run-like result dict"""
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            returncode = JOB_HANDLERS[kind](**params)
+    except Exception:
+        returncode = 1
+        stderr.write(traceback.format_exc())
+
+    return {"returncode": returncode, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+# set in a worker while it runs a job
+_progress_reporter = None
+
+
+def report_progress(done, total):
+    """Report progress of the job running in this worker; readable with `InferencePool.progress()`"""
+
+    if _progress_reporter is not None:
+        _progress_reporter(done, total)
+
+
+def _worker_main(connection, threads):
+    global _progress_reporter, _threads
+
+    _threads = threads
+    # one pool worker per few cores; keep torch/onnxruntime/BLAS from each grabbing every core
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+
+    # a script may report progress from its own threads
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    parent = os.getppid()
+    while True:
+        if not connection.poll(5):
+            # exit with the pool server rather than linger holding a loaded model
+            if os.getppid() != parent:
+                break
+            continue
+
+        task = connection.recv()
+        if task is None:
+            break
+
+        job_id, kind, params = task
+        _progress_reporter = lambda done, total: send(("progress", job_id, (done, total)))
+        try:
+            result = _run_job(kind, params)
+        finally:
+            _progress_reporter = None
+        send(("done", job_id, result))
+
+
+def _spawner_main(connection, pool_end, threads):
+    """Fork, kill and reap pool workers on request of the pool server
+
+    The pool server runs proxy, result and scheduler threads, and forking a
+    process while another thread holds a lock (logging's, an allocator's)
+    can deadlock the child. The spawner is forked from the pool server
+    before any of those threads exist and has no threads of its own, so
+    workers forked from it start clean. Requests are ("start", index), which
+    answers the worker's pid followed by the pool end of its pipe, and
+    ("kill", pid) or ("reap", pid) of an exited worker, which answer its
+    exit code.
+    """
+
+    # the pool server's end, inherited; only the pool server may hold it, or this end never sees end of file
+    pool_end.close()
+    context = multiprocessing.get_context("fork")
+    # pid -> Process
+    workers = {}
+    while True:
+        try:
+            request, argument = connection.recv()
+        except EOFError:
+            # the pool server is gone; daemonic workers are terminated as this process exits
+            break
+
+        if request == "start":
+            pool_connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_worker_main, args=(worker_connection, threads), name=f"ml-worker-{argument}", daemon=True)
+            worker.start()
+            # only the worker holds its end, so the pipe reports end of file when the worker dies
+            worker_connection.close()
+            workers[worker.pid] = worker
+            connection.send(worker.pid)
+            multiprocessing.reduction.send_handle(connection, pool_connection.fileno(), None)
+            pool_connection.close()
+        else:
+            worker = workers.pop(argument)
+            if request == "kill":
+                worker.kill()
+            # a worker whose pipe closed may take a moment to exit
+            worker.join(1)
+            if worker.exitcode is None:
+                worker.kill()
+                worker.join()
+            connection.send(worker.exitcode)
+
+
+# --- pool server side ---
+
+class InferencePool:
+    """Worker processes each fed one job at a time from the pool's queue
+
+    Methods are called through manager proxies from other processes, each
+    proxy connection on its own server thread, so `wait()` only blocks the
+    caller.
+
+    Queued jobs stay in the pool server until a worker is idle, so they can
+    be cancelled without touching a worker. Cancelling a running job kills
+    its worker, which frees its cores at once, and starts a replacement.
+    Workers are forked by a single-threaded spawner process (see
+    `_spawner_main()`), never by the multithreaded pool server itself.
+
+    Every worker talks to the pool over its own pipe, which is thrown away
+    with the worker: killing a process that writes to a queue shared with
+    other workers can leave the queue's lock held and wedge all of them.
+    """
+
+    def __init__(self, processes, threads_per_process):
+        """Create in a process that has no other threads yet: the worker spawner is forked from it"""
+
+        context = multiprocessing.get_context("fork")
+        self._spawner, spawner_connection = context.Pipe()
+        spawner = context.Process(target=_spawner_main, args=(spawner_connection, self._spawner, threads_per_process),
+                                  name="ml-worker-spawner")
+        spawner.start()
+        spawner_connection.close()
+        # closing the pipe at exit stops the spawner before multiprocessing waits for it
+        multiprocessing.util.Finalize(self, self._spawner.close, exitpriority=10)
+
+        # (job_id, kind, params) not yet handed to a worker
+        self._pending = collections.deque()
+        # job_id -> worker index
+        self._running = {}
+        self._progress = {}
+        self._completed = {}
+        self._condition = threading.Condition()
+
+        # pid of each worker
+        self._workers = [None] * processes
+        # pool end of each worker's pipe -> worker index
+        self._connections = {}
+        # pipes of killed workers, drained until they report end of file
+        self._retired_connections = set()
+        for index in range(processes):
+            self._start_worker(index)
+        self._idle = set(range(processes))
+
+        threading.Thread(target=self._collect_results, name="ml-pool-results", daemon=True).start()
+
+    def _start_worker(self, index):
+        """Have the spawner fork a worker; call with the condition held (or before the result thread starts)"""
+
+        self._spawner.send(("start", index))
+        self._workers[index] = self._spawner.recv()
+        connection = multiprocessing.connection.Connection(multiprocessing.reduction.recv_handle(self._spawner))
+        self._connections[connection] = index
+
+    def _stop_worker(self, index, request):
+        """Retire a worker's pipe and have the spawner "kill" it or "reap" it; returns its exit code"""
+
+        for connection, connection_index in list(self._connections.items()):
+            if connection_index == index:
+                del self._connections[connection]
+                self._retired_connections.add(connection)
+
+        self._spawner.send((request, self._workers[index]))
+        return self._spawner.recv()
+
+    def _replace_worker(self, index):
+        """Kill a worker and start a fresh one in its place; call with the condition held"""
+
+        self._stop_worker(index, "kill")
+        self._start_worker(index)
+
+    def _dispatch(self):
+        """Hand queued jobs to idle workers; call with the condition held"""
+
+        while self._pending and self._idle:
+            job_id, kind, params = self._pending.popleft()
+            index = self._idle.pop()
+            self._running[job_id] = index
+            connection = next(connection for connection, connection_index in self._connections.items() if connection_index == index)
+            connection.send((job_id, kind, params))
+
+    def _finish(self, job_id, result):
+        """Record a job's result; call with the condition held"""
+
+        self._running.pop(job_id, None)
+        self._progress.pop(job_id, None)
+        self._completed[job_id] = result
+        self._condition.notify_all()
+
+    def _receive(self, connection):
+        with self._condition:
+            if connection in self._retired_connections:
+                # messages from a killed worker belong to a job that was already cancelled
+                try:
+                    connection.recv()
+                except (EOFError, OSError):
+                    self._retired_connections.discard(connection)
+                    connection.close()
+                return
+
+            index = self._connections[connection]
+            try:
+                message, job_id, payload = connection.recv()
+            except (EOFError, OSError):
+                if self._spawner.closed:
+                    # the pool server is exiting, and its workers with it
+                    return
+                # the worker died on its own (e.g. killed for memory); fail its job and replace it
+                job_id = next((job_id for job_id, job_index in self._running.items() if job_index == index), None)
+                exitcode = self._stop_worker(index, "reap")
+                log.warning("ML worker %d exited unexpectedly with code %s", index, exitcode)
+                self._start_worker(index)
+                if job_id is not None:
+                    self._finish(job_id, {"returncode": exitcode or 1, "stdout": "", "stderr": f"ML worker exited with code {exitcode}"})
+                self._idle.add(index)
+                self._dispatch()
+                return
+
+            if message == "progress":
+                if self._running.get(job_id) == index:
+                    self._progress[job_id] = payload
+                return
+
+            self._finish(job_id, payload)
+            self._idle.add(index)
+            self._dispatch()
+
+    def _collect_results(self):
+        while True:
+            with self._condition:
+                connections = [*self._connections, *self._retired_connections]
+            for connection in multiprocessing.connection.wait(connections, timeout=CONNECTION_POLL_SECONDS):
+                self._receive(connection)
+
+    def submit(self, kind, params):
+        """Queue a job and return its id"""
+
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown ML job kind {kind!r}")
+
+        job_id = uuid.uuid4().hex
+        with self._condition:
+            self._pending.append((job_id, kind, params))
+            self._dispatch()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; False if it has already finished"""
+
+        with self._condition:
+            for task in self._pending:
+                if task[0] == job_id:
+                    self._pending.remove(task)
+                    break
+            else:
+                index = self._running.get(job_id)
+                if index is None:
+                    return False
+
+                # the job may be deep inside native inference code; only killing the worker stops it
+                self._replace_worker(index)
+                self._idle.add(index)
+
+            self._finish(job_id, CANCELLED_RESULT)
+            self._dispatch()
+            return True
+
+    def progress(self, job_id):
+        """(done, total) last reported by a running job, or None"""
+
+        with self._condition:
+            return self._progress.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Result of a job, or None if it has not finished within `timeout` seconds"""
+
+        with self._condition:
+            self._condition.wait_for(lambda: job_id in self._completed, timeout)
+            return self._completed.pop(job_id, None)
+
+    def run(self, kind, params, timeout=None):
+        """Submit a job and wait for its result"""
+
+        return self.wait(self.submit(kind, params), timeout)
+
+    def size(self):
+        return len(self._workers)
+
+
+_pool = None
+_pool_config = {}
+_pool_lock = threading.Lock()
+# keeps the server alive; the manager shuts its server down when garbage collected
+_manager = None
+
+
+def _configure_pool(processes, threads_per_process, initializer=None):
+    _pool_config.update(processes=processes, threads_per_process=threads_per_process)
+    # created now, before the manager starts its server threads
+    pool = _get_pool()
+    if initializer:
+        initializer(pool)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = InferencePool(**_pool_config)
+    return _pool
+
+
+class PoolManager(BaseManager):
+    pass
+
+
+PoolManager.register("pool", callable=_get_pool)
+
+
+def pool_size(processes=None, threads_per_process=None):
+    """(workers, threads per worker) for this host
+
+    Defaults to a quarter of the cores per worker, so four jobs can run at
+    once without oversubscribing the CPU.
+    """
+
+    cores = os.cpu_count() or 1
+    threads_per_process = threads_per_process or max(1, cores // 4)
+    processes = processes or max(1, cores // threads_per_process)
+    return processes, threads_per_process
+
+
+def connect(address, authkey):
+    """Proxy to the pool served at `address`"""
+
+    manager = PoolManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.pool()
+
+
+def ensure_pool_server(address, authkey, processes, threads_per_process, initializer=None):
+    """Start the pool server unless one is already listening at `address`
+
+    Call before starting any threads: the server process is forked from the
+    caller, and the workers from a spawner the server forks before it starts
+    threads. `initializer(pool)` is called in the server process once its
+    workers are up, e.g. to start a job scheduler next to the pool.
+    """
+
+    try:
+        return connect(address, authkey)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # nothing listening; remove a stale socket left by a previous container run
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(address)
+
+    global _manager
+    _manager = PoolManager(address=address, authkey=authkey)
+    _manager.start(initializer=_configure_pool, initargs=(processes, threads_per_process, initializer))
+    os.chmod(address, 0o600)
+
+    pool = _manager.pool()
+    log.info("ML worker pool started at %s: %d workers x %d threads", address, pool.size(), threads_per_process)
+    return pool
@@ -0,0 +1,185 @@
+"""Object detection over whole scenes with batched ONNX inference
+
+The scene is read in overlapping tiles on its own pixel grid, aligned to the
+GeoTIFF's internal blocks. Tiles are stacked into batches for one
+onnxruntime session, and the next batch is read on a background thread while
+the current one is inferred, so reads overlap with inference. The session
+uses the threads of the pool worker it runs in.
+
+Objects in the overlap between tiles are detected twice; per-class non
+maximum suppression over the whole scene keeps the best box of each. Boxes
+are written as georeferenced polygons to a GeoJSON in EPSG:4326, with their
+`score`, `class` and `label`.
+
+Detection models are ONNX files with one input of shape
+(batch, 3, height, width), float32 RGB scaled to [0, 1], and a first output
+of shape (batch, detections, 6) holding [x1, y1, x2, y2, score, class] in tile
+pixels (e.g. an end-to-end YOLO export). Fixed batch and tile sizes in the
+input shape are respected; class names are read from a `names` entry in the
+model metadata if there is one.
+
+"""
+
+import ast
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+
+import ml_result_files
+from tiled_change_detection import plan_windows
+
+TILE_SIZE = 640
+TILE_OVERLAP = 64
+BATCH_SIZE = 8
+SCORE_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.5
+
+
+def load_session(model_path, threads):
+    """onnxruntime session for a detection model, using `threads` cores"""
+
+    # only the ML workers run models; the web processes never import onnxruntime
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def _class_names(session):
+    """Class index -> name from the model metadata, or {}"""
+
+    names = session.get_modelmeta().custom_metadata_map.get("names")
+    try:
+        return {int(index): str(name) for index, name in ast.literal_eval(names).items()} if names else {}
+    except (ValueError, SyntaxError, AttributeError):
+        return {}
+
+
+def _read_batch(dataset, windows, tile_size, scale):
+    """(tiles, [(col_off, row_off)]) for the windows holding valid pixels; tiles are zero padded to tile_size"""
+
+    # greyscale scenes are fed as three identical bands
+    indexes = [1, 2, 3] if dataset.count >= 3 else [1, 1, 1]
+    tiles, offsets = [], []
+    for window in windows:
+        if not dataset.read_masks(1, window=window).any():
+            continue
+        tile = np.zeros((3, tile_size, tile_size), dtype=np.float32)
+        data = dataset.read(indexes, window=window)
+        tile[:, :data.shape[1], :data.shape[2]] = data * scale
+        tiles.append(tile)
+        offsets.append((int(window.col_off), int(window.row_off)))
+
+    return np.stack(tiles) if tiles else np.zeros((0, 3, tile_size, tile_size), dtype=np.float32), offsets
+
+
+def non_max_suppression(boxes, scores, classes, iou_threshold=IOU_THRESHOLD):
+    """Indices of the boxes kept by greedy per-class non maximum suppression
+
+    `boxes` is (n, 4) [x1, y1, x2, y2]. Overlapping candidates are found with
+    an STRtree, so a whole scene of boxes is suppressed at once.
+    """
+
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+
+    left, right = shapely.STRtree(shapely.box(*boxes.T)).query(shapely.box(*boxes.T), predicate="intersects")
+    pairs = (left != right) & (classes[left] == classes[right])
+    left, right = left[pairs], right[pairs]
+
+    width = np.minimum(boxes[left, 2], boxes[right, 2]) - np.maximum(boxes[left, 0], boxes[right, 0])
+    height = np.minimum(boxes[left, 3], boxes[right, 3]) - np.maximum(boxes[left, 1], boxes[right, 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    iou = intersection / np.maximum(areas[left] + areas[right] - intersection, 1e-9)
+    left, right = left[iou > iou_threshold], right[iou > iou_threshold]
+
+    # boxes each box suppresses if it is kept
+    order = np.argsort(left, kind="stable")
+    left, right = left[order], right[order]
+    starts = np.searchsorted(left, np.arange(len(boxes) + 1))
+
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for index in np.argsort(-scores, kind="stable"):
+        if suppressed[index]:
+            continue
+        keep.append(index)
+        suppressed[right[starts[index]:starts[index + 1]]] = True
+
+    return np.array(keep, dtype=int)
+
+
+def detect(session, scene, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=BATCH_SIZE,
+           score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD, progress=None):
+    """GeoDataFrame of the objects detected in a scene, in the scene's CRS
+
+    `progress(done, total)` is called as batches of tiles complete.
+    """
+
+    model_input = session.get_inputs()[0]
+    batch_dimension, _, tile_height, tile_width = model_input.shape
+    # models exported with fixed shapes get exactly what they expect
+    if isinstance(tile_height, int) and isinstance(tile_width, int):
+        tile_size = max(tile_height, tile_width)
+    fixed_batch_size = batch_dimension if isinstance(batch_dimension, int) else None
+    batch_size = fixed_batch_size or batch_size
+
+    with rasterio.open(scene) as dataset:
+        block_height, block_width = dataset.block_shapes[0]
+        block_size = block_width if dataset.profile.get("tiled") and block_width == block_height else None
+        windows = [window for window, _ in plan_windows(dataset.width, dataset.height, tile_size, overlap, block_size)]
+        batches = [windows[start:start + batch_size] for start in range(0, len(windows), batch_size)]
+        scale = 1 / np.iinfo(dataset.dtypes[0]).max if np.issubdtype(dataset.dtypes[0], np.integer) else 1
+        crs, transform = dataset.crs, dataset.transform
+
+        boxes, scores, classes = [], [], []
+        # one reader thread: a rasterio dataset must not be read from several threads at once
+        with ThreadPoolExecutor(1, thread_name_prefix="detection-reader") as reader:
+            next_batch = reader.submit(_read_batch, dataset, batches[0], tile_size, scale)
+            for index in range(len(batches)):
+                tiles, offsets = next_batch.result()
+                if index + 1 < len(batches):
+                    next_batch = reader.submit(_read_batch, dataset, batches[index + 1], tile_size, scale)
+
+                if offsets:
+                    if fixed_batch_size and len(tiles) < fixed_batch_size:
+                        tiles = np.concatenate([tiles, np.zeros((fixed_batch_size - len(tiles), *tiles.shape[1:]), dtype=tiles.dtype)])
+                    detections = session.run(None, {model_input.name: tiles})[0]
+                    for tile_detections, (col_off, row_off) in zip(detections, offsets):
+                        tile_detections = tile_detections[tile_detections[:, 4] >= score_threshold]
+                        boxes.append(tile_detections[:, :4] + [col_off, row_off, col_off, row_off])
+                        scores.append(tile_detections[:, 4])
+                        classes.append(tile_detections[:, 5].astype(int))
+
+                if progress:
+                    progress(index + 1, len(batches))
+
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4))
+    scores = np.concatenate(scores) if scores else np.zeros(0)
+    classes = np.concatenate(classes) if classes else np.zeros(0, dtype=int)
+    keep = non_max_suppression(boxes, scores, classes, iou_threshold)
+
+    # pixel boxes to the scene CRS
+    a, b, c, d, e, f = transform[:6]
+    geometries = shapely.transform(shapely.box(*boxes[keep].T),
+                                   lambda xy: np.column_stack([a * xy[:, 0] + b * xy[:, 1] + c, d * xy[:, 0] + e * xy[:, 1] + f]))
+    names = _class_names(session)
+    return gpd.GeoDataFrame({
+        "score": scores[keep].astype(float),
+        "class": classes[keep],
+        "label": [names.get(int(value), str(value)) for value in classes[keep]],
+    }, geometry=geometries, crs=crs)
+
+
+def run(session, scene, output, progress=None, **options):
+    """Detect objects in a scene and write them to `output` as GeoJSON in EPSG:4326"""
+
+    detections = detect(session, scene, progress=progress, **options)
+    return ml_result_files.write_result(detections, output)
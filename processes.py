@@ -0,0 +1,12 @@
+"""Helpers for locks and jobs owned by local processes"""
+
+import psutil
+
+
+def process_alive(pid):
+    """Whether a local process is still running (a killed, unreaped process counts as gone)"""
+
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
@@ -0,0 +1,270 @@
+"""XYZ tiles for a scene, rendered on demand from its GeoTIFF
+
+Scenes no longer need an offline tiling step before they can be shown on
+the map. A tile request is answered, in order, from:
+
+1. the local tile cache (`TileCache`, a size bounded LRU on /fs),
+2. the scene's pre-rendered pyramid at `tilemaps_path`, when it has one
+   (from its MBTiles archive if it was converted to one, see tile_archives.py),
+3. a windowed read of the scene's `geotiff_path`, taken from the overview
+   closest to the tile's resolution and warped to web mercator.
+
+Whatever is served is written to the tile cache, so repeat requests for a
+scene never go back to blob storage.
+
+"""
+
+import contextlib
+import math
+import os
+import threading
+import warnings
+from collections import OrderedDict
+
+import diskcache
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds as window_from_bounds
+from werkzeug.security import safe_join
+
+from tiling import tile_bounds_mercator
+
+TILE_SIZE = 256
+# URL prefix of pre-rendered pyramids served by serve_tiles(); tilemaps_path is "<prefix><location>/{z}/{x}/{y}.png" (or .webp)
+MAPTILES_URL_PREFIX = "/app/WEB/maptiles/"
+# (path, overview level) pairs kept open; rasterio datasets are checked out by one thread at a time
+MAX_OPEN_DATASETS = 16
+# idle handles kept per (path, overview level), enough for a burst of concurrent tile requests
+MAX_IDLE_HANDLES = 4
+
+# (path, overview level) -> idle dataset handles, least recently used first
+_idle_datasets = OrderedDict()
+_datasets_lock = threading.Lock()
+_display_ranges = {}
+
+# PNG tiles and the in-memory arrays handed to reproject() carry no georeferencing of their own.
+# Filtered for the process: catch_warnings() is not thread safe under a threaded server.
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
+
+
+class TileCache:
+    """Size bounded, process safe LRU of encoded tiles
+
+    A thin wrapper over a dedicated diskcache; when the cache outgrows
+    `size_limit` the least recently read tiles are evicted.
+    """
+
+    def __init__(self, directory, size_limit):
+        self._cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, tile):
+        self._cache.set(key, tile)
+
+
+@contextlib.contextmanager
+def _open_dataset(path, overview_level=None):
+    """Dataset handle, optionally at an overview level, checked out of the process-wide pool
+
+    Handles outlive requests, so tiles of a scene don't reopen its GeoTIFF on
+    blob storage; the threaded server starts a new thread per request, so a
+    per-thread cache would never be reused. A rasterio dataset must not be
+    used by two threads at once, hence the checkout.
+    """
+
+    key = (path, overview_level)
+    with _datasets_lock:
+        handles = _idle_datasets.get(key)
+        dataset = handles.pop() if handles else None
+
+    if dataset is None:
+        dataset = rasterio.open(path) if overview_level is None else rasterio.open(path, overview_level=overview_level)
+
+    try:
+        yield dataset
+    finally:
+        closed = []
+        with _datasets_lock:
+            handles = _idle_datasets.setdefault(key, [])
+            _idle_datasets.move_to_end(key)
+            if len(handles) < MAX_IDLE_HANDLES:
+                handles.append(dataset)
+            else:
+                closed.append(dataset)
+            while len(_idle_datasets) > MAX_OPEN_DATASETS:
+                closed.extend(_idle_datasets.popitem(last=False)[1])
+        for handle in closed:
+            handle.close()
+
+
+def _overview_level(dataset, tile_resolution):
+    """Index of the coarsest overview still at least as fine as the tile, or None for full resolution"""
+
+    level = None
+    for index, factor in enumerate(dataset.overviews(1)):
+        if dataset.res[0] * factor <= tile_resolution:
+            level = index
+
+    return level
+
+
+def _display_range(path, dataset, indexes):
+    """(low, high) per band used to stretch non-8-bit imagery, from the coarsest overview"""
+
+    display_range = _display_ranges.get(path)
+    if display_range is None:
+        overviews = dataset.overviews(1)
+        factor = overviews[-1] if overviews else max(1, max(dataset.width, dataset.height) // 1024)
+        sample = dataset.read(indexes, out_shape=(len(indexes), max(1, dataset.height // factor), max(1, dataset.width // factor)), masked=True)
+        low = [float(np.percentile(band.compressed(), 2)) if band.count() else 0.0 for band in sample]
+        high = [float(np.percentile(band.compressed(), 98)) if band.count() else 1.0 for band in sample]
+        display_range = _display_ranges[path] = (np.array(low)[:, None, None], np.array(high)[:, None, None])
+
+    return display_range
+
+
+def encode_png(rgba):
+    """PNG bytes for a (4, height, width) uint8 array"""
+
+    count, height, width = rgba.shape
+    with MemoryFile() as memory_file:
+        with memory_file.open(driver="PNG", width=width, height=height, count=count, dtype="uint8") as png:
+            png.write(rgba)
+        return memory_file.read()
+
+
+def tile_mimetype(tile):
+    """Content type of encoded tile bytes: pre-rendered pyramids may be WebP"""
+
+    return "image/webp" if tile[:4] == b"RIFF" else "image/png"
+
+
+def _read_window(source, west, south, east, north, indexes):
+    """(data, mask, transform) covering the bounds plus a pixel of padding, or None outside the raster"""
+
+    window = window_from_bounds(west, south, east, north, source.transform)
+    # pad by a pixel for resampling at the edges, then clip to the raster
+    col_off = max(0, math.floor(window.col_off) - 1)
+    row_off = max(0, math.floor(window.row_off) - 1)
+    col_end = min(source.width, math.ceil(window.col_off + window.width) + 1)
+    row_end = min(source.height, math.ceil(window.row_off + window.height) + 1)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+    return source.read(indexes, window=window), source.read_masks(1, window=window), source.window_transform(window)
+
+
+def render_tile(geotiff_path, z, x, y):
+    """RGBA array for tile z/x/y of a GeoTIFF, or None if the tile is outside the scene"""
+
+    tile_bounds = tile_bounds_mercator(z, x, y)
+
+    with _open_dataset(geotiff_path) as dataset:
+        west, south, east, north = transform_bounds("EPSG:3857", dataset.crs, *tile_bounds)
+        left, bottom, right, top = dataset.bounds
+        if west >= right or east <= left or south >= top or north <= bottom:
+            return None
+
+        crs = dataset.crs
+        indexes = [1, 2, 3] if dataset.count >= 3 else [1]
+
+        # read from the overview whose resolution is closest to (but not coarser than) the tile's
+        level = _overview_level(dataset, (east - west) / TILE_SIZE)
+        if level is None:
+            window_data = _read_window(dataset, west, south, east, north, indexes)
+        else:
+            with _open_dataset(geotiff_path, level) as overview:
+                window_data = _read_window(overview, west, south, east, north, indexes)
+
+        if window_data is None:
+            return None
+        data, mask, window_transform = window_data
+
+        display_range = _display_range(geotiff_path, dataset, indexes) if data.dtype != np.uint8 else None
+
+    tile_transform = from_bounds(*tile_bounds, TILE_SIZE, TILE_SIZE)
+    tile_data = np.zeros((len(indexes), TILE_SIZE, TILE_SIZE), dtype=data.dtype)
+    tile_mask = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+
+    for source_array, destination_array, resampling in ((data, tile_data, Resampling.bilinear), (mask, tile_mask, Resampling.nearest)):
+        reproject(source_array, destination_array,
+                  src_transform=window_transform, src_crs=crs,
+                  dst_transform=tile_transform, dst_crs="EPSG:3857",
+                  resampling=resampling)
+
+    if not tile_mask.any():
+        return None
+
+    if display_range is not None:
+        low, high = display_range
+        tile_data = np.clip((tile_data - low) / np.maximum(high - low, 1e-9) * 255, 0, 255).astype(np.uint8)
+
+    if len(indexes) == 1:
+        tile_data = np.repeat(tile_data, 3, axis=0)
+
+    return np.concatenate([tile_data, tile_mask[None]])
+
+
+def pyramid_location(tilemaps_path):
+    """Location of a pre-rendered pyramid under the assets directory (its path up to /{z}), or None"""
+
+    if not tilemaps_path or not tilemaps_path.startswith(MAPTILES_URL_PREFIX):
+        return None
+
+    return tilemaps_path[len(MAPTILES_URL_PREFIX):].split("/{z}")[0]
+
+
+def prerendered_tile_path(assets_directory, tilemaps_path, z, x, y):
+    """Filesystem path of a pre-rendered tile for a scene, or None if it has no such tile"""
+
+    if not tilemaps_path or not tilemaps_path.startswith(MAPTILES_URL_PREFIX):
+        return None
+
+    relative_path = tilemaps_path[len(MAPTILES_URL_PREFIX):].format(z=z, x=x, y=y)
+    path = safe_join(assets_directory, relative_path)
+
+    return path if path and os.path.isfile(path) else None
+
+
+def get_scene_tile(scene, z, x, y, assets_directory, tile_cache=None, archives=None):
+    """PNG bytes of tile z/x/y for a catalog scene, or None if the scene does not cover the tile
+
+    With `archives` (a tile_archives.TileArchives), a pre-rendered pyramid
+    converted to an archive is read from it instead of its directory.
+    """
+
+    key = f"{scene['uuid']}/{z}/{x}/{y}"
+    if scene.get("tilemaps_path"):
+        # a regenerated pyramid has a new path, so tiles cached from the old one are not served
+        key += f"@{scene['tilemaps_path']}"
+    if tile_cache is not None:
+        tile = tile_cache.get(key)
+        if tile is not None:
+            # b"" records a tile known to be outside the scene
+            return tile or None
+
+    tile = None
+    location = pyramid_location(scene.get("tilemaps_path"))
+    if archives is not None and location:
+        _, tile = archives.read(location, z, x, y)
+
+    path = prerendered_tile_path(assets_directory, scene.get("tilemaps_path"), z, x, y) if tile is None else None
+    if path:
+        with open(path, "rb") as f:
+            tile = f.read()
+    elif tile is None:
+        rgba = render_tile(os.path.join(assets_directory, scene["geotiff_path"]), z, x, y)
+        tile = b"" if rgba is None else encode_png(rgba)
+
+    if tile_cache is not None:
+        tile_cache.set(key, tile)
+
+    return tile or None
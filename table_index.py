@@ -0,0 +1,209 @@
+"""Columnar index for server-side paging, filtering and sorting of a table
+
+The data page table is paged, filtered and sorted on the server (Dash
+`page_action`/`filter_action`/`sort_action="custom"`), so browsers only ever
+receive one page of rows. `TableIndex` prepares a DataFrame once so each of
+those requests is a few numpy operations:
+
+- every column is factorized into codes into its sorted distinct values,
+  so the codes are sort keys (multi-column sorts are one `np.lexsort`) and
+  a filter is evaluated once per distinct value, then broadcast to the rows
+  with a lookup; for low-cardinality columns such as algorithm and sitename
+  that is a handful of comparisons whatever the catalog size
+- the row positions of recent (filter, sort) pairs are kept in a small LRU,
+  so paging through a result only slices a cached array
+
+Filter queries are Dash's `filter_query` strings, e.g.
+`{Sitename} contains site1 && {Datetime} >= 2020`. Parts that do not parse
+or name an unknown column are ignored, as Dash does for native filtering.
+
+"""
+
+import csv
+import io
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# (filter_query, sort_by) results kept for paging
+CACHED_QUERIES = 64
+# rows per chunk of a CSV export
+CSV_CHUNK_ROWS = 10_000
+
+_FILTER_PART = re.compile(r"^\s*\{(?P<column>[^}]+)\}\s+(?P<operator>\S+)\s*(?P<value>.*?)\s*$")
+
+_OPERATORS = {
+    "=": "eq", "eq": "eq",
+    "!=": "ne", "ne": "ne",
+    "<": "lt", "lt": "lt",
+    "<=": "le", "le": "le",
+    ">": "gt", "gt": "gt",
+    ">=": "ge", "ge": "ge",
+    "contains": "contains",
+    "datestartswith": "datestartswith",
+}
+
+
+def parse_filter_query(filter_query):
+    """[(column, operator, value, case_sensitive)] of a Dash filter_query; unparsable parts are skipped"""
+
+    conditions = []
+    for part in (filter_query or "").split(" && "):
+        match = _FILTER_PART.match(part)
+        if not match:
+            continue
+        column, operator, value = match["column"], match["operator"], match["value"]
+
+        # Dash prefixes operators with i/s when the table toggles case sensitivity
+        case_sensitive = True
+        if operator not in _OPERATORS and operator[:1] in ("i", "s") and operator[1:] in _OPERATORS:
+            case_sensitive = operator[0] == "s"
+            operator = operator[1:]
+        if operator not in _OPERATORS:
+            continue
+
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'`":
+            value = value[1:-1]
+        conditions.append((column, _OPERATORS[operator], value, case_sensitive))
+
+    return conditions
+
+
+def _compare(values, operator, value):
+    """Boolean mask of `values <operator> value` over a numpy array or pandas Series"""
+
+    if operator == "eq":
+        return values == value
+    if operator == "ne":
+        return values != value
+    if operator == "lt":
+        return values < value
+    if operator == "le":
+        return values <= value
+    if operator == "gt":
+        return values > value
+    return values >= value
+
+
+class TableIndex:
+    """Precomputed columns of a DataFrame, answering page/filter/sort requests of a Dash DataTable"""
+
+    def __init__(self, table):
+        self.columns = list(table.columns)
+        self._length = len(table)
+        # column -> values as python objects, for building records and CSV rows
+        self._display = {}
+        # column -> (codes, sorted distinct values); codes are dense ranks of the rows
+        self._codes = {}
+        self._numeric = set()
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+        for column in self.columns:
+            series = table[column]
+            self._display[column] = series.tolist()
+            if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                self._numeric.add(column)
+            else:
+                series = series.fillna("").astype(str)
+            codes, values = pd.factorize(series, sort=True, use_na_sentinel=False)
+            self._codes[column] = (codes, np.asarray(values, dtype=float if column in self._numeric else object))
+
+    def __len__(self):
+        return self._length
+
+    def datatable_columns(self):
+        """`columns` for the DataTable, typed so the filter row parses numbers"""
+
+        return [{"name": column, "id": column, "type": "numeric" if column in self._numeric else "text"}
+                for column in self.columns]
+
+    def _condition_mask(self, column, operator, value, case_sensitive):
+        # evaluated per distinct value, then broadcast to the rows through the codes
+        codes, values = self._codes[column]
+        if column not in self._numeric:
+            return self._text_mask(pd.Series(values), operator, value, case_sensitive)[codes]
+
+        if operator in ("contains", "datestartswith"):
+            return pd.Series(values).astype(str).str.contains(value, regex=False).to_numpy()[codes]
+        try:
+            return _compare(values, operator, float(value))[codes]
+        except ValueError:
+            # a number column never equals text
+            return np.full(len(codes), operator == "ne")
+
+    @staticmethod
+    def _text_mask(values, operator, value, case_sensitive):
+        if not case_sensitive:
+            values, value = values.str.lower(), value.lower()
+        if operator == "contains":
+            return values.str.contains(value, regex=False).to_numpy()
+        if operator == "datestartswith":
+            return values.str.startswith(value).to_numpy()
+        return _compare(values, operator, value).to_numpy()
+
+    def _select(self, filter_query, sort_by):
+        positions = np.arange(self._length)
+        conditions = [condition for condition in parse_filter_query(filter_query) if condition[0] in self.columns]
+        if conditions:
+            mask = np.ones(self._length, dtype=bool)
+            for condition in conditions:
+                mask &= self._condition_mask(*condition)
+            positions = positions[mask]
+
+        # np.lexsort sorts by its last key first; negated codes sort descending
+        keys = [self._codes[sort["column_id"]][0][positions] * (-1 if sort.get("direction") == "desc" else 1)
+                for sort in reversed(sort_by or ()) if sort.get("column_id") in self.columns]
+        if keys:
+            positions = positions[np.lexsort(keys)]
+
+        return positions
+
+    def query(self, filter_query=None, sort_by=None):
+        """Row positions matching `filter_query`, in `sort_by` order (Dash's sort_by list)"""
+
+        key = (filter_query or "", tuple((sort.get("column_id"), sort.get("direction")) for sort in sort_by or ()))
+        with self._lock:
+            positions = self._queries.get(key)
+            if positions is not None:
+                self._queries.move_to_end(key)
+                return positions
+
+        positions = self._select(filter_query, sort_by)
+
+        with self._lock:
+            self._queries[key] = positions
+            while len(self._queries) > CACHED_QUERIES:
+                self._queries.popitem(last=False)
+        return positions
+
+    def records(self, positions):
+        """DataTable `data` for the rows at `positions`"""
+
+        return [{column: self._display[column][position] for column in self.columns} for position in positions.tolist()]
+
+    def page(self, page_current, page_size, filter_query=None, sort_by=None):
+        """(records of one page, number of pages) for a DataTable request"""
+
+        positions = self.query(filter_query, sort_by)
+        start = page_current * page_size
+        return self.records(positions[start:start + page_size]), max(1, -(-len(positions) // page_size))
+
+    def iter_csv(self, filter_query=None, sort_by=None, chunk_rows=CSV_CHUNK_ROWS):
+        """CSV text of the matching rows, header first, in chunks of `chunk_rows` rows"""
+
+        positions = self.query(filter_query, sort_by)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.columns)
+        for start in range(0, len(positions), chunk_rows):
+            writer.writerows(zip(*([self._display[column][position] for position in positions[start:start + chunk_rows].tolist()]
+                                   for column in self.columns)))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic import write_sites_geojson
+
+
+@pytest.fixture(scope="session")
+def client(tmp_path_factory):
+    """Flask test client of the app, configured against a synthetic catalog in a temporary directory"""
+
+    directory = tmp_path_factory.mktemp("web-map")
+    os.makedirs(directory / "assets" / "sites")
+    os.environ.update({
+        "CONTACT_EMAIL": "test@example.com", "DEPLOY_STATUS": "test", "PORT": "8050", "DEBUG_STATUS": "",
+        "ML_MODEL_PATH": "models/change_detection.pt", "CHANGE_DETECTION_SCRIPT": "scripts/change_detection.py",
+        "ASSETS_DIRECTORY": str(directory / "assets"),
+        "SITES_METADATA": write_sites_geojson(str(directory / "assets" / "sites" / "sites.geojson"), 500),
+        "ML_RESULTS_DIRECTORY": str(directory / "ml_results"),
+        "TILE_CACHE_DIRECTORY": str(directory / "tile_cache"),
+        "ML_RESULT_TILE_CACHE_DIRECTORY": str(directory / "ml_result_tiles"),
+        "ML_RESULT_CACHE_DIRECTORY": str(directory / "ml_result_cache"),
+        "CATALOG_SNAPSHOT_DIRECTORY": str(directory / "catalog_snapshots"),
+        "LONG_CALLBACK_CACHE_DIRECTORY": str(directory / "long_callback_cache"),
+        "ML_JOB_DATABASE": str(directory / "ml_jobs.sqlite"),
+        "ML_POOL_ADDRESS": str(directory / "ml-pool.sock"),
+        "METRICS_DIRECTORY": str(directory / "metrics"),
+        "ML_WORKER_PROCESSES": "1",
+        "TILE_PREFETCH_WORKERS": "0",
+    })
+
+    import app
+    return app.server.test_client()
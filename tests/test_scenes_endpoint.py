@@ -0,0 +1,26 @@
+import json
+
+
+def test_bbox_query(client):
+    response = client.get("/app/WEB/scenes.json?bbox=-180,-90,180,90&limit=10")
+
+    assert response.status_code == 200
+    scenes = json.loads(response.get_data())
+    assert scenes["numberMatched"] == 500
+    assert scenes["numberReturned"] == 10
+
+
+def test_posted_query(client):
+    response = client.post("/app/WEB/scenes.json", json={"bbox": [-180, -90, 180, 90], "start": "2020-01-01", "limit": 5})
+
+    assert response.status_code == 200
+    assert json.loads(response.get_data())["numberReturned"] == 5
+
+
+def test_invalid_bbox(client):
+    assert client.get("/app/WEB/scenes.json?bbox=1,2,3").status_code == 400
+
+
+def test_query_that_is_not_an_object(client):
+    assert client.post("/app/WEB/scenes.json", json=[1, 2]).status_code == 400
+    assert client.post("/app/WEB/scenes.json", json="bbox").status_code == 400
@@ -0,0 +1,54 @@
+import geopandas as gpd
+import numpy as np
+import rasterio.features
+import rasterio.windows
+import shapely
+from rasterio.transform import from_origin
+
+import tiled_change_detection
+
+CRS = "EPSG:32611"
+TRANSFORM = from_origin(500000, 5700000, 1, 1)
+
+
+def changed_pixels(size, seam, seed=0):
+    """Mask of rectangular blobs, including ones that only touch diagonally and ones across window seams"""
+
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(60):
+        row, col = rng.integers(0, size - 40, 2)
+        height, width = rng.integers(3, 40, 2)
+        mask[row:row + height, col:col + width] = 1
+    # pairs meeting at a corner only, one on a vertical seam and one on a horizontal one
+    for row, col in ((20, seam), (seam, 20)):
+        mask[row - 6:row, col - 6:col] = 1
+        mask[row:row + 6, col:col + 6] = 1
+    return mask
+
+
+def detect(mask, window=None):
+    """Polygons of the changed pixels, as a change detection script would write them"""
+
+    window = window or rasterio.windows.Window(0, 0, mask.shape[1], mask.shape[0])
+    data = mask[rasterio.windows.window_index(window)]
+    shapes = rasterio.features.shapes(data, mask=data.astype(bool), connectivity=4,
+                                      transform=rasterio.windows.transform(window, TRANSFORM))
+    geometries = [shapely.geometry.shape(geometry) for geometry, _ in shapes]
+    return gpd.GeoDataFrame({"score": np.ones(len(geometries))}, geometry=geometries, crs=CRS)
+
+
+def test_merged_windows_match_a_single_run():
+    size = 600
+    windows = tiled_change_detection.plan_windows(size, size, window_size=200, overlap=32)
+    first_core = windows[0][1]
+    mask = changed_pixels(size, seam=first_core.width)
+    whole = detect(mask)
+
+    tiled = tiled_change_detection.merge_window_results([(detect(mask, window), core) for window, core in windows],
+                                                        CRS, TRANSFORM, size, size)
+
+    assert len(windows) > 1
+    assert len(tiled) == len(whole)
+    assert tiled.geometry.area.sum() == whole.geometry.area.sum()
+    assert sorted(tiled.geometry.area) == sorted(whole.geometry.area)
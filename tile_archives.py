@@ -0,0 +1,202 @@
+"""MBTiles archives as a backend for pre-rendered tile pyramids
+
+    python tile_archives.py <assets>/tiles/site1/1 [--output <assets>/tiles/site1/1.mbtiles]
+
+A pyramid stored as `<location>/<z>/<x>/<y>.png` costs one open on the blob
+mount per tile, and millions of tiny files per site. The same pyramid can
+instead be converted into a single `<location>.mbtiles` next to it (an
+SQLite database in the MBTiles 1.3 layout), so a tile is an indexed read
+inside one already open file.
+
+`TileArchives` finds the archive of a location, if there is one, and reads
+tiles from a pool of read-only connections with SQLite's memory mapped I/O.
+Locations without an archive keep being served from their directories; the
+absence of an archive is remembered for `recheck_seconds`, so directory
+pyramids don't pay an extra stat per tile. A replaced archive (converted
+again, same name) is reopened once its mtime changes.
+
+"""
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from werkzeug.security import safe_join
+
+ARCHIVE_SUFFIX = ".mbtiles"
+# idle read-only connections kept per archive
+MAX_IDLE_CONNECTIONS = 8
+# archives of up to this many bytes are read through mmap
+MMAP_SIZE_BYTES = 1 << 30
+# how long a location is known to have (or lack) an archive before its file is checked again
+RECHECK_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+"""
+# created after the bulk insert, which is much faster than maintaining it row by row
+INDEX = "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)"
+
+
+class _Archive:
+    """One MBTiles file with a pool of read-only connections"""
+
+    def __init__(self, path, mtime_ns):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # immutable: readers take no locks; a new version of the file is a new inode, picked up by mtime
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+        return connection
+
+    def read(self, z, x, y):
+        """Tile bytes, or None if the archive has no such tile"""
+
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connect()
+
+        try:
+            # MBTiles rows count from the south (TMS), XYZ rows from the north
+            row = connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                     (z, x, (1 << z) - 1 - y)).fetchone()
+        finally:
+            with self._lock:
+                kept = len(self._idle) < MAX_IDLE_CONNECTIONS
+                if kept:
+                    self._idle.append(connection)
+            if not kept:
+                connection.close()
+
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class TileArchives:
+    """Archives of the pyramids under `directory`, looked up by location"""
+
+    def __init__(self, directory, recheck_seconds=RECHECK_SECONDS):
+        self.directory = directory
+        self.recheck_seconds = recheck_seconds
+        # location -> _Archive, or None for a location known to have none
+        self._archives = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def archive(self, location):
+        """The open archive of a location, or None if it has none"""
+
+        now = time.monotonic()
+        with self._lock:
+            archive = self._archives.get(location)
+            if now - self._checked.get(location, -self.recheck_seconds) < self.recheck_seconds:
+                return archive
+
+        path = safe_join(self.directory, location + ARCHIVE_SUFFIX)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            mtime_ns = None
+
+        stale = None
+        with self._lock:
+            archive = self._archives.get(location)
+            if mtime_ns is None:
+                stale, archive = archive, None
+            elif archive is None or archive.mtime_ns != mtime_ns:
+                stale, archive = archive, _Archive(path, mtime_ns)
+            self._archives[location] = archive
+            self._checked[location] = now
+        if stale is not None:
+            stale.close()
+
+        return archive
+
+    def read(self, location, z, x, y):
+        """(found, tile): found is False when the location has no archive; tile is None for a tile it lacks"""
+
+        archive = self.archive(location)
+        if archive is None:
+            return False, None
+        return True, archive.read(z, x, y)
+
+
+def convert(directory, output=None, extension=None):
+    """Write the pyramid under `directory` (<z>/<x>/<y>.<ext>) to an MBTiles file; returns (path, tiles)"""
+
+    output = output or directory.rstrip("/") + ARCHIVE_SUFFIX
+    temporary_output = f"{output}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if os.path.exists(temporary_output):
+        os.remove(temporary_output)
+
+    def tiles():
+        for z in sorted(int(name) for name in os.listdir(directory) if name.isdigit()):
+            for x_name in os.listdir(os.path.join(directory, str(z))):
+                if not x_name.isdigit():
+                    continue
+                for filename in os.listdir(os.path.join(directory, str(z), x_name)):
+                    y_name, _, tile_extension = filename.partition(".")
+                    if not y_name.isdigit() or (extension and tile_extension != extension):
+                        continue
+                    formats.add(tile_extension)
+                    with open(os.path.join(directory, str(z), x_name, filename), "rb") as f:
+                        yield z, int(x_name), (1 << z) - 1 - int(y_name), f.read()
+
+    formats = set()
+    connection = sqlite3.connect(temporary_output)
+    try:
+        connection.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;" + SCHEMA)
+        count = connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", tiles()).rowcount
+        if not count:
+            raise ValueError(f"{directory} holds no <z>/<x>/<y> tiles")
+        if len(formats) > 1:
+            raise ValueError(f"{directory} mixes tile formats {sorted(formats)}; pick one with `extension`")
+        connection.execute(INDEX)
+        zooms = connection.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles").fetchone()
+        connection.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("name", os.path.basename(directory.rstrip("/"))),
+            ("format", formats.pop()),
+            ("type", "overlay"),
+            ("minzoom", str(zooms[0])),
+            ("maxzoom", str(zooms[1])),
+        ])
+        connection.commit()
+    except BaseException:
+        connection.close()
+        os.remove(temporary_output)
+        raise
+    connection.close()
+
+    # readers opened the previous archive by inode; they reopen on the new mtime
+    os.replace(temporary_output, output)
+    return output, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="pyramid directory holding <z>/<x>/<y>.<ext>")
+    parser.add_argument("--output", help=f"archive path; defaults to the directory name + {ARCHIVE_SUFFIX}")
+    parser.add_argument("--extension", help="only tiles with this extension")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    output, count = convert(args.directory, args.output, args.extension)
+    print(f"{count} tiles written to {output} ({os.path.getsize(output) / 2**20:.1f} MiB) in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
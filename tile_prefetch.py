@@ -0,0 +1,140 @@
+"""Background warming of the tile cache for the scene a user is about to look at
+
+Selecting a site moves the map to the site's view and selecting a date
+points the imagery layer at a scene; without warming, every tile of that
+first screen is a cold read from blob storage. `TilePrefetcher` fetches the
+scene's tiles in the background as soon as the selection is made, through
+the same path as a tile request, so they land in the tile cache:
+
+- at the zooms users actually look at, learned from the tile requests it is
+  told about (as offsets from each site's initial view zoom),
+- over the scene's footprint, nearest the site's view centre first, at most
+  `max_tiles` tiles and `max_bytes` bytes per selection,
+- on `max_workers` threads, which bounds the extra load on blob storage.
+
+A newer selection from the same browser session supersedes the previous
+one's unfinished prefetch.
+
+"""
+
+import itertools
+import logging
+import math
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from tiling import tile_bounds_lnglat, tiles_for_bounds
+
+log = logging.getLogger(__name__)
+
+# zoom offsets from a site's view zoom prefetched until tile requests show which ones are used
+DEFAULT_ZOOM_OFFSETS = (0, 1, -1)
+MAX_ZOOM = 22
+
+
+class TilePrefetcher:
+    """Warms tiles through `fetch(scene, z, x, y)` on a small thread pool"""
+
+    def __init__(self, fetch, max_workers=2, max_tiles=256, max_bytes=64 * 2**20, zoom_levels=2):
+        self._fetch = fetch
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="tile-prefetch")
+        self.max_tiles = max_tiles
+        self.max_bytes = max_bytes
+        self.zoom_levels = zoom_levels
+        # zoom - view zoom of each tile request -> requests
+        self._zoom_offsets = Counter()
+        # owner -> generation of its latest prefetch
+        self._generations = {}
+        self._next_generation = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def record_request(self, z, view_zoom):
+        """Count a tile request at zoom `z` for a scene whose site opens at `view_zoom`"""
+
+        with self._lock:
+            self._zoom_offsets[z - view_zoom] += 1
+
+    def zooms(self, view_zoom):
+        """The `zoom_levels` zooms most requested relative to a site's view zoom, coarsest first"""
+
+        with self._lock:
+            offsets = [offset for offset, _ in self._zoom_offsets.most_common(self.zoom_levels)]
+        for offset in DEFAULT_ZOOM_OFFSETS:
+            if len(offsets) >= self.zoom_levels:
+                break
+            if offset not in offsets:
+                offsets.append(offset)
+
+        return sorted({view_zoom + offset for offset in offsets if 0 <= view_zoom + offset <= MAX_ZOOM})
+
+    def plan(self, bounds, center, view_zoom):
+        """(z, x, y) tiles covering `bounds` (west, south, east, north) to prefetch, most likely seen first
+
+        Coarser zooms come first, then tiles nearest `center` (lng, lat); at most `max_tiles`.
+        """
+
+        west, south, east, north = bounds
+        # the centre, moved into the footprint if the view is off it
+        lng, lat = min(max(center[0], west), east), min(max(center[1], south), north)
+
+        def distance(tile):
+            tile_west, tile_south, tile_east, tile_north = tile_bounds_lnglat(*tile)
+            return ((tile_west + tile_east) / 2 - lng) ** 2 + ((tile_south + tile_north) / 2 - lat) ** 2
+
+        tiles = []
+        for z in self.zooms(view_zoom):
+            # a large footprint at a fine zoom has far more tiles than are kept; only list those around the centre
+            half_width = (math.sqrt(self.max_tiles) / 2 + 1) * 360 / 2 ** z
+            window = (max(west, lng - half_width), max(south, lat - half_width), min(east, lng + half_width), min(north, lat + half_width))
+            tiles.extend(sorted(tiles_for_bounds(*window, z), key=distance))
+            if len(tiles) >= self.max_tiles:
+                break
+
+        return tiles[:self.max_tiles]
+
+    def prefetch(self, owner, scene, bounds, center, view_zoom):
+        """Warm the tiles of `scene` in the background; replaces `owner`'s (a browser session's) unfinished prefetch"""
+
+        tiles = self.plan(bounds, center, view_zoom)
+        with self._lock:
+            generation = self._generations[owner] = next(self._next_generation)
+
+        log.debug("Prefetching %s tiles of scene %s at zooms %s", len(tiles), scene["uuid"], sorted({tile[0] for tile in tiles}))
+        self._executor.submit(self._run, owner, generation, scene, tiles)
+
+    def submit(self, function, *args):
+        """Run other warming work (e.g. loading ML result indexes) within the same concurrency limit"""
+
+        return self._executor.submit(self._logged, function, *args)
+
+    @staticmethod
+    def _logged(function, *args):
+        try:
+            function(*args)
+        except Exception as error:
+            log.warning("Prefetch %s failed: %s", getattr(function, "__name__", function), error)
+
+    def _current(self, owner, generation):
+        with self._lock:
+            return self._generations.get(owner) == generation
+
+    def _run(self, owner, generation, scene, tiles):
+        fetched = fetched_bytes = 0
+        try:
+            for z, x, y in tiles:
+                # the session has moved on to another site or date
+                if not self._current(owner, generation) or fetched_bytes >= self.max_bytes:
+                    break
+                tile = self._fetch(scene, z, x, y)
+                fetched += 1
+                fetched_bytes += len(tile or b"")
+        except Exception as error:
+            # the same error would fail the user's own request for the tile; nothing more to warm
+            log.warning("Prefetch of scene %s stopped: %s", scene["uuid"], error)
+        finally:
+            with self._lock:
+                if self._generations.get(owner) == generation:
+                    del self._generations[owner]
+
+        log.debug("Prefetched %s of %s tiles (%s bytes) of scene %s", fetched, len(tiles), fetched_bytes, scene["uuid"])
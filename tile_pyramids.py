@@ -0,0 +1,339 @@
+"""XYZ tile pyramids pre-rendered from the catalog's GeoTIFFs
+
+    python tile_pyramids.py [--processes 4] [--format webp] [--quantize-bits 5] [--uuid ...]
+
+`update_pyramids()` renders every tile of each scene, from the zoom where
+the scene fits in one tile down to its native resolution, with a process
+pool, and writes them under `<assets>/tilemaps/<uuid>/<version>/`. Empty
+tiles (outside the scene, or all nodata) are not written; requests for them
+fall through to on-demand rendering, which answers 404 and caches that.
+
+A pyramid's version is a digest of its source GeoTIFF's size and mtime and
+of the tiling options, and a `pyramid.json` written after its last tile
+marks it complete. Scenes whose complete pyramid is already on disk are
+skipped, so a run only renders scenes that are new or whose source changed,
+and a new version gets a new url that no browser or tile cache holds stale
+copies of.
+
+Rendered scenes get their `tilemaps_path` in sites.geojson pointed at the
+new version (the catalog watcher picks the change up), then older versions
+and pyramids of scenes no longer in the catalog are deleted. Scenes whose
+`tilemaps_path` points at a pyramid made elsewhere that is on disk are left
+alone unless `replace_existing` is set.
+
+The app runs this as a background job in the ML job queue; each run logs
+(and the command line prints) tiles/sec and bytes written.
+
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+
+import scene_tiles
+import tile_archives
+from tiling import ORIGIN_SHIFT, tiles_for_bounds
+
+log = logging.getLogger(__name__)
+
+# pyramids are written under <assets directory>/TILEMAPS_DIRECTORY and served by serve_tiles()
+TILEMAPS_DIRECTORY = "tilemaps"
+MANIFEST_FILENAME = "pyramid.json"
+FORMATS = ("png", "webp")
+# WebP quality; ignored for PNG
+DEFAULT_QUALITY = 85
+MAX_ZOOM = 22
+# tiles rendered per pool task
+TILES_PER_TASK = 64
+# memory a render process is budgeted in the ML job queue
+WORKER_MEMORY_MB = 256
+
+
+def encode_tile(rgba, tile_format="png", quality=DEFAULT_QUALITY, quantize_bits=None):
+    """Encoded bytes of a (4, height, width) uint8 tile
+
+    `quantize_bits` keeps only the top bits of each colour channel, which
+    shrinks PNG tiles considerably for a small loss of colour depth.
+    """
+
+    if quantize_bits:
+        mask = (0xFF << (8 - quantize_bits)) & 0xFF
+        rgba = np.concatenate([rgba[:3] & mask, rgba[3:]])
+
+    if tile_format == "png":
+        return scene_tiles.encode_png(rgba)
+
+    count, height, width = rgba.shape
+    options = {"LOSSLESS": "TRUE"} if quality >= 100 else {"QUALITY": str(quality)}
+    with MemoryFile() as memory_file:
+        with memory_file.open(driver="WEBP", width=width, height=height, count=count, dtype="uint8", **options) as webp:
+            webp.write(rgba)
+        return memory_file.read()
+
+
+def zoom_range(geotiff_path, min_zoom=None, max_zoom=None):
+    """(min zoom, max zoom): from the zoom where the scene fits one tile to its native resolution"""
+
+    with rasterio.open(geotiff_path) as dataset:
+        west, south, east, north = transform_bounds(dataset.crs, "EPSG:3857", *dataset.bounds)
+        width = dataset.width
+
+    world = 2 * ORIGIN_SHIFT
+    native = math.ceil(math.log2(world / (scene_tiles.TILE_SIZE * (east - west) / width)))
+    fits_one_tile = math.floor(math.log2(world / max(east - west, north - south)))
+
+    max_zoom = min(native, MAX_ZOOM) if max_zoom is None else max_zoom
+    min_zoom = max(0, min(fits_one_tile, max_zoom)) if min_zoom is None else min_zoom
+    return min_zoom, max(min_zoom, max_zoom)
+
+
+def _pyramid_version(geotiff_path, options):
+    stat = os.stat(geotiff_path)
+    key = json.dumps([stat.st_size, stat.st_mtime_ns, scene_tiles.TILE_SIZE, options], sort_keys=True)
+    return hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+
+
+def _render_tiles(geotiff_path, directory, tiles, tile_format, quality, quantize_bits):
+    """Render and write tiles; returns (tiles written, bytes written). Runs in the pool"""
+
+    written = size = 0
+    for z, x, y in tiles:
+        rgba = scene_tiles.render_tile(geotiff_path, z, x, y)
+        if rgba is None or not rgba[3].any():
+            continue
+        tile = encode_tile(rgba, tile_format, quality, quantize_bits)
+        os.makedirs(os.path.join(directory, str(z), str(x)), exist_ok=True)
+        with open(os.path.join(directory, str(z), str(x), f"{y}.{tile_format}"), "wb") as f:
+            f.write(tile)
+        written += 1
+        size += len(tile)
+
+    return written, size
+
+
+def tilemaps_path(uuid, version, tile_format):
+    """`tilemaps_path` of a generated pyramid, as served by serve_tiles()"""
+
+    return f"{scene_tiles.MAPTILES_URL_PREFIX}{TILEMAPS_DIRECTORY}/{uuid}/{version}/{{z}}/{{x}}/{{y}}.{tile_format}"
+
+
+def _is_generated(path):
+    return bool(path) and path.startswith(f"{scene_tiles.MAPTILES_URL_PREFIX}{TILEMAPS_DIRECTORY}/")
+
+
+def _has_external_pyramid(assets_directory, path):
+    """Whether `path` is a tilemaps_path of a pyramid made elsewhere that is on disk"""
+
+    if not path or _is_generated(path) or not path.startswith(scene_tiles.MAPTILES_URL_PREFIX):
+        return False
+    location = os.path.join(assets_directory, scene_tiles.pyramid_location(path))
+    return os.path.isdir(location) or os.path.isfile(location + tile_archives.ARCHIVE_SUFFIX)
+
+
+def _property_key(properties, name):
+    """Key of a sites.geojson property, matching the case the file uses"""
+
+    for key in properties:
+        if key.lower() == name:
+            return key
+    return name.upper() if any(key.isupper() for key in properties) else name
+
+
+def _read_sites(sites_path):
+    with open(sites_path, "rb") as f:
+        return json.loads(f.read())
+
+
+def write_tilemaps_paths(sites_path, paths):
+    """Set `tilemaps_path` of the scenes in `paths` (uuid -> path) in sites.geojson; returns the number changed"""
+
+    feature_collection = _read_sites(sites_path)
+    changed = 0
+    for feature in feature_collection["features"]:
+        properties = feature["properties"]
+        path = paths.get(properties.get(_property_key(properties, "uuid")))
+        key = _property_key(properties, "tilemaps_path")
+        if path is not None and properties.get(key) != path:
+            properties[key] = path
+            changed += 1
+
+    if changed:
+        # write then rename so the catalog watcher never reads a partial file
+        temporary_path = f"{sites_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(feature_collection, f)
+        os.replace(temporary_path, sites_path)
+
+    return changed
+
+
+def _prune(tilemaps_directory, current_versions):
+    """Delete pyramid versions not in `current_versions` (uuid -> version) and pyramids of removed scenes"""
+
+    for scene_entry in os.scandir(tilemaps_directory) if os.path.isdir(tilemaps_directory) else ():
+        version = current_versions.get(scene_entry.name)
+        if version is None:
+            shutil.rmtree(scene_entry.path, ignore_errors=True)
+            continue
+        for version_entry in os.scandir(scene_entry.path):
+            # the current version's directory, and its archive if it was converted to one
+            if version_entry.name not in (version, version + tile_archives.ARCHIVE_SUFFIX):
+                if version_entry.is_dir():
+                    shutil.rmtree(version_entry.path, ignore_errors=True)
+                else:
+                    os.remove(version_entry.path)
+
+
+def update_pyramids(sites_path, assets_directory, processes=1, tile_format="png", quality=DEFAULT_QUALITY,
+                    quantize_bits=None, min_zoom=None, max_zoom=None, uuids=None, replace_existing=False,
+                    progress=None, cancelled=None):
+    """Render the pyramids of new and changed scenes and point sites.geojson at them
+
+    `progress(done, total)` is called as tiles complete and `cancelled()`
+    is polled between tasks. Returns a summary dict: scenes rendered,
+    skipped and failed, tiles and bytes written, seconds and tiles/sec.
+    """
+
+    if tile_format not in FORMATS:
+        raise ValueError(f"tile_format must be one of {FORMATS}")
+
+    started = time.perf_counter()
+    tilemaps_directory = os.path.join(assets_directory, TILEMAPS_DIRECTORY)
+    options = {"format": tile_format, "quality": quality, "quantize_bits": quantize_bits, "min_zoom": min_zoom, "max_zoom": max_zoom}
+
+    # uuid -> version of the pyramid sites.geojson should point at; kept pyramids included, so pruning spares them
+    current_versions = {}
+    # uuid -> (geotiff path, version directory, version, tiles)
+    scenes = {}
+    summary = {"scenes": 0, "skipped_scenes": 0, "failed_scenes": [], "tiles": 0, "bytes": 0}
+
+    for feature in _read_sites(sites_path)["features"]:
+        properties = {key.lower(): value for key, value in feature["properties"].items()}
+        uuid, existing_path = properties.get("uuid"), properties.get("tilemaps_path")
+        geotiff_path = os.path.join(assets_directory, properties.get("geotiff_path") or "")
+        if _is_generated(existing_path):
+            current_versions[uuid] = existing_path[len(scene_tiles.MAPTILES_URL_PREFIX):].split("/")[2]
+        if (uuids and uuid not in uuids) or not os.path.isfile(geotiff_path) \
+                or (_has_external_pyramid(assets_directory, existing_path) and not replace_existing):
+            continue
+
+        version = _pyramid_version(geotiff_path, options)
+        directory = os.path.join(tilemaps_directory, uuid, version)
+        # a converted pyramid's directory may have been deleted; its archive is as good
+        if os.path.exists(os.path.join(directory, MANIFEST_FILENAME)) or os.path.exists(directory + tile_archives.ARCHIVE_SUFFIX):
+            summary["skipped_scenes"] += 1
+            current_versions[uuid] = version
+            continue
+
+        with rasterio.open(geotiff_path) as dataset:
+            bounds = transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds)
+        low, high = zoom_range(geotiff_path, min_zoom, max_zoom)
+        tiles = [tile for z in range(low, high + 1) for tile in tiles_for_bounds(*bounds, z)]
+        scenes[uuid] = (geotiff_path, directory, version, tiles)
+
+    total = sum(len(tiles) for _, _, _, tiles in scenes.values())
+    done = 0
+    # uuid -> tasks still running; a scene is complete when its count reaches 0
+    remaining = {}
+    rendered = {}
+
+    # this runs on a thread of the multithreaded ML pool server, which must not fork; render processes come
+    # from a fork server, which imports this module (and its rasterio) once for all of them
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    with ProcessPoolExecutor(max(1, processes), mp_context=context) as executor:
+        futures = {}
+        for uuid, (geotiff_path, directory, _, tiles) in scenes.items():
+            for start in range(0, len(tiles), TILES_PER_TASK):
+                chunk = tiles[start:start + TILES_PER_TASK]
+                future = executor.submit(_render_tiles, geotiff_path, directory, chunk, tile_format, quality, quantize_bits)
+                futures[future] = (uuid, len(chunk))
+                remaining[uuid] = remaining.get(uuid, 0) + 1
+
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                uuid, count = futures[future]
+                done += count
+                remaining[uuid] -= 1
+                try:
+                    written, size = future.result()
+                except Exception as error:
+                    log.error("Rendering tiles of scene %s failed: %r", uuid, error)
+                    if uuid not in summary["failed_scenes"]:
+                        summary["failed_scenes"].append(uuid)
+                    continue
+                summary["tiles"] += written
+                summary["bytes"] += size
+
+                if remaining[uuid] == 0 and uuid not in summary["failed_scenes"]:
+                    geotiff_path, directory, version, tiles = scenes[uuid]
+                    # written last: marks the pyramid complete
+                    os.makedirs(directory, exist_ok=True)
+                    with open(os.path.join(directory, MANIFEST_FILENAME), "w") as f:
+                        json.dump({"source": geotiff_path, "options": options, "tiles": len(tiles)}, f)
+                    rendered[uuid] = tilemaps_path(uuid, version, tile_format)
+                    current_versions[uuid] = version
+                    summary["scenes"] += 1
+
+            if progress:
+                progress(done, total)
+            # checked after recording the finished renders, so scenes already complete keep their manifest
+            if cancelled and cancelled():
+                for future in pending:
+                    future.cancel()
+                summary["cancelled"] = True
+                break
+
+    if rendered:
+        write_tilemaps_paths(sites_path, rendered)
+    if not summary.get("cancelled") and not uuids:
+        _prune(tilemaps_directory, current_versions)
+
+    summary["seconds"] = time.perf_counter() - started
+    summary["tiles_per_second"] = summary["tiles"] / summary["seconds"] if summary["seconds"] else 0
+    log.info("Tile pyramids: %d scenes rendered, %d unchanged, %d failed; %d tiles, %d bytes in %.1fs (%.0f tiles/s)",
+             summary["scenes"], summary["skipped_scenes"], len(summary["failed_scenes"]), summary["tiles"],
+             summary["bytes"], summary["seconds"], summary["tiles_per_second"])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", default="/blob/assets/sites/sites.geojson")
+    parser.add_argument("--assets", default="/blob/assets")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--format", choices=FORMATS, default="png")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="WebP quality, 100 for lossless")
+    parser.add_argument("--quantize-bits", type=int, choices=range(1, 8), help="bits kept per colour channel")
+    parser.add_argument("--min-zoom", type=int)
+    parser.add_argument("--max-zoom", type=int)
+    parser.add_argument("--uuid", nargs="+", help="only these scenes")
+    parser.add_argument("--replace-existing", action="store_true", help="also render scenes with a pyramid made elsewhere")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    summary = update_pyramids(args.sites, args.assets, args.processes, args.format, args.quality, args.quantize_bits,
+                              args.min_zoom, args.max_zoom, set(args.uuid or ()), args.replace_existing,
+                              progress=lambda done, total: print(f"\r{done}/{total} tiles", end="", flush=True))
+    print()
+    print(f"{summary['scenes']} scenes rendered, {summary['skipped_scenes']} unchanged, {len(summary['failed_scenes'])} failed")
+    print(f"{summary['tiles']} tiles, {summary['bytes'] / 2**20:.1f} MiB written in {summary['seconds']:.1f}s "
+          f"({summary['tiles_per_second']:.0f} tiles/s, {summary['bytes'] / max(summary['tiles'], 1) / 1024:.1f} KiB/tile)")
+
+
+if __name__ == "__main__":
+    main()
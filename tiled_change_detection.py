@@ -0,0 +1,426 @@
+"""Change detection over large scenes in overlapping windows
+
+Handing two whole GeoTIFFs to the change detection script makes it hold
+both rasters in memory and run on one core. Instead the before/after pair
+is split into overlapping windows on the before image's pixel grid (the
+after image is warped onto that grid if it differs). Each window is a
+"change_detection_window" job on the ML worker pool, which cuts the window
+pair to small GeoTIFFs and runs the unchanged script on them. At most a
+couple of windows per worker are in flight, which bounds memory whatever
+the scene size.
+
+Each window owns its core, the window without half the overlap on each
+inner side. Window results are clipped to their cores, and polygons cut by
+a seam between cores are dissolved back into one feature, so the merged
+GeoJSON looks like the output of a single run.
+
+Scenes that fit in a single window run as one plain "change_detection" job.
+
+`run_series()` compares each consecutive pair of a time series of scenes.
+Its "change_detection_series_window" jobs cut every scene of a window once
+and run all the window's pairs on those files, and the results of all pairs
+are merged into one layer annotated with the dates of each pair.
+
+"""
+
+import contextlib
+import math
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, bounds as window_bounds
+
+import ml_result_files
+
+WINDOW_SIZE = 2048
+WINDOW_OVERLAP = 128
+# windows queued per pool worker; bounds the window files on disk and the memory in the workers
+WINDOWS_IN_FLIGHT_PER_WORKER = 2
+# how often a run polls the pool for progress reported by the script and for a cancel request
+PROGRESS_POLL_SECONDS = 1
+# rough peak memory of a worker per input pixel: both images, the script's float copies and its outputs
+WORKER_BYTES_PER_PIXEL = 64
+
+
+def plan_windows(width, height, window_size=WINDOW_SIZE, overlap=WINDOW_OVERLAP, block_size=None):
+    """[(window, core)] covering a width x height raster
+
+    Consecutive windows overlap by `overlap` pixels; their cores tile the
+    raster without gaps or overlaps. With `block_size`, window offsets are
+    aligned to the raster's internal tiling so every block is read whole.
+    """
+
+    step = max(1, window_size - overlap)
+    if block_size and step >= block_size:
+        step = step // block_size * block_size
+    window_size = step + overlap
+
+    def spans(length):
+        count = max(1, math.ceil((length - overlap) / step))
+        for index in range(count):
+            offset = index * step
+            size = min(window_size, length - offset)
+            core_start = offset + overlap // 2 if index > 0 else 0
+            core_end = offset + size - overlap // 2 if index < count - 1 else length
+            yield offset, size, core_start, core_end - core_start
+
+    return [
+        (Window(col_off, row_off, width_, height_), Window(core_col_off, core_row_off, core_width, core_height))
+        for row_off, height_, core_row_off, core_height in spans(height)
+        for col_off, width_, core_col_off, core_width in spans(width)
+    ]
+
+
+def estimate_cost(before, pool_size, window_size=WINDOW_SIZE, overlap=WINDOW_OVERLAP):
+    """(workers, memory in MB) a run on the `before` image is expected to use
+
+    Used to budget runs before they start, so it only reads the image header.
+    """
+
+    with rasterio.open(before) as dataset:
+        width, height = dataset.width, dataset.height
+
+    windows = plan_windows(width, height, window_size, overlap)
+    workers = min(len(windows), pool_size)
+    window, _ = windows[0]
+    memory_mb = workers * window.width * window.height * WORKER_BYTES_PER_PIXEL / 2**20
+    return workers, memory_mb
+
+
+def _aligned(dataset, reference):
+    """`dataset` on the pixel grid of `reference`, warped only if the grids differ"""
+
+    if (dataset.crs, dataset.transform, dataset.width, dataset.height) == (reference.crs, reference.transform, reference.width, reference.height):
+        return dataset
+    return WarpedVRT(dataset, crs=reference.crs, transform=reference.transform, width=reference.width, height=reference.height)
+
+
+def _write_window(dataset, window, path):
+    """Cut one window of a dataset to a GeoTIFF; False if the window holds no valid pixels"""
+
+    mask = dataset.read_masks(1, window=window)
+    if not mask.any():
+        return False
+
+    data = dataset.read(window=window)
+    profile = {
+        "driver": "GTiff", "width": int(window.width), "height": int(window.height), "count": dataset.count,
+        "dtype": dataset.dtypes[0], "crs": dataset.crs, "transform": dataset.window_transform(window),
+        "nodata": dataset.nodata,
+    }
+    with rasterio.open(path, "w", **profile) as window_dataset:
+        window_dataset.write(data)
+        if dataset.nodata is None and not mask.all():
+            window_dataset.write_mask(mask)
+
+    return True
+
+
+def write_window_series(paths, window, directory, names=None):
+    """Cut a window of each image in `paths` to a GeoTIFF in `directory`
+
+    Images are aligned to the grid of the first one. Returns the window path
+    of each image, None for images without data in the window.
+    """
+
+    names = names or [f"scene{index}" for index in range(len(paths))]
+    suffix = f"{int(window.row_off)}_{int(window.col_off)}"
+    window_paths = []
+
+    with contextlib.ExitStack() as stack:
+        reference = stack.enter_context(rasterio.open(paths[0]))
+        for path, name in zip(paths, names):
+            dataset = reference if path == paths[0] else stack.enter_context(rasterio.open(path))
+            dataset = _aligned(dataset, reference)
+            if isinstance(dataset, WarpedVRT):
+                stack.enter_context(dataset)
+
+            window_path = os.path.join(directory, f"{name}_{suffix}.tif")
+            window_paths.append(window_path if _write_window(dataset, window, window_path) else None)
+
+    return window_paths
+
+
+def write_window_pair(before_path, after_path, window, directory):
+    """Cut a window of a before/after pair to GeoTIFFs in `directory`
+
+    Returns (before window path, after window path), or None when either
+    image has no data in the window.
+    """
+
+    window_paths = write_window_series([before_path, after_path], window, directory, names=["before", "after"])
+    if None in window_paths:
+        for path in filter(None, window_paths):
+            os.remove(path)
+        return None
+    return tuple(window_paths)
+
+
+def _union_find_components(count, pairs):
+    """Component label per item given the (i, j) pairs that join items"""
+
+    parents = np.arange(count)
+
+    def root(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for i, j in pairs:
+        root_i, root_j = root(i), root(j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([root(item) for item in range(count)])
+
+
+def merge_window_results(window_results, crs, transform, width, height):
+    """One GeoDataFrame from per-window results
+
+    `window_results` is [(GeoDataFrame, core window)]. Features are clipped
+    to their window's core in the raster CRS; pieces touching a seam between
+    cores are dissolved with the pieces of other windows they share a stretch
+    of the seam with, keeping the properties of the largest piece. Pieces
+    that only meet at a corner are separate detections and stay separate.
+    """
+
+    raster_box = shapely.box(*window_bounds(Window(0, 0, width, height), transform))
+    output_crs = None
+    interior, seam = [], []
+
+    for window_index, (results, core) in enumerate(window_results):
+        if results.empty:
+            continue
+        output_crs = output_crs or results.crs
+        results = results.to_crs(crs)
+
+        core_bounds = window_bounds(core, transform)
+        clipped = results.set_geometry(shapely.clip_by_rect(results.geometry.to_numpy(), *core_bounds))
+        clipped = clipped[~clipped.geometry.is_empty]
+
+        # core edges that are not on the raster's own edge are seams with a neighbouring core
+        seam_lines = shapely.difference(shapely.box(*core_bounds).boundary, raster_box.boundary)
+        on_seam = shapely.intersects(clipped.geometry.to_numpy(), seam_lines)
+        interior.append(clipped[~on_seam])
+        seam.append(clipped[on_seam].assign(_window=window_index))
+
+    if output_crs is None:
+        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+
+    seam = pd.concat(seam, ignore_index=True)
+    if not seam.empty:
+        first, second = seam.sindex.query(seam.geometry, predicate="intersects")
+        windows = seam["_window"].to_numpy()
+        candidates = (first < second) & (windows[first] != windows[second])
+        first, second = first[candidates], second[candidates]
+        # cores don't overlap, so pieces of different windows meet only on seams: a cut detection's
+        # pieces share a length of seam, neighbouring detections at most a point
+        boundaries = shapely.boundary(seam.geometry.to_numpy())
+        shared = shapely.length(shapely.intersection(boundaries[first], boundaries[second])) > 0
+        pairs = zip(first[shared].tolist(), second[shared].tolist())
+        seam = seam.drop(columns="_window")
+        seam["_component"] = _union_find_components(len(seam), pairs)
+        seam["_area"] = seam.geometry.area
+        largest = seam.sort_values("_area", ascending=False).drop_duplicates("_component").set_index("_component")
+        dissolved = seam.groupby("_component").geometry.apply(lambda geometries: shapely.union_all(geometries.to_numpy()))
+        largest = largest.drop(columns="_area")
+        largest[largest.geometry.name] = dissolved.reindex(largest.index).to_numpy()
+        seam = largest.reset_index(drop=True)
+
+    merged = gpd.GeoDataFrame(pd.concat([*interior, seam], ignore_index=True), crs=crs)
+    return merged.to_crs(output_crs)
+
+
+def _raster_grid(path):
+    """(crs, transform, width, height, block size) of a GeoTIFF; block size is None unless it is tiled in square blocks"""
+
+    with rasterio.open(path) as dataset:
+        block_height, block_width = dataset.block_shapes[0]
+        block_size = block_width if dataset.profile.get("tiled") and block_width == block_height else None
+        return dataset.crs, dataset.transform, dataset.width, dataset.height, block_size
+
+
+def _progress_reporter(progress):
+    """report(done, total) calling `progress(done, total, eta_seconds)` with the ETA from the rate so far"""
+
+    started = time.monotonic()
+
+    def report(done, total):
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(done, total, elapsed / done * (total - done) if done else None)
+
+    return report
+
+
+def _wait(pool, job_id, cancelled, on_poll=None):
+    """Result of a pool job; the job is cancelled once `cancelled()` returns True"""
+
+    while (result := pool.wait(job_id, PROGRESS_POLL_SECONDS)) is None:
+        if cancelled and cancelled():
+            pool.cancel(job_id)
+            return pool.wait(job_id)
+        if on_poll:
+            on_poll()
+    return result
+
+
+def _run_window_jobs(pool, jobs, report, cancelled, max_workers):
+    """Run [(kind, params)] on the pool, a couple per worker at a time
+
+    Returns (stdout of the jobs, result of the first failed job or None).
+    """
+
+    in_flight = deque()
+    stdout = []
+    failure = None
+    pending = iter(jobs)
+    max_in_flight = min(pool.size(), max_workers or pool.size()) * WINDOWS_IN_FLIGHT_PER_WORKER
+    report(0, len(jobs))
+
+    while True:
+        # keep the pool busy without queueing every window of a huge scene at once
+        while failure is None and len(in_flight) < max_in_flight:
+            job = next(pending, None)
+            if job is None:
+                break
+            in_flight.append(pool.submit(*job))
+
+        if not in_flight:
+            break
+
+        result = _wait(pool, in_flight.popleft(), cancelled)
+        stdout.append(result["stdout"])
+        if result["returncode"] != 0:
+            failure = result
+            # the run has failed or was cancelled; don't keep workers busy on windows whose results would be thrown away
+            for job_id in in_flight:
+                pool.cancel(job_id)
+                pool.wait(job_id)
+            in_flight.clear()
+
+        report(len(stdout), len(jobs))
+
+    return "".join(stdout), failure
+
+
+def _read_window_result(path):
+    """Result of one window; a window without data has no result file"""
+
+    return gpd.read_file(path) if os.path.exists(path) else gpd.GeoDataFrame(geometry=[])
+
+
+def run(pool, script, model, before, after, output, window_size=WINDOW_SIZE, overlap=WINDOW_OVERLAP,
+        progress=None, cancelled=None, max_workers=None, work_directory=None, verbose=False):
+    """Run change detection for a before/after pair on the ML worker pool
+
+    `progress(done, total, eta_seconds)` is called as windows complete;
+    `eta_seconds` is None until the first one has. Once `cancelled()`
+    returns True the run's pool jobs are cancelled. At most `max_workers`
+    pool workers are kept busy. Returns a subprocess.run-like result dict
+    like `InferencePool.run()`.
+    """
+
+    crs, transform, width, height, block_size = _raster_grid(before)
+    report = _progress_reporter(progress)
+
+    windows = plan_windows(width, height, window_size, overlap, block_size)
+    if len(windows) == 1:
+        report(0, 1)
+        job_id = pool.submit("change_detection", {"script": script, "model": model, "before": before,
+                                                  "after": after, "output": output, "verbose": verbose})
+
+        def report_job_progress():
+            # scripts with a progress hook report their own (done, total)
+            job_progress = pool.progress(job_id)
+            if job_progress:
+                report(*job_progress)
+
+        result = _wait(pool, job_id, cancelled, report_job_progress)
+        if result["returncode"] == 0 and os.path.exists(output):
+            # the script wrote the result in one piece; rewrite it line per feature with its index
+            ml_result_files.write_result(gpd.read_file(output), output)
+        report(1, 1)
+        return result
+
+    run_directory = tempfile.mkdtemp(prefix="change_detection_", dir=work_directory)
+    try:
+        window_outputs = [os.path.join(run_directory, f"result_{index}.geojson") for index in range(len(windows))]
+        jobs = [("change_detection_window", {
+            "script": script, "model": model, "before": before, "after": after,
+            "window": [int(window.col_off), int(window.row_off), int(window.width), int(window.height)],
+            "output": window_output, "verbose": verbose}) for (window, _), window_output in zip(windows, window_outputs)]
+
+        stdout, failure = _run_window_jobs(pool, jobs, report, cancelled, max_workers)
+        if failure:
+            return {"returncode": failure["returncode"], "stdout": stdout, "stderr": failure["stderr"]}
+
+        completed = [(_read_window_result(window_output), core) for (_, core), window_output in zip(windows, window_outputs)]
+        ml_result_files.write_result(merge_window_results(completed, crs, transform, width, height), output)
+        return {"returncode": 0, "stdout": stdout, "stderr": ""}
+
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+
+def run_series(pool, script, model, scenes, dates, output, window_size=WINDOW_SIZE, overlap=WINDOW_OVERLAP,
+               progress=None, cancelled=None, max_workers=None, work_directory=None, verbose=False):
+    """Run change detection between each consecutive pair of a time series of scenes
+
+    `scenes` are GeoTIFF paths in date order and `dates` their labels. Each
+    window is one pool job that cuts every scene once and runs the script on
+    each consecutive pair of window files, so a scene is decoded (and
+    warped) once per window however many pairs it is in, and all pairs
+    progress in parallel across the pool's workers. When there are fewer
+    windows than workers, each pair of each window is its own job instead,
+    so the pairs of a small scene do not run one after another on a single
+    worker. The results of all pairs
+    are written to one GeoJSON whose features carry the `before_date` and
+    `after_date` of their pair. Arguments and the result are as for `run()`.
+    """
+
+    crs, transform, width, height, block_size = _raster_grid(scenes[0])
+    report = _progress_reporter(progress)
+    windows = plan_windows(width, height, window_size, overlap, block_size)
+    pair_count = len(scenes) - 1
+
+    run_directory = tempfile.mkdtemp(prefix="change_detection_series_", dir=work_directory)
+    try:
+        window_outputs = [[os.path.join(run_directory, f"result_{index}_{pair}.geojson") for pair in range(pair_count)]
+                          for index in range(len(windows))]
+        boxes = [[int(window.col_off), int(window.row_off), int(window.width), int(window.height)] for window, _ in windows]
+        if len(windows) < min(pool.size(), max_workers or pool.size()):
+            jobs = [("change_detection_window", {
+                "script": script, "model": model, "before": scenes[pair], "after": scenes[pair + 1],
+                "window": box, "output": pair_outputs[pair], "verbose": verbose})
+                for box, pair_outputs in zip(boxes, window_outputs) for pair in range(pair_count)]
+        else:
+            jobs = [("change_detection_series_window", {
+                "script": script, "model": model, "scenes": scenes,
+                "window": box, "outputs": pair_outputs, "verbose": verbose})
+                for box, pair_outputs in zip(boxes, window_outputs)]
+
+        stdout, failure = _run_window_jobs(pool, jobs, report, cancelled, max_workers)
+        if failure:
+            return {"returncode": failure["returncode"], "stdout": stdout, "stderr": failure["stderr"]}
+
+        # pair by pair, so the layer of all pairs is never built in memory at once
+        with ml_result_files.ResultWriter(output) as writer:
+            for pair in range(pair_count):
+                completed = [(_read_window_result(pair_outputs[pair]), core) for (_, core), pair_outputs in zip(windows, window_outputs)]
+                merged = merge_window_results(completed, crs, transform, width, height)
+                writer.write(merged.assign(before_date=dates[pair], after_date=dates[pair + 1]))
+        return {"returncode": 0, "stdout": stdout, "stderr": ""}
+
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
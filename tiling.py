@@ -0,0 +1,52 @@
+"""Web mercator XYZ tile helpers shared by the tile and ML result endpoints"""
+
+import math
+
+# half the circumference of the earth in web mercator metres
+ORIGIN_SHIFT = 20037508.342789244
+MAX_LATITUDE = 85.0511287798066
+
+
+def tile_bounds_mercator(z, x, y):
+    """(minx, miny, maxx, maxy) of an XYZ tile in EPSG:3857 metres"""
+
+    tile_size = 2 * ORIGIN_SHIFT / 2 ** z
+    minx = -ORIGIN_SHIFT + x * tile_size
+    maxy = ORIGIN_SHIFT - y * tile_size
+
+    return minx, maxy - tile_size, minx + tile_size, maxy
+
+
+def tile_bounds_lnglat(z, x, y):
+    """(west, south, east, north) of an XYZ tile in degrees"""
+
+    n = 2 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y)
+
+
+def lnglat_to_tile(lng, lat, z):
+    """XYZ tile (x, y) containing a point at zoom `z`"""
+
+    n = 2 ** z
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bounds(west, south, east, north, z):
+    """All XYZ tiles at zoom `z` covering a lng/lat bounding box"""
+
+    min_x, min_y = lnglat_to_tile(west, north, z)
+    max_x, max_y = lnglat_to_tile(east, south, z)
+
+    return [(z, x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z
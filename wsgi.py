@@ -0,0 +1,12 @@
+"""WSGI entry point for production serving
+
+    gunicorn --config gunicorn.conf.py wsgi:application
+
+Importing app builds the site catalog, opens the caches and starts the ML
+pool server. gunicorn.conf.py preloads it once in the master, so every
+forked worker shares the parsed catalog copy-on-write instead of parsing
+sites.geojson itself.
+
+"""
+
+from app import server as application